@@ -0,0 +1,107 @@
+"""
+ecot_reasoning_sweep.py
+
+Latency against success rate of ECoT for a range of reasoning budgets. Every
+configuration is set on a running ECoT service through
+/update_inference_parameters, then the SimplerEnv tasks are run with
+Experiment; step latency is measured at the client and the tokens decoded per
+step are read from the vla_decoded_tokens summary of /metrics.
+
+    python notebooks/ecot_reasoning_sweep.py --server-url http://localhost:8002 --episodes 10
+"""
+import argparse
+import json
+import time
+import numpy as np
+import requests
+
+from experiment import Experiment
+
+# max_reasoning_tokens / reasoning_sections / reasoning_interval of each run; {} is the full reasoning
+CONFIGS = [
+    {},
+    {"reasoning_sections": ["plan", "subtask", "move", "gripper_position"]},
+    {"reasoning_sections": ["plan", "move"]},
+    {"reasoning_sections": ["move"]},
+    {"max_reasoning_tokens": 128},
+    {"max_reasoning_tokens": 64},
+    {"reasoning_sections": ["plan", "move"], "reasoning_interval": 5},
+    {"reasoning_sections": []},
+]
+
+
+class TimedExperiment(Experiment):
+    """Experiment that keeps the round-trip latency of every step."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.latencies = []
+
+    def _step_model(self, img, prompt, session_id):
+        start = time.perf_counter()
+        action = super()._step_model(img, prompt, session_id)
+        self.latencies.append(time.perf_counter() - start)
+        return action
+
+
+def decoded_tokens(server_url):
+    """(sum, count) of the vla_decoded_tokens summary."""
+    values = {}
+    for line in requests.get(f"{server_url}/metrics").text.splitlines():
+        if line.startswith("vla_decoded_tokens_sum") or line.startswith("vla_decoded_tokens_count"):
+            name, value = line.split()
+            values[name] = float(value)
+    return values.get("vla_decoded_tokens_sum", 0.0), values.get("vla_decoded_tokens_count", 0.0)
+
+
+def update(server_url, params):
+    requests.post(f"{server_url}/update_inference_parameters", json=params).raise_for_status()
+
+
+def reset_budget(server_url):
+    # null turns the budget off, so {} runs the unbounded predict_action path
+    update(server_url, {"max_reasoning_tokens": None, "reasoning_sections": None, "reasoning_interval": 1})
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--server-url", default="http://localhost:8002")
+    parser.add_argument("--tasks", nargs="+", default=["widowx_carrot_on_plate", "widowx_spoon_on_towel"])
+    parser.add_argument("--episodes", type=int, default=10)
+    parser.add_argument("--output", default="ecot_reasoning_sweep.json")
+    args = parser.parse_args()
+
+    results = []
+    for config in CONFIGS:
+        reset_budget(args.server_url)
+        if config:
+            update(args.server_url, config)
+        tokens_before = decoded_tokens(args.server_url)
+        experiment = TimedExperiment(args.tasks, args.episodes, fps=5, experiment_name=f"ecot_sweep_{len(results)}",
+                                     server_url=args.server_url)
+        experiment.run()
+        tokens_after = decoded_tokens(args.server_url)
+        latencies = np.array(experiment.latencies) * 1000
+        steps = max(tokens_after[1] - tokens_before[1], 1)
+        result = {
+            "config": config,
+            "success_rate": float(np.mean([np.mean(m["success"]) for m in experiment.metrics.values()])),
+            "latency_ms_p50": float(np.percentile(latencies, 50)),
+            "latency_ms_p95": float(np.percentile(latencies, 95)),
+            "latency_ms_max": float(latencies.max()),
+            "tokens_per_step": (tokens_after[0] - tokens_before[0]) / steps,
+        }
+        results.append(result)
+        print(json.dumps(result))
+
+    reset_budget(args.server_url)
+    print(f"\n{'config':70s} success  p50 ms  p95 ms  tokens")
+    for r in results:
+        print(f"{json.dumps(r['config']):70s} {r['success_rate']:7.3f} {r['latency_ms_p50']:7.1f} "
+              f"{r['latency_ms_p95']:7.1f} {r['tokens_per_step']:7.1f}")
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
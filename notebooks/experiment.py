@@ -5,11 +5,21 @@ from simpler_env.utils.env.observation_utils import get_image_from_maniskill2_ob
 import numpy as np
 import mediapy as media
 import cv2
+import json
+import sys
 from pathlib import Path
+from websockets.sync.client import connect as ws_connect
+
+sys.path.append(str(Path(__file__).resolve().parents[1] / "server"))
+from common.frames import encode_frame, FRAME_CONTENT_TYPE
+from common.responses import decode_response
+from common.states import STATE_HEADER
 
 
 class Experiment:
-    def __init__(self, tasks: list[str], n_episodes, fps, prompts: list = [], experiment_name='experiment'):
+    def __init__(self, tasks: list[str], n_episodes, fps, prompts: list = [], experiment_name='experiment',
+                 frame_codec='raw', transport='http', server_url='http://localhost:8003', response_format='raw',
+                 stateless=False):
         print(f"INITIALIZING {experiment_name}")
         self.tasks = tasks
         self.prompts = []
@@ -22,6 +32,17 @@ class Experiment:
         self.n_episodes = n_episodes
         self.fps = fps
         self.experiment_name = experiment_name
+        # 'raw' / 'lz4' / 'zstd' / 'jpeg' send binary frames; None keeps the multipart JPEG upload
+        self.frame_codec = frame_codec
+        # 'http' posts /reset and /step, 'ws' streams the episode over one websocket
+        self.transport = transport
+        # 'raw' / 'msgpack' / 'flat' ask /step for the flat action vector only; 'json' for the full payload
+        self.response_format = response_format
+        self.server_url = server_url
+        # over http, carry the policy state in X-Policy-State instead of a server session, so any replica can step
+        self.stateless = stateless
+        self._state = None
+        self._ws = None
         self.metrics = {t: defaultdict(list) for t in tasks}
 
     def run(self):
@@ -43,36 +64,14 @@ class Experiment:
                 steps, path_len, collision_events = 0, 0.0, 0
 
                 # reset model
-                response = requests.post(
-                    "http://localhost:8003/reset",
-                    data={"task_description": prompt}
-                )
+                session_id = self._reset_model(prompt)
 
                 success = trunc = False
                 while not (success or trunc):
                     img = get_image_from_maniskill2_obs_dict(env, obs)
                     frames.append(img)
 
-                    success_cv2, img_encoded_jpeg = cv2.imencode('.jpg', img)
-                    if not success_cv2:
-                        raise RuntimeError("Failed to encode image")
-
-                    response = requests.post(
-                        "http://localhost:8003/step",
-                        files={
-                            # The key "image" should match the parameter name in your API
-                            "file": ("image.jpg", img_encoded_jpeg.tobytes(), "image/jpeg"),
-                        },
-                        data={
-                            "task_description": prompt,
-                        }
-                    )
-
-                    result = response.json()
-                    act = result["action"]
-                    vec = np.concatenate([act["world_vector"],
-                                          act["rot_axangle"],
-                                          act["gripper"]])
+                    vec = self._step_model(img, prompt, session_id)
                     obs, _, success, trunc, info = env.step(vec)
 
                     # -------- metric accumulation -------
@@ -96,6 +95,8 @@ class Experiment:
                         collision_events += 1
                     prev_contact_count = curr_contact_count
 
+                self._close_model()
+
                 # save video ----------------------------------------------------------
                 tag = "success" if success else "fail"
                 video_path = f"{self.experiment_name}/{task}/episode_{ep:02d}_{tag}.mp4"
@@ -128,6 +129,72 @@ class Experiment:
             print(f" Collisions     : {coll:6.2f} contacts (avg)")
         print("-" * 60)
 
+    def _reset_model(self, prompt):
+        """Start a new episode on the server and return its session id."""
+        if self.transport == "ws":
+            self._ws = ws_connect(self.server_url.replace("http", "ws", 1) + "/ws")
+            self._ws.send(json.dumps({"type": "reset", "task_description": prompt}))
+            return json.loads(self._ws.recv())["session_id"]
+
+        response = requests.post(
+            f"{self.server_url}/reset",
+            data={"task_description": prompt, "stateless": self.stateless}
+        )
+        self._state = response.json().get("state")
+        return response.json()["session_id"]
+
+    def _step_model(self, img, prompt, session_id):
+        """Run one step and return the 7-D action for env.step."""
+        if self.transport == "ws":
+            self._ws.send(encode_frame(img, self.frame_codec or "raw"))
+            return self._action_vector(json.loads(self._ws.recv()))
+
+        compact = self.response_format not in (None, "json")
+        params = {"format": self.response_format, "fields": "action"} if compact else None
+        state_headers = {STATE_HEADER: self._state} if self._state is not None else {}
+        if self.frame_codec is not None:
+            response = requests.post(
+                f"{self.server_url}/step",
+                params=params,
+                data=encode_frame(img, self.frame_codec, session_id, prompt),
+                headers={"Content-Type": FRAME_CONTENT_TYPE, **state_headers},
+            )
+        else:
+            success_cv2, img_encoded_jpeg = cv2.imencode('.jpg', img)
+            if not success_cv2:
+                raise RuntimeError("Failed to encode image")
+
+            response = requests.post(
+                f"{self.server_url}/step",
+                params=params,
+                files={
+                    # The key "image" should match the parameter name in your API
+                    "file": ("image.jpg", img_encoded_jpeg.tobytes(), "image/jpeg"),
+                },
+                data={
+                    "task_description": prompt,
+                    "session_id": session_id,
+                },
+                headers=state_headers,
+            )
+        if self._state is not None:
+            self._state = response.headers[STATE_HEADER]
+        if compact:
+            return decode_response(response.content, self.response_format, ["action"])["action"]
+        return self._action_vector(response.json())
+
+    @staticmethod
+    def _action_vector(result):
+        act = result["action"]
+        return np.concatenate([act["world_vector"],
+                               act["rot_axangle"],
+                               act["gripper"]])
+
+    def _close_model(self):
+        if self._ws is not None:
+            self._ws.close()
+            self._ws = None
+
     def _hand_links(self, scene):
         """Subset of robot links that a task can physically collide with."""
         rlinks = self._robot_links(scene)
@@ -0,0 +1,62 @@
+"""
+batching_benchmark.py
+
+Measures /step throughput of the staged InferenceWorker (and its
+BatchScheduler) against the CPU stub policy, with and without batching, for a
+number of concurrent sessions.
+
+    cd server
+    python -m benchmarks.batching_benchmark --sessions 16 --steps 20 --max-batch-size 8 --preprocess-ms 10
+"""
+import argparse
+import asyncio
+import time
+import numpy as np
+
+from common.stub import StubInference
+from common.worker import InferenceWorker
+
+
+async def run(sessions: int, steps: int, max_batch_size: int, max_wait_ms: float, forward_ms: float,
+              per_item_ms: float, preprocess_ms: float):
+    inference = StubInference(forward_ms=forward_ms, per_item_ms=per_item_ms, preprocess_ms=preprocess_ms)
+    worker = InferenceWorker(inference, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms)
+    states = [inference.new_state() for _ in range(sessions)]
+    latencies = []
+
+    async def client(idx: int):
+        image = np.full((224, 224, 3), idx, dtype=np.uint8)
+        for _ in range(steps):
+            start = time.perf_counter()
+            raw_action, _ = await worker.step(image, "pick coke can", states[idx])
+            latencies.append(time.perf_counter() - start)
+            assert np.isclose(raw_action["world_vector"][0], idx / 255.0)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client(i) for i in range(sessions)))
+    elapsed = time.perf_counter() - start
+    return sessions * steps / elapsed, np.percentile(latencies, 50) * 1000, inference.forward_calls
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sessions", type=int, default=16)
+    parser.add_argument("--steps", type=int, default=20)
+    parser.add_argument("--max-batch-size", type=int, default=8)
+    parser.add_argument("--max-wait-ms", type=float, default=5.0)
+    parser.add_argument("--forward-ms", type=float, default=40.0)
+    parser.add_argument("--per-item-ms", type=float, default=2.0)
+    parser.add_argument("--preprocess-ms", type=float, default=0.0)
+    args = parser.parse_args()
+
+    for batch_size in (1, args.max_batch_size):
+        throughput, p50, forwards = asyncio.run(run(
+            args.sessions, args.steps, batch_size, args.max_wait_ms, args.forward_ms, args.per_item_ms,
+            args.preprocess_ms,
+        ))
+        print(f"max_batch_size={batch_size:3d}: {throughput:7.1f} steps/s | p50 latency {p50:7.1f} ms | "
+              f"{forwards} forward calls")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""
+cogact_head_benchmark.py
+
+CogACT's diffusion action head sampled once per session (as predict_action
+does) against one batched denoising loop over all sessions
+(models/cogact/action_head.py), on a tiny randomly initialized DiT that runs on
+the CPU. With the same noise per session, checks that every session gets the
+chunk it gets on its own, with guidance scales mixed in the batch, and times
+both.
+
+Needs the CogACT package (action_model, prismatic) of the cogact image:
+
+    cd server
+    python -m benchmarks.cogact_head_benchmark --sessions 1 4 16 64 --ddim-steps 10
+"""
+from pathlib import Path
+import argparse
+import sys
+import time
+import torch
+
+from action_model.action_model import ActionModel
+from action_model.models import DiT
+
+sys.path.append(str(Path(__file__).resolve().parents[1] / "models" / "cogact"))
+from action_head import sample_chunks  # noqa: E402
+
+
+def tiny_action_model(token_size: int, chunk_len: int, ddim_steps: int) -> ActionModel:
+    torch.manual_seed(0)
+    action_model = ActionModel(token_size=token_size, model_type="DiT-S", in_channels=7,
+                               future_action_window_size=chunk_len - 1, past_action_window_size=0)
+    action_model.net = DiT(in_channels=7, hidden_size=64, depth=2, num_heads=4, class_dropout_prob=0.1,
+                           future_action_window_size=chunk_len - 1, past_action_window_size=0, token_size=token_size)
+    # DiT zero-initializes its output and modulation layers, which would make every chunk the same
+    for parameter in action_model.net.parameters():
+        torch.nn.init.normal_(parameter, std=0.1)
+    action_model.create_ddim(ddim_step=ddim_steps)
+    return action_model.eval()
+
+
+@torch.inference_mode()
+def sample_one(action_model: ActionModel, feature: torch.Tensor, noise: torch.Tensor, cfg_scale: float):
+    """One session, the way CogACTVLA.predict_action samples it."""
+    net = action_model.net
+    z = feature[None, None]
+    noise = noise[None]
+    if cfg_scale > 1.0:
+        noise = torch.cat([noise, noise], 0)
+        z = torch.cat([z, net.z_embedder.uncondition[None, None]], 0)
+        model_kwargs, sample_fn = dict(z=z, cfg_scale=cfg_scale), net.forward_with_cfg
+    else:
+        model_kwargs, sample_fn = dict(z=z), net.forward
+    samples = action_model.ddim_diffusion.ddim_sample_loop(
+        sample_fn, noise.shape, noise, clip_denoised=False, model_kwargs=model_kwargs, progress=False,
+        device=z.device, eta=0.0,
+    )
+    return samples[:1] if cfg_scale > 1.0 else samples
+
+
+def relative_error(actual: torch.Tensor, expected: torch.Tensor) -> float:
+    return ((actual - expected).abs().max() / expected.abs().max()).item()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sessions", type=int, nargs="+", default=[1, 4, 16, 64])
+    parser.add_argument("--ddim-steps", type=int, default=10)
+    parser.add_argument("--chunk-len", type=int, default=16)
+    parser.add_argument("--token-size", type=int, default=64)
+    parser.add_argument("--tolerance", type=float, default=1e-5, help="relative to the largest sample")
+    args = parser.parse_args()
+
+    action_model = tiny_action_model(args.token_size, args.chunk_len, args.ddim_steps)
+    failed = False
+    for sessions in args.sessions:
+        generator = torch.Generator().manual_seed(sessions)
+        features = torch.randn(sessions, args.token_size, generator=generator)
+        noise = torch.randn(sessions, args.chunk_len, 7, generator=generator)
+        # guidance scales differ between sessions, as with per-session sampling settings
+        cfg_scales = [1.5 + 0.5 * (i % 3) for i in range(sessions)]
+
+        start = time.perf_counter()
+        expected = torch.cat([sample_one(action_model, f, n, s) for f, n, s in zip(features, noise, cfg_scales)])
+        loop_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        actual = sample_chunks(action_model, features, noise, cfg_scales, use_ddim=True)
+        batch_seconds = time.perf_counter() - start
+        # without guidance
+        unguided = sample_chunks(action_model, features, noise, [1.0] * sessions, use_ddim=True)
+        expected_unguided = torch.cat([sample_one(action_model, f, n, 1.0) for f, n in zip(features, noise)])
+
+        # batched matmuls round differently, so the difference is relative to the size of the samples
+        max_error = max(relative_error(actual, expected), relative_error(unguided, expected_unguided))
+        failed |= not max_error <= args.tolerance
+        print(f"sessions={sessions:3d}: per session {loop_seconds * 1000:7.1f} ms | batched {batch_seconds * 1000:7.1f} ms"
+              f" | {loop_seconds / batch_seconds:5.1f}x | max relative diff {max_error:.1e}")
+    if failed:
+        raise SystemExit(f"batched chunks differ from per-session sampling by more than {args.tolerance}")
+
+
+
+if __name__ == "__main__":
+    main()
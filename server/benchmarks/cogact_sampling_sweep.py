@@ -0,0 +1,149 @@
+"""
+cogact_sampling_sweep.py
+
+Latency against action quality of CogACT's diffusion sampling. Replays
+recorded episodes (the videos Experiment saves, or any video / .npy frame
+stack) through the model for a grid of DDIM step counts and CFG scales, and
+reports per setting the action-head latency (the DiT sampling loop alone),
+the whole predict_action latency and the deviation of the predicted chunks
+from those of the reference setting (10 DDIM steps, cfg_scale 1.5) on the
+same frames. The diffusion noise is seeded per frame, so the deviation comes
+from the sampler settings only. cfg_scale 1 runs without classifier-free
+guidance.
+
+Needs the GPU and the CogACT weights, like the service:
+
+    cd server
+    python -m benchmarks.cogact_sampling_sweep --prompt "pick coke can" \\
+        --episodes experiment/google_robot_pick_coke_can/*.mp4 --steps 10 8 5 3 2 1 --cfg-scales 1.5 1.0
+"""
+from pathlib import Path
+import argparse
+import functools
+import json
+import sys
+import time
+import cv2 as cv
+import numpy as np
+import torch
+
+sys.path.append(str(Path(__file__).resolve().parents[1] / "models" / "cogact"))
+from cogact_inference import CogACTInference  # noqa: E402
+
+
+def load_frames(path: str, stride: int) -> list[np.ndarray]:
+    """RGB uint8 frames of a recorded episode: a video or an (N, H, W, 3) .npy array."""
+    if path.endswith(".npy"):
+        return list(np.load(path))[::stride]
+    capture = cv.VideoCapture(path)
+    frames = []
+    while True:
+        ok, frame = capture.read()
+        if not ok:
+            break
+        frames.append(cv.cvtColor(frame, cv.COLOR_BGR2RGB))
+    return frames[::stride]
+
+
+class HeadTimer:
+    """Times the DDIM sampling loops of the action model (the DiT action head)."""
+
+    def __init__(self) -> None:
+        self.seconds = 0.0
+        self._patched = set()
+
+    def patch(self, diffusion) -> None:
+        if id(diffusion) in self._patched:
+            return
+        self._patched.add(id(diffusion))
+        diffusion.ddim_sample_loop = self._timed(diffusion.ddim_sample_loop)
+
+    def _timed(self, loop):
+        @functools.wraps(loop)
+        def timed(*args, **kwargs):
+            torch.cuda.synchronize()
+            start = time.perf_counter()
+            result = loop(*args, **kwargs)
+            torch.cuda.synchronize()
+            self.seconds += time.perf_counter() - start
+            return result
+        return timed
+
+
+def replay(inference: CogACTInference, timer: HeadTimer, episodes, prompt: str, sampling: dict):
+    """Chunks predicted for every frame with ``sampling``, and the action-head / total seconds of each."""
+    state = inference.new_state()
+    inference.reset(prompt, state)
+    inference.configure_sampling(state, **sampling)
+    chunks, head_seconds, total_seconds = [], [], []
+    for episode in episodes:
+        for frame in episode:
+            inputs = inference._model_inputs(inference._resize_image(frame), state)
+            inference._select_ddim_sampler(sampling["num_ddim_steps"])
+            timer.patch(inference.vla.action_model.ddim_diffusion)
+            # the same noise for the frame under every setting
+            torch.manual_seed(len(chunks))
+            timer.seconds = 0.0
+            torch.cuda.synchronize()
+            start = time.perf_counter()
+            chunks.append(inference.forward_batch([inputs])[0])
+            torch.cuda.synchronize()
+            total_seconds.append(time.perf_counter() - start)
+            head_seconds.append(timer.seconds)
+    return np.stack(chunks), np.array(head_seconds), np.array(total_seconds)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--episodes", nargs="+", required=True, help="videos or .npy frame stacks")
+    parser.add_argument("--prompt", required=True)
+    parser.add_argument("--policy-setup", default="google_robot")
+    parser.add_argument("--steps", type=int, nargs="+", default=[10, 8, 5, 3, 2, 1])
+    parser.add_argument("--cfg-scales", type=float, nargs="+", default=[1.5, 1.0])
+    parser.add_argument("--reference-steps", type=int, default=10)
+    parser.add_argument("--reference-cfg-scale", type=float, default=1.5)
+    parser.add_argument("--stride", type=int, default=1, help="replay every stride-th frame")
+    parser.add_argument("--output", default=None, help="write the results as JSON")
+    args = parser.parse_args()
+
+    inference = CogACTInference(policy_setup=args.policy_setup, action_ensemble=False)
+    timer = HeadTimer()
+    episodes = [load_frames(path, args.stride) for path in args.episodes]
+    print(f"{sum(map(len, episodes))} frames from {len(episodes)} episodes")
+
+    def run(steps, cfg_scale):
+        return replay(inference, timer, episodes, args.prompt,
+                      {"num_ddim_steps": steps, "cfg_scale": cfg_scale, "use_ddim": True})
+
+    # warm-up, then the reference
+    run(args.reference_steps, args.reference_cfg_scale)
+    reference, _, _ = run(args.reference_steps, args.reference_cfg_scale)
+    results = []
+    for cfg_scale in args.cfg_scales:
+        for steps in args.steps:
+            chunks, head_seconds, total_seconds = run(steps, cfg_scale)
+            deviation = np.abs(chunks - reference)
+            result = {
+                "num_ddim_steps": steps,
+                "cfg_scale": cfg_scale,
+                "head_ms": float(np.median(head_seconds) * 1000),
+                "predict_action_ms": float(np.median(total_seconds) * 1000),
+                # first action of the chunk (the one executed without open-loop execution) and whole chunk
+                "first_action_mean_abs": float(deviation[:, 0].mean()),
+                "first_action_max_abs": float(deviation[:, 0].max()),
+                "chunk_mean_abs": float(deviation.mean()),
+                "gripper_flips": int(np.sum((chunks[:, 0, 6] > 0.5) != (reference[:, 0, 6] > 0.5))),
+            }
+            results.append(result)
+            print(f"steps={steps:2d} cfg={cfg_scale:.2f}: head {result['head_ms']:6.1f} ms | "
+                  f"predict_action {result['predict_action_ms']:6.1f} ms | first action dev "
+                  f"{result['first_action_mean_abs']:.4f} (max {result['first_action_max_abs']:.4f}) | "
+                  f"chunk dev {result['chunk_mean_abs']:.4f} | gripper flips {result['gripper_flips']}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"reference": {"num_ddim_steps": args.reference_steps, "cfg_scale": args.reference_cfg_scale},
+                       "frames": len(reference), "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
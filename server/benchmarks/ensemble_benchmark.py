@@ -0,0 +1,90 @@
+"""
+ensemble_benchmark.py
+
+Per-step cost of action-chunk ensembling: the ring-buffer pools of
+common/ensemble.py, batched across sessions with ``ensemble_batch``, against
+one deque-based ensembler per session (the implementation they replaced), for
+a range of ensemble horizons and session counts. Also checks that both give
+the same actions.
+
+    cd server
+    python -m benchmarks.ensemble_benchmark --horizons 2 4 8 16 --sessions 1 4 16 64 256
+"""
+from collections import deque
+import argparse
+import time
+import numpy as np
+
+from common.ensemble import AdaptiveEnsemblePool, Ensembler, TemporalEnsemblePool, ensemble_batch
+
+
+class DequeEnsembler:
+    """The per-session ensembler the pools replaced (temporal or adaptive weights)."""
+
+    def __init__(self, horizon: int, kind: str, param: float) -> None:
+        self.history = deque(maxlen=horizon)
+        self.kind = kind
+        self.param = param
+
+    def ensemble_action(self, cur_action: np.ndarray) -> np.ndarray:
+        self.history.append(cur_action)
+        num_actions = len(self.history)
+        preds = np.stack(
+            [pred[i] for (i, pred) in zip(range(num_actions - 1, -1, -1), self.history) if i < len(pred)]
+        )
+        if self.kind == "temporal":
+            weights = np.exp(-self.param * np.arange(len(preds)))
+        else:
+            ref = preds[-1]
+            cos_similarity = np.sum(preds * ref, axis=1) / (
+                np.linalg.norm(preds, axis=1) * np.linalg.norm(ref) + 1e-7
+            )
+            weights = np.exp(self.param * cos_similarity)
+        weights = weights / weights.sum()
+        return np.sum(weights[:, None] * preds, axis=0)
+
+
+def run(kind: str, param: float, horizon: int, sessions: int, steps: int, chunk_len: int):
+    rng = np.random.default_rng(0)
+    chunks = rng.normal(size=(steps, sessions, chunk_len, 7)).astype(np.float32)
+
+    # the first step (the pool allocates its buffer) is not timed
+    baseline = [DequeEnsembler(horizon, kind, param) for _ in range(sessions)]
+    expected = [[ensembler.ensemble_action(chunk) for ensembler, chunk in zip(baseline, chunks[0])]]
+    start = time.perf_counter()
+    expected += [[ensembler.ensemble_action(chunk) for ensembler, chunk in zip(baseline, step)] for step in chunks[1:]]
+    deque_seconds = time.perf_counter() - start
+
+    pool_type = TemporalEnsemblePool if kind == "temporal" else AdaptiveEnsemblePool
+    pool = pool_type(horizon, param, capacity=sessions)
+    ensemblers = [Ensembler(pool) for _ in range(sessions)]
+    actual = [ensemble_batch(ensemblers, list(chunks[0]))]
+    start = time.perf_counter()
+    actual += [ensemble_batch(ensemblers, list(step)) for step in chunks[1:]]
+    pool_seconds = time.perf_counter() - start
+
+    max_error = np.abs(np.array(expected) - np.array(actual)).max()
+    per_step = 1e6 / ((steps - 1) * sessions)
+    return deque_seconds * per_step, pool_seconds * per_step, max_error
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--horizons", type=int, nargs="+", default=[2, 4, 8, 16])
+    parser.add_argument("--sessions", type=int, nargs="+", default=[1, 4, 16, 64, 256])
+    parser.add_argument("--steps", type=int, default=50)
+    parser.add_argument("--chunk-len", type=int, default=16)
+    parser.add_argument("--temp", type=float, default=-0.8)
+    parser.add_argument("--alpha", type=float, default=0.1)
+    args = parser.parse_args()
+
+    for kind, param in (("temporal", args.temp), ("adaptive", args.alpha)):
+        for horizon in args.horizons:
+            for sessions in args.sessions:
+                deque_us, pool_us, max_error = run(kind, param, horizon, sessions, args.steps, args.chunk_len)
+                print(f"{kind:8s} horizon={horizon:2d} sessions={sessions:3d}: deque {deque_us:6.1f} us/step | "
+                      f"pool {pool_us:6.1f} us/step | {deque_us / pool_us:5.1f}x | max diff {max_error:.1e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1 @@
+"""Code shared by every model service (mounted at /app/common in each container)."""
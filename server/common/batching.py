@@ -0,0 +1,78 @@
+"""
+batching.py
+
+Dynamic batching of /step requests. Concurrent requests are queued and the
+collector hands up to ``max_batch_size`` of them to ``batch_fn`` at once,
+waiting at most ``max_wait_ms`` after the first one arrived. ``batch_fn`` runs
+on a single dedicated thread so the event loop keeps accepting requests while
+the GPU works.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, List, Optional
+import asyncio
+import time
+
+
+class BatchScheduler:
+    def __init__(
+        self,
+        batch_fn: Callable[[List[Any]], List[Any]],
+        max_batch_size: int = 8,
+        max_wait_ms: float = 5.0,
+    ) -> None:
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._collector: Optional[asyncio.Task] = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="batch")
+
+    def qsize(self) -> int:
+        """Number of requests waiting for a batch slot."""
+        return 0 if self._queue is None else self._queue.qsize()
+
+    def close(self) -> None:
+        if self._collector is not None and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._collector.cancel)
+        self._executor.shutdown(wait=False)
+
+    async def submit(self, item: Any) -> Any:
+        """Queue one item and wait for its entry of the batch result."""
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # (re)start the collector on the loop that serves requests
+            self._loop = loop
+            self._queue = asyncio.Queue()
+            self._collector = loop.create_task(self._collect())
+        future = loop.create_future()
+        await self._queue.put((item, future))
+        return await future
+
+    async def _collect(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            pending = [await self._queue.get()]
+            while len(pending) < self.max_batch_size and not self._queue.empty():
+                pending.append(self._queue.get_nowait())
+            deadline = time.monotonic() + self.max_wait_ms / 1000.0
+            while len(pending) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    pending.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            items = [item for item, _ in pending]
+            try:
+                results = await loop.run_in_executor(self._executor, self.batch_fn, items)
+            except Exception as exc:
+                for _, future in pending:
+                    if not future.done():
+                        future.set_exception(exc)
+                continue
+            for (_, future), result in zip(pending, results):
+                if not future.done():
+                    future.set_result(result)
@@ -0,0 +1,79 @@
+"""
+duplicates.py
+
+Near-duplicate frames. While the robot barely moves (waiting out a sticky
+gripper, settling after a grasp) consecutive frames are almost identical, and
+so is what the model predicts from them. With a ``duplicate_frame_threshold``
+on the inference object, a session keeps the outputs of its last forward pass
+and the signature of the frame they were predicted from: a 32x32 grayscale
+thumbnail. A frame whose thumbnail differs from that one by at most the
+threshold (mean absolute difference, 0-1) is answered with those outputs
+again, as a ``Reuse``, instead of a forward pass; post-processing still runs
+on them. Frames are compared with the frame of the last forward rather than
+the previous frame, so slow motion cannot creep past the threshold.
+
+Reused steps are counted in ``vla_duplicate_frames_skipped_total``. The next
+forward of the session measures how far the actions drifted over the skipped
+frames, as the largest absolute difference between its raw action and the
+reused one, in ``vla_duplicate_drift``.
+"""
+from dataclasses import dataclass
+from typing import Any, Callable, Optional, Sequence
+import cv2 as cv
+import numpy as np
+
+from common.metrics import metrics
+
+
+@dataclass
+class Reuse:
+    """Outputs of the session's last forward pass, served again for a near-duplicate frame."""
+    outputs: Any
+
+
+def frame_signature(image: np.ndarray) -> np.ndarray:
+    """32x32 grayscale thumbnail of an RGB uint8 frame, in 0-1."""
+    gray = cv.cvtColor(image, cv.COLOR_RGB2GRAY)
+    return cv.resize(gray, (32, 32), interpolation=cv.INTER_AREA).astype(np.float32) / 255.0
+
+
+def frame_change(signature: np.ndarray, reference: np.ndarray) -> float:
+    """Mean absolute difference of two frame signatures."""
+    return float(np.abs(signature - reference).mean())
+
+
+def reuse_outputs(image: np.ndarray, state: Any, threshold: Optional[float]) -> Optional[Reuse]:
+    """
+    A Reuse of the session's last outputs if ``image`` is within ``threshold`` of the frame they were
+    predicted from; otherwise None, and ``image`` becomes the reference of the forward that follows.
+    """
+    if threshold is None:
+        return None
+    signature = frame_signature(image)
+    if state.duplicate_outputs is not None and frame_change(signature, state.duplicate_reference) <= threshold:
+        state.duplicate_steps += 1
+        metrics.inc("duplicate_frames_skipped")
+        return Reuse(state.duplicate_outputs)
+    state.duplicate_reference = signature
+    return None
+
+
+def remember_outputs(outputs: Any, state: Any, raw_action: Callable[[Any], np.ndarray]) -> None:
+    """
+    Post-processing side: keep the outputs of a forward pass for the next near-duplicate frames, and
+    report the drift from the reused ones. ``raw_action`` takes the (7,) action out of the outputs.
+    """
+    if outputs is None or outputs is state.duplicate_outputs:
+        return
+    if state.duplicate_steps > 0:
+        drift = np.abs(raw_action(outputs) - raw_action(state.duplicate_outputs)).max()
+        metrics.observe("duplicate_drift", float(drift))
+        state.duplicate_steps = 0
+    state.duplicate_outputs = outputs
+
+
+def forward_or_reuse(forward_batch: Callable[[list], list], inputs: Sequence) -> list:
+    """forward_batch over the inputs that are not a Reuse, with the reused outputs in place of the others."""
+    forward = [x for x in inputs if not isinstance(x, Reuse)]
+    outputs = iter(forward_batch(forward) if forward else [])
+    return [x.outputs if isinstance(x, Reuse) else next(outputs) for x in inputs]
@@ -0,0 +1,248 @@
+"""
+ensemble.py
+
+Action-chunk ensembling over preallocated ring buffers. An ``EnsemblePool``
+keeps the last ``horizon`` predicted chunks of many sessions in one
+(sessions, horizon, chunk, dim) array; every session holds an ``Ensembler``
+handle to its slot. At each step the new chunk of a session is written over
+its oldest one, and the action for the current timestep is the weighted
+average of the row of every stored chunk that reaches it (row ``age`` of the
+chunk predicted ``age`` steps ago), oldest first. ``ensemble_batch`` does this
+for many sessions in a few NumPy calls.
+
+    TemporalEnsemblePool  weights exp(-temp * i) over the i-th oldest prediction
+                          (SpatialVLA), from a table per history length
+    AdaptiveEnsemblePool  weights exp(alpha * cos(prediction, newest prediction))
+                          (CogACT)
+
+1-D inputs (single actions instead of chunks) are averaged as they are,
+without the time alignment, like the deque-based ensemblers did. Chunks are
+kept in their own dtype and the results match those ensemblers bit for bit up
+to a horizon of 7; from 8 on NumPy's pairwise summation of the zero-weighted
+missing entries can change the last bit.
+"""
+from typing import Optional, Sequence
+import abc
+import threading
+import weakref
+import numpy as np
+
+
+class EnsemblePool(abc.ABC):
+    def __init__(self, horizon: int, capacity: int = 8) -> None:
+        self.horizon = horizon
+        # entry i of the history is the chunk added horizon - 1 - i steps ago, so the newest is the last
+        self._ages = np.arange(horizon - 1, -1, -1)
+        # _positions[p]: ring positions of the history when the next chunk goes to position p
+        self._positions = (np.arange(horizon)[:, None] - 1 - self._ages) % horizon
+        # allocated on the first chunk, once its length and action dim are known
+        self._actions: Optional[np.ndarray] = None  # (capacity, horizon, chunk, dim)
+        self._lengths = np.zeros((capacity, horizon), dtype=np.int64)  # rows of each stored chunk
+        self._counts = np.zeros(capacity, dtype=np.int64)  # chunks added since the last reset
+        self._free = list(range(capacity - 1, -1, -1))
+        # slots are acquired and released by request threads while the post-processing thread ensembles
+        self._lock = threading.Lock()
+
+    def acquire(self) -> int:
+        with self._lock:
+            if not self._free:
+                self._grow_slots(2 * len(self._counts))
+            slot = self._free.pop()
+            self._clear(slot)
+            return slot
+
+    def release(self, slot: int) -> None:
+        with self._lock:
+            self._free.append(slot)
+
+    def reset(self, slot: int) -> None:
+        with self._lock:
+            self._clear(slot)
+
+    def history(self, slot: int) -> list[np.ndarray]:
+        """
+        The stored chunks of a slot that later steps still read, oldest first, each cut to those
+        rows: the chunk added ``age`` steps ago keeps its rows ``age + 1`` to ``horizon - 1``.
+        Only time-aligned chunks (2-D) are supported.
+        """
+        with self._lock:
+            count = int(self._counts[slot])
+            chunks = []
+            for age in range(min(count, self.horizon - 1) - 1, -1, -1):
+                position = (count - 1 - age) % self.horizon
+                end = min(int(self._lengths[slot, position]), self.horizon)
+                chunks.append(self._actions[slot, position, age + 1 : end].copy())
+            return chunks
+
+    def load(self, slot: int, chunks: Sequence[np.ndarray]) -> None:
+        """Restore a slot from the ``history`` of another, e.g. of another process."""
+        with self._lock:
+            self._clear(slot)
+            if not chunks:
+                return
+            chunks = list(chunks)[-(self.horizon - 1):]
+            count = len(chunks)
+            chunk_len = max(count - i + len(chunk) for i, chunk in enumerate(chunks))
+            dtype = np.result_type(*chunks)
+            if self._actions is not None:
+                chunk_len, dtype = max(chunk_len, self._actions.shape[2]), np.result_type(dtype, self._actions)
+            if self._actions is None or (chunk_len, dtype) != (self._actions.shape[2], self._actions.dtype):
+                self._grow_chunks(chunk_len, chunks[0].shape[-1], dtype)
+            for i, chunk in enumerate(chunks):
+                # the chunk of the i-th oldest entry was added count - 1 - i steps ago
+                age = count - 1 - i
+                position = i % self.horizon
+                self._actions[slot, position, : age + 1] = 0
+                self._actions[slot, position, age + 1 : age + 1 + len(chunk)] = chunk
+                self._lengths[slot, position] = age + 1 + len(chunk)
+            self._counts[slot] = count
+
+    def ensemble(self, slots: Sequence[int], chunks: Sequence[np.ndarray]) -> np.ndarray:
+        """Add one chunk per slot (slots unique) and return the ensembled actions, (len(slots), dim)."""
+        slots = np.asarray(slots, dtype=np.int64)
+        aligned = chunks[0].ndim > 1
+        chunks = [chunk if aligned else chunk[None] for chunk in chunks]
+        with self._lock:
+            positions = self._push(slots, chunks)
+            rows, valid = self._history(slots, positions, aligned)
+        weights = self._weights(rows, valid)
+        # the zero weights of missing entries leave the sums unchanged
+        return np.sum(weights[:, :, None] * rows, axis=1)
+
+    @abc.abstractmethod
+    def _weights(self, rows: np.ndarray, valid: np.ndarray) -> np.ndarray:
+        """
+        Normalized (sessions, horizon) weights of the oldest-first predictions ``rows``,
+        0 where not ``valid``. The newest prediction is always the last one.
+        """
+
+    def _clear(self, slot: int) -> None:
+        self._lengths[slot] = 0
+        self._counts[slot] = 0
+
+    def _grow_slots(self, capacity: int) -> None:
+        extra = capacity - len(self._counts)
+        if self._actions is not None:
+            self._actions = np.concatenate(
+                [self._actions, np.zeros((extra,) + self._actions.shape[1:], dtype=self._actions.dtype)]
+            )
+        self._lengths = np.concatenate([self._lengths, np.zeros((extra, self.horizon), dtype=np.int64)])
+        self._counts = np.concatenate([self._counts, np.zeros(extra, dtype=np.int64)])
+        self._free = list(range(capacity - 1, capacity - 1 - extra, -1)) + self._free
+
+    def _grow_chunks(self, chunk_len: int, dim: int, dtype: np.dtype) -> None:
+        # chunks are kept in the dtype the model predicts them in, which the weighting is computed in;
+        # rows up to the horizon are read (and masked out) even while every chunk is shorter
+        chunk_len = max(chunk_len, self.horizon)
+        actions = np.zeros((len(self._counts), self.horizon, chunk_len, dim), dtype=dtype)
+        if self._actions is not None:
+            actions[:, :, : self._actions.shape[2]] = self._actions
+        self._actions = actions
+
+    def _push(self, slots: np.ndarray, chunks: Sequence[np.ndarray]) -> np.ndarray:
+        """Write the chunks over the oldest of their slots; returns the positions written."""
+        lengths = [len(chunk) for chunk in chunks]
+        chunk_len, dtype = max(lengths), np.result_type(*chunks)
+        if self._actions is not None:
+            chunk_len, dtype = max(chunk_len, self._actions.shape[2]), np.result_type(dtype, self._actions)
+        if self._actions is None or (chunk_len, dtype) != (self._actions.shape[2], self._actions.dtype):
+            self._grow_chunks(chunk_len, chunks[0].shape[-1], dtype)
+        positions = self._counts[slots] % self.horizon
+        if len(chunks) > 1 and min(lengths) == max(lengths):
+            self._actions[slots, positions, : lengths[0]] = np.stack(chunks)
+        else:
+            for slot, position, chunk in zip(slots, positions, chunks):
+                self._actions[slot, position, : len(chunk)] = chunk
+        self._lengths[slots, positions] = lengths
+        self._counts[slots] += 1
+        return positions
+
+    def _history(
+        self, slots: np.ndarray, positions: np.ndarray, aligned: bool
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Oldest-first rows for the current timestep, (sessions, horizon, dim), and which exist."""
+        history = self._positions[(positions + 1) % self.horizon]
+        valid = self._ages < self._counts[slots][:, None]
+        if aligned:
+            valid &= self._ages < self._lengths[slots[:, None], history]
+        rows = self._actions[slots[:, None], history, self._ages if aligned else 0]
+        return rows, valid
+
+
+class TemporalEnsemblePool(EnsemblePool):
+    def __init__(self, horizon: int, temp: float = 0.0, capacity: int = 8) -> None:
+        super().__init__(horizon, capacity)
+        self.temp = temp
+        # _table[n, i]: weight of the i-th oldest of n predictions
+        self._table = np.zeros((horizon + 1, horizon))
+        for n in range(1, horizon + 1):
+            weights = np.exp(-temp * np.arange(n))
+            self._table[n, :n] = weights / weights.sum()
+
+    def _weights(self, rows: np.ndarray, valid: np.ndarray) -> np.ndarray:
+        rank = np.cumsum(valid, axis=1) - 1
+        return np.where(valid, self._table[valid.sum(axis=1)[:, None], rank], 0.0)
+
+
+class AdaptiveEnsemblePool(EnsemblePool):
+    def __init__(self, horizon: int, alpha: float = 0.0, capacity: int = 8) -> None:
+        super().__init__(horizon, capacity)
+        self.alpha = alpha
+
+    def _weights(self, rows: np.ndarray, valid: np.ndarray) -> np.ndarray:
+        ref = rows[:, -1]
+        dot_product = np.sum(rows * ref[:, None], axis=2)
+        norm_rows = np.linalg.norm(rows, axis=2)
+        # a dot product per session, like the np.linalg.norm of a single vector
+        norm_ref = np.sqrt(ref[:, None, :] @ ref[:, :, None])[:, 0]
+        cos_similarity = dot_product / (norm_rows * norm_ref + 1e-7)
+        weights = np.where(valid, np.exp(self.alpha * cos_similarity), 0.0)
+        return weights / weights.sum(axis=1, keepdims=True)
+
+
+class Ensembler:
+    """A session's slot in an ``EnsemblePool``, released when the session is dropped."""
+
+    def __init__(self, pool: EnsemblePool) -> None:
+        self.pool = pool
+        self.slot = pool.acquire()
+        weakref.finalize(self, pool.release, self.slot)
+
+    def reset(self) -> None:
+        self.pool.reset(self.slot)
+
+    def history(self) -> list[np.ndarray]:
+        return self.pool.history(self.slot)
+
+    def load(self, chunks: Sequence[np.ndarray]) -> None:
+        self.pool.load(self.slot, chunks)
+
+    def ensemble_action(self, cur_action: np.ndarray) -> np.ndarray:
+        return self.pool.ensemble([self.slot], [cur_action])[0]
+
+
+def ensemble_batch(ensemblers: Sequence[Ensembler], chunks: Sequence[np.ndarray]) -> list[np.ndarray]:
+    """
+    ``ensemble_action`` for many sessions: one vectorized call per pool. An ensembler may
+    appear more than once (consecutive steps of one session); its chunks are then added in order.
+    """
+    results: list = [None] * len(ensemblers)
+    pending = list(range(len(ensemblers)))
+    while pending:
+        # per pool, the first occurrence of every slot; repeats wait for the next round
+        groups: dict = {}
+        later = []
+        for i in pending:
+            group = groups.setdefault(id(ensemblers[i].pool), {})
+            if ensemblers[i].slot in group:
+                later.append(i)
+            else:
+                group[ensemblers[i].slot] = i
+        for group in groups.values():
+            items = list(group.values())
+            pool = ensemblers[items[0]].pool
+            actions = pool.ensemble([ensemblers[i].slot for i in items], [chunks[i] for i in items])
+            for i, action in zip(items, actions):
+                results[i] = action
+        pending = later
+    return results
@@ -0,0 +1,144 @@
+"""
+frames.py
+
+Binary frame protocol for /step (Content-Type: application/octet-stream).
+
+A message is a fixed header followed by the variable-length fields and the
+encoded pixels, all little-endian:
+
+    magic      4s   b"VLAF"
+    version    u8   FRAME_VERSION
+    codec      u8   index into CODECS
+    dtype      u8   index into DTYPES
+    ndim       u8
+    shape      ndim x u32
+    session    u16 length + utf-8 bytes (empty = no session)
+    prompt     u16 length + utf-8 bytes (empty = keep the session's task)
+    payload    rest of the message
+
+Codecs: "raw" (plain bytes), "lz4" and "zstd" (lossless, optional
+dependencies) and "jpeg". Decoding goes straight to a numpy array, without a
+PIL round trip. Frames are (H, W, 3) uint8 RGB, what every model's preprocess
+takes; the dtype byte leaves room for other pixel formats.
+"""
+from dataclasses import dataclass
+from typing import Optional
+import struct
+import numpy as np
+import cv2 as cv
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:  # optional codec
+    lz4_frame = None
+try:
+    import zstandard
+except ImportError:  # optional codec
+    zstandard = None
+
+FRAME_MAGIC = b"VLAF"
+FRAME_VERSION = 1
+FRAME_CONTENT_TYPE = "application/octet-stream"
+CODECS = ("raw", "lz4", "zstd", "jpeg")
+DTYPES = (np.dtype(np.uint8),)
+
+_HEADER = struct.Struct("<4sBBBB")
+_LENGTH = struct.Struct("<H")
+
+
+@dataclass
+class Frame:
+    image: np.ndarray
+    session_id: Optional[str] = None
+    task_description: Optional[str] = None
+
+
+def encode_frame(
+    image: np.ndarray,
+    codec: str = "raw",
+    session_id: Optional[str] = None,
+    task_description: Optional[str] = None,
+    jpeg_quality: int = 95,
+) -> bytes:
+    image = np.ascontiguousarray(image)
+    if codec not in CODECS:
+        raise ValueError(f"Unknown codec {codec!r}, expected one of {CODECS}")
+    _check_frame(image.dtype, image.shape)
+
+    if codec == "raw":
+        payload = image.tobytes()
+    elif codec == "lz4":
+        payload = _require(lz4_frame, "lz4").compress(image.tobytes())
+    elif codec == "zstd":
+        payload = _require(zstandard, "zstandard").ZstdCompressor(level=1).compress(image.tobytes())
+    else:
+        ok, encoded = cv.imencode(".jpg", image, [cv.IMWRITE_JPEG_QUALITY, jpeg_quality])
+        if not ok:
+            raise ValueError("Failed to encode image")
+        payload = encoded.tobytes()
+
+    parts = [
+        _HEADER.pack(FRAME_MAGIC, FRAME_VERSION, CODECS.index(codec), DTYPES.index(image.dtype), image.ndim),
+        struct.pack(f"<{image.ndim}I", *image.shape),
+    ]
+    for text in (session_id, task_description):
+        data = (text or "").encode("utf-8")
+        parts += [_LENGTH.pack(len(data)), data]
+    parts.append(payload)
+    return b"".join(parts)
+
+
+def decode_frame(message: bytes) -> Frame:
+    """Parse a frame message; raises ValueError on malformed input."""
+    view = memoryview(message)
+    try:
+        magic, version, codec_idx, dtype_idx, ndim = _HEADER.unpack_from(view, 0)
+        offset = _HEADER.size
+        shape = struct.unpack_from(f"<{ndim}I", view, offset)
+        offset += 4 * ndim
+        texts = []
+        for _ in range(2):
+            (length,) = _LENGTH.unpack_from(view, offset)
+            offset += _LENGTH.size
+            texts.append(bytes(view[offset:offset + length]).decode("utf-8") or None)
+            offset += length
+    except (struct.error, UnicodeDecodeError) as exc:
+        raise ValueError(f"Malformed frame header: {exc}")
+    if magic != FRAME_MAGIC or version != FRAME_VERSION:
+        raise ValueError("Not a frame message or unsupported frame version")
+    if codec_idx >= len(CODECS) or dtype_idx >= len(DTYPES):
+        raise ValueError("Unknown codec or dtype in frame header")
+
+    codec, dtype = CODECS[codec_idx], DTYPES[dtype_idx]
+    _check_frame(dtype, shape)
+    payload = view[offset:]
+    if codec == "raw":
+        buffer = payload
+    elif codec == "lz4":
+        buffer = _require(lz4_frame, "lz4").decompress(payload)
+    elif codec == "zstd":
+        buffer = _require(zstandard, "zstandard").ZstdDecompressor().decompress(payload)
+    else:
+        image = cv.imdecode(np.frombuffer(payload, dtype=np.uint8), cv.IMREAD_UNCHANGED)
+        if image is None or image.shape != tuple(shape):
+            raise ValueError("Invalid jpeg payload")
+        return Frame(image, *texts)
+
+    if len(buffer) != int(np.prod(shape)) * dtype.itemsize:
+        raise ValueError(f"Payload size does not match shape {tuple(shape)} and dtype {dtype}")
+    image = np.frombuffer(buffer, dtype=dtype).reshape(shape)
+    return Frame(image, *texts)
+
+
+def _check_frame(dtype: np.dtype, shape: tuple) -> None:
+    """Raise ValueError unless the frame is (H, W, 3) uint8."""
+    if dtype not in DTYPES:
+        raise ValueError(f"Unsupported dtype {dtype}, expected uint8")
+    if len(shape) != 3 or shape[2] != 3:
+        raise ValueError(f"Unsupported shape {tuple(shape)}, expected (H, W, 3)")
+
+
+def _require(module, name: str):
+    if module is None:
+        raise ValueError(f"Codec requires the optional '{name}' package")
+    return module
@@ -0,0 +1,139 @@
+"""
+metrics.py
+
+In-process latency instrumentation for the model services.
+
+``metrics.span(stage)`` times a block of code. Every span feeds a sliding
+window summary (p50/p95/p99, sum, count) exported in Prometheus text format
+by ``metrics.render()``, and is also added to the trace of the request being
+served (``start_trace``) so /step can return it in a Server-Timing header.
+"""
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Optional
+import threading
+import time
+import numpy as np
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+_trace: ContextVar[Optional[dict]] = ContextVar("vla_trace", default=None)
+
+
+class Metrics:
+    def __init__(self, prefix: str = "vla", window: int = 2048) -> None:
+        self.prefix = prefix
+        self.window = window
+        self._lock = threading.Lock()
+        self._samples: dict = defaultdict(lambda: deque(maxlen=self.window))
+        self._sums: dict = defaultdict(float)
+        self._counts: dict = defaultdict(int)
+        self._counters: dict = defaultdict(float)
+        self._gauges: dict = {}
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._samples[key].append(value)
+            self._sums[key] += value
+            self._counts[key] += 1
+
+    def inc(self, name: str, value: float = 1.0, **labels: str) -> None:
+        with self._lock:
+            self._counters[(name, _label_key(labels))] += value
+
+    def gauge(self, name: str, fn: Callable[[], Any]) -> None:
+        """
+        Register a gauge evaluated at render time. ``fn`` returns a number, or a
+        dict mapping label dicts (as tuples of (key, value) pairs) to numbers.
+        """
+        self._gauges[name] = fn
+
+    @contextmanager
+    def span(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    def record(self, stage: str, seconds: float, trace: Optional[dict] = None) -> None:
+        """Add an already measured stage duration to the summaries and the request trace."""
+        self.observe("stage_seconds", seconds, stage=stage)
+        trace = _trace.get() if trace is None else trace
+        if trace is not None:
+            trace[stage] = trace.get(stage, 0.0) + seconds
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            summaries = {key: np.array(samples) for key, samples in self._samples.items()}
+            sums, counts, counters = dict(self._sums), dict(self._counts), dict(self._counters)
+
+        for name in sorted({name for name, _ in summaries}):
+            full_name = f"{self.prefix}_{name}"
+            lines.append(f"# TYPE {full_name} summary")
+            for (key_name, labels), samples in sorted(summaries.items()):
+                if key_name != name:
+                    continue
+                for q, value in zip(QUANTILES, np.quantile(samples, QUANTILES)):
+                    lines.append(f"{full_name}{_format_labels(labels + (('quantile', str(q)),))} {value:.6g}")
+                lines.append(f"{full_name}_sum{_format_labels(labels)} {sums[(key_name, labels)]:.6g}")
+                lines.append(f"{full_name}_count{_format_labels(labels)} {counts[(key_name, labels)]}")
+
+        for name in sorted({name for name, _ in counters}):
+            full_name = f"{self.prefix}_{name}_total"
+            lines.append(f"# TYPE {full_name} counter")
+            for (key_name, labels), value in sorted(counters.items()):
+                if key_name == name:
+                    lines.append(f"{full_name}{_format_labels(labels)} {value:.6g}")
+
+        for name, fn in sorted(self._gauges.items()):
+            full_name = f"{self.prefix}_{name}"
+            lines.append(f"# TYPE {full_name} gauge")
+            value = fn()
+            if isinstance(value, dict):
+                for labels, v in sorted(value.items()):
+                    lines.append(f"{full_name}{_format_labels(tuple(labels))} {v:.6g}")
+            else:
+                lines.append(f"{full_name} {value:.6g}")
+        return "\n".join(lines) + "\n"
+
+
+def start_trace() -> dict:
+    """Start collecting span durations for the request served by the current task."""
+    trace = {}
+    _trace.set(trace)
+    return trace
+
+
+def current_trace() -> Optional[dict]:
+    return _trace.get()
+
+
+def run_traced(trace: Optional[dict], fn: Callable, *args) -> Any:
+    """Call fn with ``trace`` as the current request trace (for executor threads)."""
+    token = _trace.set(trace)
+    try:
+        return fn(*args)
+    finally:
+        _trace.reset(token)
+
+
+def server_timing(trace: dict) -> str:
+    return ", ".join(f"{stage};dur={seconds * 1000:.2f}" for stage, seconds in trace.items())
+
+
+def _label_key(labels: dict) -> tuple:
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+
+# process-wide registry shared by the inference classes and the service
+metrics = Metrics()
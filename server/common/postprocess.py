@@ -0,0 +1,150 @@
+"""
+postprocess.py
+
+Raw policy output to maniskill2 action, shared by the ``*Inference`` classes
+and vectorized over a batch: ``postprocess_actions`` takes an (N, 7) array of
+raw actions (world_vector, rotation_delta as roll/pitch/yaw, open_gripper in
+[0, 1]) and the N session states, and does the euler to axis-angle
+conversion, action scaling and the sticky-gripper update in a few NumPy calls.
+
+The sticky gripper (google_robot) turns the absolute gripper command into a
+relative one and repeats a large change for ``sticky_gripper_num_repeat``
+steps. ``hold_previous_gripper`` picks between the two variants the models
+were evaluated with: SIMPLER's original, which compares every step with the
+step before (OpenVLA, ECoT), and the CogACT / SpatialVLA fix, which keeps the
+reference gripper action until a sticky action is triggered.
+"""
+from typing import Any, Sequence
+import numpy as np
+
+# below this norm of the quaternion's vector part the rotation is the identity (transforms3d)
+_IDENTITY_THRESH = np.finfo(np.float64).eps * 3
+
+
+def euler2axangle(rpy: np.ndarray) -> np.ndarray:
+    """
+    Rotation vectors (axis * angle, (N, 3)) of static xyz euler angles (N, 3); the
+    vectorized ``transforms3d.euler.euler2axangle`` followed by ``axis * angle``.
+    """
+    half = np.asarray(rpy, dtype=np.float64) / 2.0
+    c, s = np.cos(half), np.sin(half)
+    ci, cj, ck = c[:, 0], c[:, 1], c[:, 2]
+    si, sj, sk = s[:, 0], s[:, 1], s[:, 2]
+    cc, cs, sc, ss = ci * ck, ci * sk, si * ck, si * sk
+    quat = np.empty((len(half), 4))
+    quat[:, 0] = cj * cc + sj * ss
+    quat[:, 1] = cj * sc - sj * cs
+    quat[:, 2] = cj * ss + sj * cc
+    quat[:, 3] = cj * cs - sj * sc
+    quat /= np.sqrt(np.sum(quat ** 2, axis=-1, keepdims=True))
+
+    xyz = quat[:, 1:]
+    length = np.sqrt(np.sum(xyz ** 2, axis=-1))
+    identity = length < _IDENTITY_THRESH
+    angle = 2 * np.arccos(np.minimum(np.maximum(quat[:, 0], -1.0), 1.0))
+    axis = xyz / np.where(identity, 1.0, length)[:, None]
+    axangle = axis * angle[:, None]
+    axangle[identity] = 0.0
+    return axangle
+
+
+def sticky_gripper(
+    current: np.ndarray,
+    previous: np.ndarray,
+    sticky_on: np.ndarray,
+    sticky_action: np.ndarray,
+    repeat: np.ndarray,
+    num_repeat: np.ndarray,
+    hold_previous: bool,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    One step of the sticky-gripper state machine for N sessions at once. ``previous``
+    is NaN for sessions without a previous gripper action. Returns the relative
+    gripper actions and the updated (previous, sticky_on, sticky_action, repeat).
+    """
+    first = np.isnan(previous)
+    relative = np.where(first, 0.0, previous - current)
+    trigger = (np.abs(relative) > 0.5) & ~sticky_on
+    previous = np.where(first | trigger, current, previous) if hold_previous else current
+
+    sticky_on = sticky_on | trigger
+    sticky_action = np.where(trigger, relative, sticky_action)
+    repeat = repeat + sticky_on
+    relative = np.where(sticky_on, sticky_action, relative)
+
+    done = repeat == num_repeat
+    return (
+        relative,
+        previous,
+        sticky_on & ~done,
+        np.where(done, 0.0, sticky_action),
+        np.where(done, 0, repeat),
+    )
+
+
+def postprocess_actions(
+    raw_actions: np.ndarray, states: Sequence[Any], action_scale: float, hold_previous_gripper: bool
+) -> list[tuple[dict[str, np.ndarray], dict[str, np.ndarray]]]:
+    """
+    (raw_action, action) dicts for the rows of ``raw_actions`` (N, 7), updating the
+    gripper state of ``states``. A state may appear more than once (consecutive steps
+    of one session); its rows are then applied in order.
+    """
+    results = []
+    start = 0
+    while start < len(states):
+        # split into runs without repeated sessions, which are updated in one go
+        seen = set()
+        end = start
+        while end < len(states) and id(states[end]) not in seen:
+            seen.add(id(states[end]))
+            end += 1
+        results += _postprocess_run(raw_actions[start:end], states[start:end], action_scale, hold_previous_gripper)
+        start = end
+    return results
+
+
+def _postprocess_run(
+    raw_actions: np.ndarray, states: Sequence[Any], action_scale: float, hold_previous_gripper: bool
+) -> list[tuple[dict[str, np.ndarray], dict[str, np.ndarray]]]:
+    raw_actions = np.asarray(raw_actions)
+    world_vector = raw_actions[:, :3] * action_scale
+    rot_axangle = euler2axangle(raw_actions[:, 3:6]) * action_scale
+    open_gripper = raw_actions[:, 6]
+
+    google = np.array([state.policy_setup == "google_robot" for state in states])
+    gripper = 2.0 * (open_gripper > 0.5) - 1.0
+    if google.any():
+        sticky = [state for state, is_google in zip(states, google) if is_google]
+        relative, previous, sticky_on, sticky_action, repeat = sticky_gripper(
+            open_gripper[google],
+            np.array([np.nan if s.previous_gripper_action is None else s.previous_gripper_action for s in sticky],
+                     dtype=np.float64),
+            np.array([s.sticky_action_is_on for s in sticky], dtype=bool),
+            np.array([s.sticky_gripper_action for s in sticky], dtype=np.float64),
+            np.array([s.gripper_action_repeat for s in sticky]),
+            np.array([s.sticky_gripper_num_repeat for s in sticky]),
+            hold_previous_gripper,
+        )
+        gripper[google] = relative
+        for i, state in enumerate(sticky):
+            state.previous_gripper_action = float(previous[i])
+            state.sticky_action_is_on = bool(sticky_on[i])
+            state.sticky_gripper_action = float(sticky_action[i])
+            state.gripper_action_repeat = int(repeat[i])
+
+    results = []
+    for i in range(len(states)):
+        raw_action = {
+            "world_vector": raw_actions[i, :3],
+            "rotation_delta": raw_actions[i, 3:6],
+            "open_gripper": raw_actions[i, 6:7],  # range [0, 1]; 1 = open; 0 = close
+        }
+        action = {
+            "world_vector": world_vector[i],
+            "rot_axangle": rot_axangle[i],
+            "gripper": gripper[i:i + 1],
+            "terminate_episode": np.array([0.0]),
+        }
+        results.append((raw_action, action))
+    return results
@@ -0,0 +1,168 @@
+"""
+prismatic.py
+
+Batched action decoding for OpenVLA-family (Prismatic) checkpoints. The HF
+``predict_action``/``generate`` path of these models only accepts batch size 1,
+so this module runs the vision backbone, projector and Llama backbone directly
+with a left-padded multimodal batch and a greedy decoding loop.
+
+``process_inputs`` is the processor call of a step, with the tokenized prompt
+taken from the prompt cache (common/prompts.py). The patch embeddings of
+frames seen before can come from the vision cache (common/vision.py).
+
+The key/value states of the prompt are not carried over between the steps of
+an episode: the image patches sit right after <BOS>, so every text token
+attends to them and its keys and values from the second layer on change with
+the frame. The only states that stay the same are those of <BOS> and the
+first-layer ones of the text, under 1% of the prefill (tests/test_prompt_kv.py).
+"""
+from typing import Any, List, Optional
+import numpy as np
+import torch
+from PIL import Image
+from transformers import BatchFeature
+
+from common.prompts import prompt_cache
+from common.vision import vision_cache
+
+# token for '' that Prismatic appends after "Out:" to match training inputs
+EMPTY_TOKEN_ID = 29871
+
+
+def process_inputs(processor: Any, model: str, prompt: str, unnorm_key: str, image: Image.Image) -> BatchFeature:
+    """``processor(prompt, image)`` (PrismaticProcessor), running only the image processor on a cached prompt."""
+    text_inputs = prompt_cache.get(
+        model, prompt, unnorm_key, lambda: dict(processor.tokenizer(prompt, return_tensors="pt"))
+    )
+    pixel_values = processor.image_processor(image, return_tensors="pt")["pixel_values"]
+    return BatchFeature(data={**text_inputs, "pixel_values": pixel_values})
+
+
+@torch.inference_mode()
+def generate_batch(
+    vla,
+    input_ids: List[torch.Tensor],
+    pixel_values: torch.Tensor,
+    max_new_tokens: int,
+    eos_token_id: Optional[int] = None,
+    suffix_ids: Optional[List[Optional[torch.Tensor]]] = None,
+    controllers: Optional[List[Optional[Any]]] = None,
+    image_keys: Optional[List[Optional[str]]] = None,
+) -> List[torch.Tensor]:
+    """
+    Greedy-decode ``max_new_tokens`` tokens for every (prompt, image) pair.
+
+    input_ids: list of 1-D token tensors (prompts may differ in length)
+    pixel_values: (B, C, H, W) processed images
+    suffix_ids: optional 1-D tensors of earlier generated tokens (e.g. ECoT reasoning) fed
+        after each prompt, decoding continues from there
+    controllers: optional per-row objects steering the decoding. ``controller.step(token)`` gets
+        the greedy token of the row and returns ``(token, drop)``: the token to feed instead and how
+        many of the row's previously generated tokens to drop. Dropped tokens are masked out and
+        their positions reused, so with rotary embeddings the rest of the sequence is decoded as if
+        they had never been generated.
+    image_keys: optional per-row hashes of the frames; rows with a key take their patch embeddings
+        from the vision cache, and rows sharing a key run the vision backbone once
+    Returns one 1-D tensor of generated (and not dropped) ids per row, cut after ``eos_token_id``.
+    """
+    device = pixel_values.device
+    embed = vla.get_input_embeddings()
+    if image_keys is None:
+        patch_embeddings = vla.projector(vla.vision_backbone(pixel_values))
+    else:
+        patch_embeddings = vision_cache.embeddings(
+            image_keys, lambda rows: vla.projector(vla.vision_backbone(pixel_values[rows]))
+        )
+
+    sequences = []
+    for row, (ids, patches) in enumerate(zip(input_ids, patch_embeddings)):
+        ids = ids.to(device)
+        if ids[-1] != EMPTY_TOKEN_ID:
+            ids = torch.cat([ids, ids.new_tensor([EMPTY_TOKEN_ID])])
+        if suffix_ids is not None and suffix_ids[row] is not None:
+            ids = torch.cat([ids, suffix_ids[row].to(device)])
+        text = embed(ids)
+        # image patches go right after <BOS>, as in PrismaticForConditionalGeneration.forward
+        sequences.append(torch.cat([text[:1], patches.to(text.dtype), text[1:]]))
+
+    batch_size, max_len = len(sequences), max(len(s) for s in sequences)
+    inputs_embeds = sequences[0].new_zeros(batch_size, max_len, sequences[0].shape[-1])
+    attention_mask = torch.zeros(batch_size, max_len, dtype=torch.long, device=device)
+    for row, seq in enumerate(sequences):
+        inputs_embeds[row, max_len - len(seq):] = seq
+        attention_mask[row, max_len - len(seq):] = 1
+    position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+
+    output = vla.language_model(
+        inputs_embeds=inputs_embeds,
+        attention_mask=attention_mask,
+        position_ids=position_ids,
+        use_cache=True,
+    )
+    next_position = position_ids[:, -1:] + 1
+    finished = torch.zeros(batch_size, dtype=torch.bool, device=device)
+    generated = [[] for _ in range(batch_size)]
+    num_steps = 0
+    while True:
+        next_tokens = output.logits[:, -1].argmax(-1)
+        if controllers is not None:
+            next_tokens, attention_mask, next_position = _control(
+                controllers, generated, next_tokens, attention_mask, next_position
+            )
+        for row, token in enumerate(next_tokens.tolist()):
+            generated[row].append(token)
+        num_steps += 1
+        if eos_token_id is not None:
+            finished |= next_tokens == eos_token_id
+        if num_steps == max_new_tokens or bool(finished.all()):
+            break
+        attention_mask = torch.cat([attention_mask, attention_mask.new_ones(batch_size, 1)], dim=1)
+        output = vla.language_model(
+            input_ids=next_tokens[:, None],
+            attention_mask=attention_mask,
+            position_ids=next_position,
+            past_key_values=output.past_key_values,
+            use_cache=True,
+        )
+        next_position = next_position + 1
+
+    rows = []
+    for row in generated:
+        if eos_token_id is not None and eos_token_id in row:
+            row = row[: row.index(eos_token_id) + 1]
+        rows.append(torch.tensor(row, dtype=torch.long))
+    return rows
+
+
+def _control(controllers, generated, next_tokens, attention_mask, next_position):
+    """Apply the per-row controllers of generate_batch to the greedy tokens of one decoding step."""
+    next_tokens = next_tokens.clone()
+    for row, controller in enumerate(controllers):
+        if controller is None:
+            continue
+        token, drop = controller.step(int(next_tokens[row]))
+        next_tokens[row] = token
+        if drop:
+            # the dropped tokens are the last ones fed, i.e. the last columns of the mask
+            attention_mask = attention_mask.clone()
+            attention_mask[row, attention_mask.shape[1] - drop:] = 0
+            next_position = next_position.clone()
+            next_position[row] -= drop
+            del generated[row][len(generated[row]) - drop:]
+    return next_tokens, attention_mask, next_position
+
+
+def decode_action_tokens(vla, action_token_ids: np.ndarray, unnorm_key: str) -> np.ndarray:
+    """Map (..., action_dim) action token ids to un-normalized continuous actions."""
+    discretized_actions = vla.vocab_size - action_token_ids
+    discretized_actions = np.clip(discretized_actions - 1, a_min=0, a_max=vla.bin_centers.shape[0] - 1)
+    normalized_actions = vla.bin_centers[discretized_actions]
+
+    action_norm_stats = vla.get_action_stats(unnorm_key)
+    mask = action_norm_stats.get("mask", np.ones_like(action_norm_stats["q01"], dtype=bool))
+    action_high, action_low = np.array(action_norm_stats["q99"]), np.array(action_norm_stats["q01"])
+    return np.where(
+        mask,
+        0.5 * (normalized_actions + 1) * (action_high - action_low) + action_low,
+        normalized_actions,
+    )
@@ -0,0 +1,55 @@
+"""
+prompts.py
+
+Cache of tokenized prompts. The task description of a session is constant for
+an episode, and usually across the hundreds of episodes of one SimplerEnv
+task, so the text half of the processor output (input ids, attention mask and
+whatever else the processor derives from the prompt) is computed once per
+(model, prompt, unnorm_key) and kept in a bounded LRU shared by the inference
+classes of the process. Only the image half of the processor runs per step.
+
+Hits and misses are counted in ``vla_prompt_cache_hits_total`` and
+``vla_prompt_cache_misses_total``, labeled by model. ``PROMPT_CACHE_SIZE``
+(default 256) bounds the number of entries.
+"""
+from collections import OrderedDict
+from typing import Any, Callable, Optional
+import os
+import threading
+
+from common.metrics import metrics
+
+
+class PromptCache:
+    def __init__(self, max_entries: int = 256) -> None:
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[tuple, Any]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, model: str, prompt: Optional[str], unnorm_key: Optional[str], compute: Callable[[], Any]) -> Any:
+        """
+        The cached prompt inputs of ``model``, or ``compute()`` on a miss. The result is shared
+        between requests and must not be modified in place.
+        """
+        key = (model, prompt, unnorm_key)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                metrics.inc("prompt_cache_hits", model=model)
+                return self._entries[key]
+        metrics.inc("prompt_cache_misses", model=model)
+        value = compute()
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return value
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+
+# process-wide, so that the models of the gateway share one bound
+prompt_cache = PromptCache(int(os.environ.get("PROMPT_CACHE_SIZE", 256)))
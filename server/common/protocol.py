@@ -0,0 +1,157 @@
+"""
+protocol.py
+
+Request parsing shared by the /reset and /step endpoints of all model services.
+"""
+from typing import Any, AsyncIterator, List, Optional
+import base64
+import binascii
+import io
+import json
+import numpy as np
+from fastapi import HTTPException, Request, UploadFile
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import StreamingResponse
+from PIL import Image
+from pydantic import ValidationError
+from starlette.concurrency import run_in_threadpool
+
+from common.frames import Frame, FRAME_CONTENT_TYPE, decode_frame
+from common.metrics import metrics
+from common.responses import dumps
+from common.states import STATE_HEADER, decode_state, encode_state
+
+
+def configure_state(
+    inference: Any, state: Any, policy_setup: Optional[str] = None, unnorm_key: Optional[str] = None
+) -> None:
+    """Apply the policy_setup / unnorm_key of a reset request to a session's state (400 if unsupported)."""
+    if policy_setup is None and unnorm_key is None:
+        return
+    try:
+        inference.configure(state, policy_setup, unnorm_key)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+
+
+def configure_sampling(
+    inference: Any,
+    state: Any,
+    cfg_scale: Optional[float] = None,
+    use_ddim: Optional[bool] = None,
+    num_ddim_steps: Optional[int] = None,
+) -> None:
+    """Apply the sampling overrides of a request to a session's state (400 if invalid or unsupported)."""
+    if cfg_scale is None and use_ddim is None and num_ddim_steps is None:
+        return
+    if not hasattr(inference, "configure_sampling"):
+        raise HTTPException(status_code=400, detail="This model has no per-session sampling parameters.")
+    try:
+        inference.configure_sampling(state, cfg_scale, use_ddim, num_ddim_steps)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+
+
+async def read_reset_request(request: Request, model: type) -> Any:
+    """
+    Parse a /reset request into the pydantic ``model`` from either a JSON body or form fields,
+    like the gateway's reset, so that one client works against every service (422 if invalid).
+    """
+    if request.headers.get("content-type", "").startswith("application/json"):
+        fields = await request.json()
+    else:
+        fields = dict(await request.form())
+    try:
+        return model(**fields)
+    except ValidationError as exc:
+        raise RequestValidationError(exc.errors())
+
+
+def read_carried_state(inference: Any, request: Request) -> Optional[Any]:
+    """
+    The policy state a stateless client sent back in the X-Policy-State header (see
+    common/states.py), a fresh state for an empty header, or None without the header.
+    """
+    header = request.headers.get(STATE_HEADER)
+    if header is None:
+        return None
+    if not header:
+        return inference.new_state()
+    try:
+        return decode_state(inference, base64.b64decode(header, validate=True))
+    except (ValueError, binascii.Error) as exc:
+        raise HTTPException(status_code=400, detail=f"Invalid policy state: {exc}")
+
+
+def carried_state(inference: Any, state: Any) -> str:
+    """The X-Policy-State header value of a state, for the client to send back on its next step."""
+    return base64.b64encode(encode_state(inference, state)).decode()
+
+
+async def read_step_request(request: Request) -> Frame:
+    """
+    Parse a /step request. Either a binary frame (application/octet-stream, see
+    common/frames.py) or the multipart form with `file`, `task_description` and `session_id`.
+    """
+    if request.headers.get("content-type", "").startswith(FRAME_CONTENT_TYPE):
+        body = await request.body()
+        try:
+            with metrics.span("decode"):
+                return await run_in_threadpool(decode_frame, body)
+        except ValueError as exc:
+            raise HTTPException(status_code=400, detail=f"Invalid frame: {exc}")
+
+    form = await request.form()
+    file = form.get("file")
+    if file is None or isinstance(file, str):
+        raise HTTPException(status_code=400, detail="Missing image file.")
+    contents = await file.read()
+    try:
+        with metrics.span("decode"):
+            image = await run_in_threadpool(_decode_image, contents)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid image file.")
+    return Frame(image, form.get("session_id"), form.get("task_description"))
+
+
+async def read_step_batch_request(
+    files: List[UploadFile], task_description: Optional[str], task_descriptions: Optional[str]
+) -> tuple[list[np.ndarray], list[Optional[str]]]:
+    """
+    Parse a /step_batch request: the frames, and one prompt per frame from either the shared
+    ``task_description`` or ``task_descriptions``, a JSON list with an entry per frame. A single
+    frame with several ``task_descriptions`` is run once per prompt (a multi-prompt step).
+    """
+    if task_descriptions is not None:
+        try:
+            prompts = json.loads(task_descriptions)
+        except json.JSONDecodeError:
+            raise HTTPException(status_code=400, detail="`task_descriptions` must be a JSON list.")
+        if not isinstance(prompts, list) or (len(prompts) != len(files) and len(files) != 1):
+            raise HTTPException(status_code=400, detail="`task_descriptions` needs one entry per file.")
+    else:
+        prompts = [task_description] * len(files)
+
+    images = []
+    for file in files:
+        contents = await file.read()
+        try:
+            with metrics.span("decode"):
+                images.append(await run_in_threadpool(_decode_image, contents))
+        except Exception:
+            raise HTTPException(status_code=400, detail=f"Invalid image file: {file.filename}")
+    if len(images) == 1:
+        images = images * len(prompts)
+    return images, prompts
+
+
+def ndjson_response(results: AsyncIterator[tuple[int, dict]]) -> StreamingResponse:
+    """Stream (index, payload) pairs as one JSON object per line, {"index": i, **payload}."""
+    async def lines():
+        async for index, payload in results:
+            yield dumps({"index": index, **payload}) + b"\n"
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+def _decode_image(contents: bytes) -> np.ndarray:
+    return np.array(Image.open(io.BytesIO(contents)).convert("RGB"))
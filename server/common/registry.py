@@ -0,0 +1,178 @@
+"""
+registry.py
+
+Model registry for the gateway: several ``*Inference`` classes share one
+process and GPU. A model is loaded on first use. Before a model is placed on
+the GPU, the least recently used idle models are offloaded to CPU RAM (or
+dropped) until fewer than ``max_resident`` models are resident and enough GPU
+memory is free for it. Models with requests in flight are never evicted.
+"""
+from dataclasses import dataclass
+from typing import Any, Callable, Optional
+import gc
+import threading
+import time
+import torch
+
+from common.metrics import metrics
+
+
+@dataclass
+class ModelSpec:
+    name: str
+    # builds the inference object; loading it puts the weights on the GPU
+    factory: Callable[[], Any]
+    max_batch_size: int = 1
+    max_wait_ms: float = 0.0
+
+
+class ModelHost:
+    """A loaded model together with its sessions and step worker."""
+
+    def __init__(self, spec: ModelSpec, inference: Any, sessions: Any, worker: Any) -> None:
+        self.spec = spec
+        self.inference = inference
+        self.sessions = sessions
+        self.worker = worker
+        # "cuda", "cpu", or "moving" while being offloaded
+        self.device = "cuda"
+        self.gpu_bytes = 0
+        self.active = 0
+        self.last_used = time.monotonic()
+
+
+class ModelRegistry:
+    def __init__(
+        self,
+        specs: list[ModelSpec],
+        make_host: Callable[[ModelSpec], ModelHost],
+        max_resident: int = 2,
+        min_free_bytes: int = 0,
+        offload: str = "cpu",
+    ) -> None:
+        if offload not in ("cpu", "drop"):
+            raise ValueError(f"offload must be 'cpu' or 'drop', got {offload!r}")
+        self.specs = {spec.name: spec for spec in specs}
+        self.make_host = make_host
+        self.max_resident = max_resident
+        self.min_free_bytes = min_free_bytes
+        self.offload = offload
+        self._hosts: dict[str, ModelHost] = {}
+        # _lock guards the host table and counters; _load_lock serializes loads and moves
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+
+    def acquire(self, name: str) -> ModelHost:
+        """
+        Return the host of ``name`` with its model on the GPU, loading or moving it
+        there if needed (blocking, may take minutes). Raises KeyError for unknown
+        models. Every acquire must be paired with a ``release``.
+        """
+        spec = self.specs[name]
+        with self._lock:
+            host = self._hosts.get(name)
+            if host is not None and host.device == "cuda":
+                return self._touch(host)
+
+        with self._load_lock:
+            with self._lock:
+                host = self._hosts.get(name)
+                if host is not None and host.device == "cuda":
+                    return self._touch(host)
+            self._make_room(host)
+            if host is None:
+                host = self._load(spec)
+            else:
+                _move_modules(host.inference, "cuda")
+                metrics.inc("model_moves", model=name, device="cuda")
+            with self._lock:
+                host.device = "cuda"
+                self._hosts[name] = host
+                return self._touch(host)
+
+    def release(self, host: ModelHost) -> None:
+        with self._lock:
+            host.active -= 1
+            host.last_used = time.monotonic()
+
+    def status(self) -> dict[str, dict]:
+        with self._lock:
+            hosts = dict(self._hosts)
+        now = time.monotonic()
+        status = {}
+        for name in self.specs:
+            host = hosts.get(name)
+            if host is None:
+                status[name] = {"device": None}
+            else:
+                status[name] = {
+                    "device": host.device,
+                    "active": host.active,
+                    "sessions": len(host.sessions),
+                    "gpu_bytes": host.gpu_bytes,
+                    "idle_seconds": round(now - host.last_used, 1),
+                }
+        return status
+
+    def resident(self) -> dict:
+        """Gauge: 1 for models on the GPU, 0 for loaded models offloaded to the CPU."""
+        with self._lock:
+            return {(("model", name),): int(host.device == "cuda") for name, host in self._hosts.items()}
+
+    def _touch(self, host: ModelHost) -> ModelHost:
+        host.active += 1
+        host.last_used = time.monotonic()
+        return host
+
+    def _load(self, spec: ModelSpec) -> ModelHost:
+        allocated = torch.cuda.memory_allocated() if torch.cuda.is_available() else 0
+        host = self.make_host(spec)
+        if torch.cuda.is_available():
+            host.gpu_bytes = torch.cuda.memory_allocated() - allocated
+        metrics.inc("model_loads", model=spec.name)
+        return host
+
+    def _make_room(self, incoming: Optional[ModelHost]) -> None:
+        needed = incoming.gpu_bytes if incoming is not None and incoming.gpu_bytes else self.min_free_bytes
+        while True:
+            with self._lock:
+                resident = [host for host in self._hosts.values() if host.device == "cuda"]
+                idle = [host for host in resident if host.active == 0]
+                tight = len(resident) >= self.max_resident or _free_gpu_bytes() < needed
+                if not tight or not idle:
+                    # with every resident model busy, load anyway rather than block
+                    return
+                victim = min(idle, key=lambda host: host.last_used)
+                victim.device = "moving"
+            self._evict(victim)
+
+    def _evict(self, host: ModelHost) -> None:
+        name = host.spec.name
+        if self.offload == "cpu":
+            _move_modules(host.inference, "cpu")
+            with self._lock:
+                host.device = "cpu"
+            metrics.inc("model_moves", model=name, device="cpu")
+        else:
+            with self._lock:
+                del self._hosts[name]
+            host.worker.close()
+            host.inference = None
+            gc.collect()
+            metrics.inc("model_drops", model=name)
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+
+def _move_modules(inference: Any, device: str) -> None:
+    # the inference classes keep their networks as plain attributes (vla / model)
+    for value in vars(inference).values():
+        if isinstance(value, torch.nn.Module):
+            value.to(device)
+
+
+def _free_gpu_bytes() -> float:
+    if not torch.cuda.is_available():
+        return float("inf")
+    free, _ = torch.cuda.mem_get_info()
+    return free
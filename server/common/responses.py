@@ -0,0 +1,125 @@
+"""
+responses.py
+
+Encodings of the /step result, picked per request with the ``format`` query
+parameter (or the Accept header):
+
+    json     {"raw_action": {...}, "action": {...}} with nested lists (default)
+    flat     JSON, every field as one flat list of floats
+    msgpack  a msgpack map, every field as the bytes of a float32 vector
+    raw      the float32 vectors of the fields back to back (application/octet-stream)
+
+``fields`` is a comma-separated subset of ``raw_action`` (world_vector,
+rotation_delta, open_gripper) and ``action`` (world_vector, rot_axangle,
+gripper, ready for env.step), returned in that order; both are 7 values and
+both are sent by default. Vectors are little-endian float32, so a raw response
+with ``fields=action`` is exactly 28 bytes.
+
+JSON is written with orjson when it is installed, straight from the numpy
+arrays; otherwise with the standard library.
+"""
+from dataclasses import dataclass
+from typing import Any, Sequence
+import json
+import numpy as np
+from fastapi import HTTPException, Request
+
+try:
+    import orjson
+except ImportError:  # optional fast path
+    orjson = None
+try:
+    import msgpack
+except ImportError:  # optional format
+    msgpack = None
+
+FORMATS = {
+    "json": "application/json",
+    "flat": "application/json",
+    "msgpack": "application/msgpack",
+    "raw": "application/octet-stream",
+}
+# Accept header values that select a format when ?format= is not given
+_ACCEPT = {
+    "application/msgpack": "msgpack",
+    "application/x-msgpack": "msgpack",
+    "application/octet-stream": "raw",
+}
+# keys concatenated into the flat vector of each field
+FIELDS = {
+    "raw_action": ("world_vector", "rotation_delta", "open_gripper"),
+    "action": ("world_vector", "rot_axangle", "gripper"),
+}
+DEFAULT_FIELDS = ("raw_action", "action")
+
+
+@dataclass(frozen=True)
+class ResponseEncoder:
+    format: str = "json"
+    fields: tuple = DEFAULT_FIELDS
+
+    @property
+    def media_type(self) -> str:
+        return FORMATS[self.format]
+
+    def __call__(self, raw_action: dict, action: dict) -> bytes:
+        parts = {"raw_action": raw_action, "action": action}
+        if self.format == "json":
+            return dumps({field: parts[field] for field in self.fields})
+        vectors = {field: flatten(parts[field], FIELDS[field]) for field in self.fields}
+        if self.format == "flat":
+            return dumps(vectors)
+        if self.format == "msgpack":
+            return msgpack.packb({field: vector.tobytes() for field, vector in vectors.items()})
+        return b"".join(vector.tobytes() for vector in vectors.values())
+
+
+def response_encoder(request: Request) -> ResponseEncoder:
+    """The encoder a /step request asks for (400 for unknown formats or fields)."""
+    format = request.query_params.get("format")
+    if format is None:
+        accept = request.headers.get("accept", "").split(",")[0].split(";")[0].strip()
+        format = _ACCEPT.get(accept, "json")
+    if format not in FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unknown format {format!r}, expected one of {list(FORMATS)}.")
+    if format == "msgpack" and msgpack is None:
+        raise HTTPException(status_code=400, detail="msgpack is not installed on the server.")
+
+    fields = request.query_params.get("fields")
+    if fields is None:
+        return ResponseEncoder(format)
+    selected = {field.strip() for field in fields.split(",") if field.strip()}
+    if not selected or not selected <= FIELDS.keys():
+        raise HTTPException(status_code=400, detail=f"`fields` must be a subset of {list(FIELDS)}.")
+    return ResponseEncoder(format, tuple(field for field in DEFAULT_FIELDS if field in selected))
+
+
+def flatten(part: dict, keys: Sequence[str]) -> np.ndarray:
+    return np.concatenate([np.ravel(part[key]) for key in keys], dtype="<f4")
+
+
+def dumps(payload: Any) -> bytes:
+    """JSON-encode a payload that may contain numpy arrays and scalars."""
+    if orjson is not None:
+        return orjson.dumps(payload, default=_to_list, option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(payload, default=_to_list, separators=(",", ":")).encode()
+
+
+def decode_response(
+    body: bytes, format: str, fields: Sequence[str] = DEFAULT_FIELDS
+) -> dict[str, np.ndarray]:
+    """Client side: the flat vectors of a flat / msgpack / raw response, by field."""
+    if format == "flat":
+        return {field: np.asarray(values, dtype=np.float32) for field, values in json.loads(body).items()}
+    if format == "msgpack":
+        return {field: np.frombuffer(data, dtype="<f4") for field, data in msgpack.unpackb(body).items()}
+    if format == "raw":
+        fields = [field for field in DEFAULT_FIELDS if field in fields]
+        return dict(zip(fields, np.frombuffer(body, dtype="<f4").reshape(len(fields), -1)))
+    raise ValueError(f"Not a flat response format: {format!r}")
+
+
+def _to_list(value: Any) -> Any:
+    if isinstance(value, (np.ndarray, np.generic)):
+        return value.tolist()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
@@ -0,0 +1,127 @@
+"""
+results.py
+
+Content-addressed cache of model outputs, for replays. All models decode
+greedily, so the same checkpoint, unnorm_key, prompt, frame (and for
+SpatialVLA the frames of its history, for ECoT the reasoning it is
+conditioned on, for CogACT the sampling settings) gives the same outputs.
+The inference classes fingerprint those inputs in ``preprocess`` as
+``inputs["cache_key"]``, and the worker looks the key up before the forward
+pass: a hit skips the device stage, a miss stores the raw outputs once the
+forward is done. Ensembling, the gripper logic and every other per-session
+step still run on the cached outputs, so re-running an evaluation or
+replaying recorded frames costs the preprocessing only.
+
+The entries live in an LRU of ``RESULT_CACHE_SIZE`` entries and, with
+``RESULT_CACHE_DIR`` set, in one file per key under that directory, which
+outlives the process and is shared by the processes that mount it. The cache
+is off unless either is set. Hits are counted in
+``vla_result_cache_hits_total`` (labeled by tier, memory or disk) and misses
+in ``vla_result_cache_misses_total``.
+
+CogACT samples its diffusion noise unseeded, so a cached chunk is the first
+one drawn for its inputs rather than the one a new forward would draw.
+"""
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Optional
+import hashlib
+import os
+import pickle
+import threading
+import numpy as np
+import torch
+
+from common.metrics import metrics
+
+
+def fingerprint(*parts: Any) -> str:
+    """Hex digest of strings, numbers, None, arrays, tensors and (nested) sequences of them."""
+    digest = hashlib.blake2b(digest_size=20)
+
+    def update(part: Any) -> None:
+        if isinstance(part, torch.Tensor):
+            part = part.detach().cpu()
+            # numpy has no bfloat16
+            part = (part.float() if part.dtype == torch.bfloat16 else part).numpy()
+        if isinstance(part, np.ndarray):
+            digest.update(f"array:{part.dtype}:{part.shape}:".encode())
+            digest.update(np.ascontiguousarray(part).tobytes())
+        elif isinstance(part, (list, tuple)):
+            digest.update(f"seq:{len(part)}:".encode())
+            for item in part:
+                update(item)
+        elif isinstance(part, bytes):
+            digest.update(f"bytes:{len(part)}:".encode() + part)
+        else:
+            text = repr(part)
+            digest.update(f"{type(part).__name__}:{len(text)}:{text}".encode())
+
+    for part in parts:
+        update(part)
+    return digest.hexdigest()
+
+
+class ResultCache:
+    def __init__(self, max_entries: int = 0, directory: Optional[str] = None) -> None:
+        self.max_entries = max_entries
+        self.directory = Path(directory) if directory else None
+        # pickled outputs, so that every hit hands out its own copy to post-processing
+        self._entries: "OrderedDict[str, bytes]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0 or self.directory is not None
+
+    def get(self, key: str) -> Optional[Any]:
+        """The outputs stored under ``key``, or None."""
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+        tier = "memory"
+        if data is None and self.directory is not None:
+            try:
+                data = self._path(key).read_bytes()
+            except FileNotFoundError:
+                pass
+            else:
+                tier = "disk"
+                self._remember(key, data)
+        if data is None:
+            metrics.inc("result_cache_misses")
+            return None
+        metrics.inc("result_cache_hits", tier=tier)
+        return pickle.loads(data)
+
+    def put(self, key: str, outputs: Any) -> None:
+        data = pickle.dumps(outputs, protocol=pickle.HIGHEST_PROTOCOL)
+        self._remember(key, data)
+        if self.directory is not None:
+            path = self._path(key)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            # written under a temporary name, so that readers never see a partial file
+            temporary = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+            temporary.write_bytes(data)
+            os.replace(temporary, path)
+
+    def _remember(self, key: str, data: bytes) -> None:
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = data
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _path(self, key: str) -> Path:
+        return self.directory / key[:2] / f"{key}.pkl"
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+
+# process-wide, so that the models of the gateway share one bound
+result_cache = ResultCache(int(os.environ.get("RESULT_CACHE_SIZE", 0)), os.environ.get("RESULT_CACHE_DIR") or None)
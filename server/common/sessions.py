@@ -0,0 +1,139 @@
+"""
+sessions.py
+
+Session-keyed policy state. The heavy model weights live on the single
+``*Inference`` object of a service; everything that belongs to one episode
+(task description, sticky-gripper counters, image history, ensembler) lives
+on a ``PolicyState`` stored here under a session id.
+"""
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from typing import Any, Callable, Optional
+import threading
+import time
+import uuid
+
+
+@dataclass
+class Prefetch:
+    """
+    Prediction of the next action chunk, started from the frame of a step that was
+    itself served from the cached chunk. ``result`` is None until the prediction is
+    started, then a future (InferenceWorker) or the model outputs (synchronous step).
+    """
+    inputs: Any
+    # index in the current chunk of the step whose frame conditions the prediction
+    chunk_step: int
+    created: float = field(default_factory=time.monotonic)
+    result: Any = None
+
+
+class PolicyState:
+    def __init__(self, image_history_len: int = 0, action_ensembler: Any = None) -> None:
+        self.image_history = deque(maxlen=image_history_len)
+        self.action_ensembler = action_ensembler
+        # robot setup of the session (see the inference classes' configure); kept across resets
+        self.policy_setup: Optional[str] = None
+        self.unnorm_key: Optional[str] = None
+        self.sticky_gripper_num_repeat = 1
+        # per-session overrides of the sampling parameters of the model (CogACT: cfg_scale,
+        # use_ddim, num_ddim_steps); kept across resets
+        self.sampling: dict = {}
+        # steps served over the lifetime of the session, across episode resets
+        self.num_steps = 0
+        self.reset(None)
+
+    def reset(self, task_description: Optional[str]) -> None:
+        self.task_description = task_description
+        self.image_history.clear()
+        if self.action_ensembler is not None:
+            self.action_ensembler.reset()
+        self.num_image_history = 0
+
+        self.sticky_action_is_on = False
+        self.gripper_action_repeat = 0
+        self.sticky_gripper_action = 0.0
+        self.previous_gripper_action = None
+
+        # last predicted action chunk, the index of the action executed from it and the index of the
+        # first action served from it (past 0 for a prefetched chunk, aligned to its conditioning frame)
+        self.action_chunk = None
+        self.chunk_step = 0
+        self.chunk_start = 0
+        # next chunk being predicted in the background, dropped with the episode
+        self.prefetch: Optional[Prefetch] = None
+
+        # ECoT chain-of-thought conditioning the steps until it is regenerated: its token ids,
+        # the steps it has served and the downscaled frame it was generated on
+        self.reasoning_ids: Any = None
+        self.reasoning_steps = 0
+        self.reasoning_scene: Any = None
+        # tokens ECoT decoded in the last step
+        self.decoded_tokens = 0
+
+        # near-duplicate frames (common/duplicates.py): outputs of the last forward pass, the
+        # signature of the frame they were predicted from and the steps they were reused for since
+        self.duplicate_outputs: Any = None
+        self.duplicate_reference: Any = None
+        self.duplicate_steps = 0
+
+
+class SessionStore:
+    """
+    Thread-safe map session_id -> state. Sessions idle for longer than ``ttl``
+    seconds are dropped, and when more than ``max_sessions`` are alive the
+    least recently used one is evicted.
+    """
+
+    def __init__(self, factory: Callable[[], Any], ttl: float = 600.0, max_sessions: int = 64) -> None:
+        self.factory = factory
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self._sessions: "OrderedDict[str, list]" = OrderedDict()  # id -> [state, last_access]
+        self._lock = threading.Lock()
+
+    def create(self) -> tuple[str, Any]:
+        session_id = uuid.uuid4().hex
+        state = self.factory()
+        with self._lock:
+            now = time.monotonic()
+            self._evict(now)
+            while len(self._sessions) >= self.max_sessions:
+                self._sessions.popitem(last=False)
+            self._sessions[session_id] = [state, now]
+        return session_id, state
+
+    def get(self, session_id: str) -> Any:
+        """Return the state of a live session, raising KeyError for unknown or expired ids."""
+        with self._lock:
+            now = time.monotonic()
+            self._evict(now)
+            entry = self._sessions[session_id]
+            entry[1] = now
+            self._sessions.move_to_end(session_id)
+            return entry[0]
+
+    def drop(self, session_id: str) -> None:
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def items(self) -> list[tuple[str, Any]]:
+        """Snapshot of (session_id, state) pairs, without refreshing their TTL."""
+        with self._lock:
+            return [(session_id, entry[0]) for session_id, entry in self._sessions.items()]
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._sessions)
+
+    def __contains__(self, session_id: str) -> bool:
+        with self._lock:
+            return session_id in self._sessions
+
+    def _evict(self, now: float) -> None:
+        # entries are kept in access order, so expired ones are at the front
+        while self._sessions:
+            session_id, (_, last_access) = next(iter(self._sessions.items()))
+            if now - last_access <= self.ttl:
+                break
+            self._sessions.popitem(last=False)
@@ -0,0 +1,184 @@
+"""
+states.py
+
+Client-carried policy state, for stateless steps. A session pins its episode
+to the process that holds its ``PolicyState``; a client that resets with
+``stateless=true`` instead gets the state back as a compact binary blob, in
+the ``X-Policy-State`` header (base64) of every /step response, and sends it
+back in the same header on its next /step. Any replica with the same weights
+can then serve any step, and a load balancer needs no session affinity.
+
+The blob is the magic ``VLAS``, a version byte and one tagged field per
+entry of ``FIELDS`` that differs from a fresh state: the task, the robot
+setup, the sticky-gripper counters, the cached action chunk (with
+``exec_horizon > 1``), the sampling overrides and the ensembling history, as
+little-endian scalars and float32 arrays. The ensembling history keeps only
+the rows of the stored chunks that later steps still read, so for CogACT's
+bridge setup (horizon 7) it is 21 actions, 588 bytes; ECoT with ``reasoning_interval > 1`` adds its reasoning
+tokens (2 bytes each) and the 32x32 thumbnail of the frame they were
+generated on (1 KiB).
+
+Not carried: SpatialVLA's frame history (the frame of a step fills it, which
+is exact for checkpoints observing a single frame), the prediction of the next
+chunk in the background (``prefetch_at`` only wastes forwards here), and the
+near-duplicate frame state. Chunks are carried in float32, which is what the
+models predict them in.
+"""
+from typing import Any
+import struct
+import numpy as np
+import torch
+
+from common.sessions import PolicyState
+
+STATE_MAGIC = b"VLAS"
+STATE_VERSION = 1
+# request and response header carrying the base64 blob
+STATE_HEADER = "X-Policy-State"
+
+# (kind, attribute); a field is tagged with its index here, so new fields are only appended
+FIELDS = (
+    ("str", "task_description"),
+    ("str", "policy_setup"),
+    ("str", "unnorm_key"),
+    ("int", "num_steps"),
+    ("bool", "sticky_action_is_on"),
+    ("int", "gripper_action_repeat"),
+    ("float", "sticky_gripper_action"),
+    ("float", "previous_gripper_action"),
+    ("int", "chunk_step"),
+    ("array", "action_chunk"),
+    ("int", "reasoning_steps"),
+    ("array", "reasoning_ids"),
+    ("array", "reasoning_scene"),
+    ("float", "sampling.cfg_scale"),
+    ("bool", "sampling.use_ddim"),
+    ("int", "sampling.num_ddim_steps"),
+    ("arrays", "ensemble"),
+    ("int", "chunk_start"),
+)
+
+# gripper values are float64 in the post-processing, so scalars are kept exact
+_SCALARS = {"int": "<i", "float": "<d", "bool": "<?"}
+_DTYPES = (np.dtype("<u1"), np.dtype("<u2"), np.dtype("<i4"), np.dtype("<f4"))
+
+
+def encode_state(inference: Any, state: PolicyState) -> bytes:
+    """The blob of a session's state of ``inference``: the fields that differ from a fresh state."""
+    fresh = PolicyState()
+    # without exec_horizon > 1 the last chunk is never executed from again
+    skip = () if getattr(inference, "exec_horizon", 1) > 1 else ("action_chunk", "chunk_step", "chunk_start")
+    out = bytearray(STATE_MAGIC + bytes([STATE_VERSION]))
+    for tag, (kind, name) in enumerate(FIELDS):
+        if name in skip:
+            continue
+        value = _read(state, name)
+        if value is None or (kind == "arrays" and not value):
+            continue
+        if kind not in ("array", "arrays") and value == _read(fresh, name):
+            continue
+        out.append(tag)
+        if kind == "str":
+            text = value.encode()
+            out += struct.pack("<H", len(text)) + text
+        elif kind in _SCALARS:
+            out += struct.pack(_SCALARS[kind], value)
+        elif kind == "array":
+            out += _pack_array(value)
+        else:
+            out += struct.pack("<B", len(value)) + b"".join(_pack_array(array) for array in value)
+    return bytes(out)
+
+
+def decode_state(inference: Any, blob: bytes) -> PolicyState:
+    """A state of ``inference`` restored from a blob; ValueError if it is malformed or its setup unsupported."""
+    if blob[:4] != STATE_MAGIC:
+        raise ValueError("not a policy state")
+    if blob[4:5] != bytes([STATE_VERSION]):
+        raise ValueError(f"unsupported policy state version: {blob[4:5].hex()}")
+    fields, offset = {}, 5
+    try:
+        while offset < len(blob):
+            tag = blob[offset]
+            if tag >= len(FIELDS):
+                raise ValueError(f"unknown policy state field: {tag}")
+            kind, name = FIELDS[tag]
+            fields[name], offset = _unpack(kind, blob, offset + 1)
+    except struct.error:
+        raise ValueError("truncated policy state")
+
+    state = inference.new_state(fields.pop("policy_setup", None), fields.pop("unnorm_key", None))
+    history = fields.pop("ensemble", None)
+    if history is not None and state.action_ensembler is not None:
+        state.action_ensembler.load(history)
+    for name, value in fields.items():
+        if name.startswith("sampling."):
+            state.sampling[name.split(".", 1)[1]] = value
+        elif name == "reasoning_ids":
+            state.reasoning_ids = torch.as_tensor(value, dtype=torch.long)
+        elif name == "reasoning_scene":
+            # the thumbnail is carried as the uint8 gray levels it was computed from
+            state.reasoning_scene = value.astype(np.float32) / 255.0
+        else:
+            setattr(state, name, value)
+    return state
+
+
+def _read(state: PolicyState, name: str) -> Any:
+    if name.startswith("sampling."):
+        return state.sampling.get(name.split(".", 1)[1])
+    if name == "ensemble":
+        ensembler = state.action_ensembler
+        return ensembler.history() if ensembler is not None else None
+    value = getattr(state, name)
+    if name == "reasoning_ids" and value is not None:
+        value = value.cpu().numpy()
+        return value.astype(np.uint16 if value.max(initial=0) < 1 << 16 else np.int32)
+    if name == "reasoning_scene" and value is not None:
+        return np.rint(value * 255.0).astype(np.uint8)
+    if name == "action_chunk" and value is not None:
+        return np.asarray(value, dtype=np.float32)
+    return value
+
+
+def _pack_array(array: np.ndarray) -> bytes:
+    if array.dtype.kind == "f":
+        array = array.astype(np.float32)
+    code = _DTYPES.index(array.dtype.newbyteorder("<"))
+    header = struct.pack(f"<BB{array.ndim}H", code, array.ndim, *array.shape)
+    return header + np.ascontiguousarray(array, dtype=_DTYPES[code]).tobytes()
+
+
+def _unpack(kind: str, blob: bytes, offset: int) -> tuple[Any, int]:
+    if kind == "str":
+        (length,) = struct.unpack_from("<H", blob, offset)
+        offset += 2
+        if offset + length > len(blob):
+            raise ValueError("truncated policy state")
+        return blob[offset:offset + length].decode(), offset + length
+    if kind in _SCALARS:
+        (value,) = struct.unpack_from(_SCALARS[kind], blob, offset)
+        return value, offset + struct.calcsize(_SCALARS[kind])
+    if kind == "array":
+        return _unpack_array(blob, offset)
+    (count,) = struct.unpack_from("<B", blob, offset)
+    offset += 1
+    arrays = []
+    for _ in range(count):
+        array, offset = _unpack_array(blob, offset)
+        arrays.append(array)
+    return arrays, offset
+
+
+def _unpack_array(blob: bytes, offset: int) -> tuple[np.ndarray, int]:
+    code, ndim = struct.unpack_from("<BB", blob, offset)
+    if code >= len(_DTYPES):
+        raise ValueError(f"unknown array dtype in policy state: {code}")
+    shape = struct.unpack_from(f"<{ndim}H", blob, offset + 2)
+    offset += 2 + 2 * ndim
+    size = int(np.prod(shape)) * _DTYPES[code].itemsize
+    if offset + size > len(blob):
+        raise ValueError("truncated policy state")
+    array = np.frombuffer(blob, dtype=_DTYPES[code], count=int(np.prod(shape)), offset=offset).reshape(shape)
+    # a writable native copy, as the models keep and modify the arrays
+    return array.astype(_DTYPES[code].newbyteorder("="), copy=True), offset + size
@@ -0,0 +1,76 @@
+"""
+streaming.py
+
+Long-lived WebSocket control loop, one connection per episode. Saves the
+HTTP request and multipart parsing of /reset and /step on every control step.
+
+Text messages are JSON commands:
+    {"type": "reset", "task_description": "...", "policy_setup": ..., "unnorm_key": ...}
+        -> {"status": "reset", "task_description": "...", "session_id": "...", ...}
+(policy_setup and unnorm_key are optional, see the inference classes' configure)
+Binary messages are frames (see common/frames.py) and are answered with the
+same payload /step returns, in the order they were received. The connection
+owns its session; the session field of the frames is ignored.
+"""
+from typing import Any, Awaitable, Callable
+import json
+from fastapi import WebSocket, WebSocketDisconnect
+from starlette.concurrency import run_in_threadpool
+
+from common.frames import decode_frame
+from common.metrics import metrics
+from common.sessions import SessionStore
+
+
+async def serve_control_loop(
+    websocket: WebSocket,
+    sessions: SessionStore,
+    inference: Any,
+    run_step: Callable[..., Awaitable[dict]],
+) -> None:
+    await websocket.accept()
+    session_id, state = sessions.create()
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+
+            if message.get("bytes") is not None:
+                try:
+                    with metrics.span("decode"):
+                        frame = await run_in_threadpool(decode_frame, message["bytes"])
+                except ValueError as exc:
+                    await websocket.send_json({"error": f"Invalid frame: {exc}"})
+                    continue
+                await websocket.send_json(await run_step(frame.image, frame.task_description, state))
+                continue
+
+            try:
+                command = json.loads(message.get("text") or "")
+            except json.JSONDecodeError:
+                await websocket.send_json({"error": "Text messages must be JSON commands."})
+                continue
+            if command.get("type") == "reset":
+                task_description = command.get("task_description")
+                policy_setup, unnorm_key = command.get("policy_setup"), command.get("unnorm_key")
+                if policy_setup is not None or unnorm_key is not None:
+                    try:
+                        inference.configure(state, policy_setup, unnorm_key)
+                    except ValueError as exc:
+                        await websocket.send_json({"error": str(exc)})
+                        continue
+                inference.reset(task_description, state)
+                await websocket.send_json({
+                    "status": "reset",
+                    "task_description": task_description,
+                    "session_id": session_id,
+                    "policy_setup": state.policy_setup,
+                    "unnorm_key": state.unnorm_key,
+                })
+            else:
+                await websocket.send_json({"error": f"Unknown command: {command.get('type')}"})
+    except WebSocketDisconnect:
+        pass
+    finally:
+        sessions.drop(session_id)
@@ -0,0 +1,78 @@
+"""
+stub.py
+
+CPU stand-in for a VLA policy with the same step / step_batch and
+preprocess / forward_batch / postprocess interface as the real ``*Inference``
+classes. Preprocessing a frame costs ``preprocess_ms``; a forward pass costs
+``forward_ms`` plus ``per_item_ms`` for every extra frame in the batch, which
+mimics a GPU where small batches cost about as much as a single frame. Used to
+measure serving overheads (batching, pipelining, transport) without a GPU.
+"""
+from typing import Optional, Sequence
+import time
+import numpy as np
+
+from common.sessions import PolicyState
+
+
+class StubInference:
+    def __init__(
+        self, forward_ms: float = 40.0, per_item_ms: float = 2.0, preprocess_ms: float = 0.0, action_dim: int = 7
+    ) -> None:
+        self.forward_ms = forward_ms
+        self.preprocess_ms = preprocess_ms
+        self.per_item_ms = per_item_ms
+        self.action_dim = action_dim
+        self.forward_calls = 0
+        self.state = self.new_state()
+
+    def new_state(self) -> PolicyState:
+        return PolicyState()
+
+    def reset(self, task_description: str, state: Optional[PolicyState] = None) -> None:
+        state = self.state if state is None else state
+        state.reset(task_description)
+
+    def step(
+        self, image: np.ndarray, task_description: Optional[str] = None, *args, state: Optional[PolicyState] = None, **kwargs
+    ) -> tuple[dict[str, np.ndarray], dict[str, np.ndarray]]:
+        return self.step_batch([image], [task_description], [state])[0]
+
+    def step_batch(
+        self,
+        images: Sequence[np.ndarray],
+        task_descriptions: Sequence[Optional[str]],
+        states: Sequence[Optional[PolicyState]],
+    ) -> list[tuple[dict[str, np.ndarray], dict[str, np.ndarray]]]:
+        states = [self.state if state is None else state for state in states]
+        inputs = [self.preprocess(*item) for item in zip(images, task_descriptions, states)]
+        outputs = self.forward_batch(inputs)
+        return [self.postprocess(raw, state) for raw, state in zip(outputs, states)]
+
+    def preprocess(self, image: np.ndarray, task_description: Optional[str], state: PolicyState) -> np.ndarray:
+        if task_description is not None and task_description != state.task_description:
+            self.reset(task_description, state)
+        time.sleep(self.preprocess_ms / 1000.0)
+        return image
+
+    def forward_batch(self, inputs: Sequence[np.ndarray]) -> list[np.ndarray]:
+        self.forward_calls += 1
+        time.sleep((self.forward_ms + self.per_item_ms * (len(inputs) - 1)) / 1000.0)
+        # deterministic per-frame output so results can be matched to requests
+        return [np.full(self.action_dim, float(image.mean()) / 255.0, dtype=np.float32) for image in inputs]
+
+    def postprocess(
+        self, raw: np.ndarray, state: PolicyState
+    ) -> tuple[dict[str, np.ndarray], dict[str, np.ndarray]]:
+        raw_action = {
+            "world_vector": raw[:3],
+            "rotation_delta": raw[3:6],
+            "open_gripper": raw[6:7],
+        }
+        action = {
+            "world_vector": raw_action["world_vector"],
+            "rot_axangle": raw_action["rotation_delta"],
+            "gripper": 2.0 * (raw_action["open_gripper"] > 0.5) - 1.0,
+            "terminate_episode": np.array([0.0]),
+        }
+        return raw_action, action
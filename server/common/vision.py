@@ -0,0 +1,84 @@
+"""
+vision.py
+
+Cache of projected visual tokens. Prompt studies replay the same frames under
+many instructions, and the vision backbone (DINOv2 + SigLIP) and projector of
+the Prismatic models (OpenVLA, ECoT, CogACT) give the same patch embeddings
+for a frame whatever the prompt. With ``VISION_CACHE_SIZE`` set, the inference
+classes hash every frame in ``preprocess`` (``inputs["image_key"]``, which
+includes the checkpoint) and the forward pass takes the patch embeddings of
+known frames from an LRU of that many entries, kept on the device, instead of
+running the vision backbone; only the language model runs per prompt. Rows of
+one batch with the same frame share one backbone call as well, so the K
+prompts of a multi-prompt step (``/step_batch`` with one file) cost one vision
+pass. An entry of OpenVLA or ECoT takes 256 x 4096 bf16 values, 2 MiB.
+
+Hits (cached or shared within the batch) and misses are counted in
+``vla_vision_cache_hits_total`` and ``vla_vision_cache_misses_total``.
+"""
+from collections import OrderedDict
+from typing import Any, Callable, List, Optional, Sequence
+import os
+import threading
+
+from common.metrics import metrics
+
+
+class VisionCache:
+    def __init__(self, max_entries: int = 0) -> None:
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Any]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def embeddings(self, keys: Sequence[Optional[str]], compute: Callable[[List[int]], Any]) -> List[Any]:
+        """
+        Patch embeddings of every row of a batch. Rows whose key is cached get the cached
+        embeddings, the first row of every other key (and every row without one) is computed with
+        ``compute(rows)``, which returns one (num_patches, dim) tensor per given row, and later
+        rows of the same key share it. The cached tensors must not be modified in place.
+        """
+        results: List[Any] = [None] * len(keys)
+        first_row: dict[str, int] = {}
+        missing: List[int] = []
+        with self._lock:
+            for row, key in enumerate(keys):
+                if key is None:
+                    missing.append(row)
+                elif key in self._entries:
+                    self._entries.move_to_end(key)
+                    results[row] = self._entries[key]
+                elif key not in first_row:
+                    first_row[key] = row
+                    missing.append(row)
+        if missing:
+            for row, embeddings in zip(missing, compute(missing)):
+                results[row] = embeddings
+                if keys[row] is not None:
+                    self._put(keys[row], embeddings)
+        for row, key in enumerate(keys):
+            if results[row] is None:
+                results[row] = results[first_row[key]]
+        metrics.inc("vision_cache_misses", len(missing))
+        metrics.inc("vision_cache_hits", len(keys) - len(missing))
+        return results
+
+    def _put(self, key: str, embeddings: Any) -> None:
+        if not self.enabled:
+            return
+        with self._lock:
+            self._entries[key] = embeddings
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+
+# process-wide, so that the models of the gateway share one bound
+vision_cache = VisionCache(int(os.environ.get("VISION_CACHE_SIZE", 0)))
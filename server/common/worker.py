@@ -0,0 +1,220 @@
+"""
+worker.py
+
+Staged step pipeline that keeps model execution off the asyncio event loop:
+
+    1. preprocess  - resize, processor, input tensors     (thread pool)
+    2. forward     - model call, batched across requests  (one device thread)
+    3. postprocess - ensembling, gripper logic, serialization (one thread,
+                     batched across the requests whose forward finished together)
+
+Stages of different requests overlap, so frame N+1 is preprocessed while
+frame N is on the GPU, and /ping and uploads stay responsive under load.
+The inference object provides ``preprocess``, ``forward_batch`` and
+``postprocess``, the same split its ``step`` is built from. ``preprocess``
+returns None when the step needs no forward pass (it is served from the
+session's cached action chunk); ``postprocess`` then gets None as well.
+It returns a ``Prefetch`` to start predicting the next chunk in the background
+while the step is still served from the cache, and the same ``Prefetch`` again
+at the chunk boundary, where its result becomes the next chunk.
+
+A ``Reuse`` (``common/duplicates.py``) hands the session's previous outputs
+to post-processing without a forward pass. Inputs that carry a ``cache_key``
+go through the result cache (``common/results.py``) instead of the device
+when their outputs are known.
+"""
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Callable, Optional, Sequence
+import asyncio
+import time
+import numpy as np
+
+from common.batching import BatchScheduler
+from common.duplicates import Reuse
+from common.metrics import metrics, current_trace, run_traced
+from common.results import result_cache
+from common.sessions import Prefetch
+
+
+class InferenceWorker:
+    def __init__(
+        self,
+        inference: Any,
+        serialize: Optional[Callable[[dict, dict], Any]] = None,
+        preprocess_workers: int = 2,
+        max_batch_size: int = 1,
+        max_wait_ms: float = 0.0,
+    ) -> None:
+        self.inference = inference
+        self.serialize = serialize
+        self._preprocess = ThreadPoolExecutor(max_workers=preprocess_workers, thread_name_prefix="preprocess")
+        self.device = BatchScheduler(self._forward, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms)
+        # a single thread keeps per-session state updates in submission order; it takes
+        # whatever is queued at once, without waiting for a batch to fill
+        self.finisher = BatchScheduler(self._finish_batch, max_batch_size=max_batch_size, max_wait_ms=0.0)
+
+    async def step(
+        self,
+        image: np.ndarray,
+        task_description: Optional[str],
+        state: Any,
+        serialize: Optional[Callable[[dict, dict], Any]] = None,
+    ) -> Any:
+        """Run one step; ``serialize`` overrides the worker's serializer for this request."""
+        loop = asyncio.get_running_loop()
+        # executor threads do not inherit the request context, so the trace is passed along
+        trace = current_trace()
+        inputs = await loop.run_in_executor(
+            self._preprocess, run_traced, trace, self.inference.preprocess, image, task_description, state
+        )
+        if isinstance(inputs, Prefetch) and inputs.result is None:
+            inputs.result = asyncio.ensure_future(self._submit(inputs.inputs))
+            inputs = None
+        if inputs is None:
+            metrics.inc("forward_skipped")
+            outputs = None
+        elif isinstance(inputs, Reuse):
+            outputs = inputs.outputs
+        elif isinstance(inputs, Prefetch):
+            waiting = time.perf_counter()
+            outputs, _ = await inputs.result
+            metrics.record("prefetch_wait", time.perf_counter() - waiting, trace)
+            if trace is not None:
+                # how stale the frame that conditioned the chunk is (vla_prefetch_frame_age_*)
+                trace["frame_age"] = time.monotonic() - inputs.created
+        else:
+            submitted = time.perf_counter()
+            outputs, forward_seconds = await self._submit(inputs)
+            metrics.record("queue", time.perf_counter() - submitted - forward_seconds, trace)
+            metrics.record("forward", forward_seconds, trace)
+        return await self.finisher.submit((outputs, state, serialize, trace))
+
+    async def step_independent(
+        self, items: Sequence[tuple], window: Optional[int] = None
+    ) -> AsyncIterator[tuple[int, Any]]:
+        """
+        Run (image, task_description, state) items with unrelated states, at most ``window``
+        at a time so their forwards share batches. Yields (index, result) as they complete.
+        """
+        window = self._window() if window is None else window
+
+        async def run(index: int, item: tuple) -> tuple[int, Any]:
+            return index, await self.step(*item)
+
+        pending = set()
+        for index, item in enumerate(items):
+            pending.add(asyncio.ensure_future(run(index, item)))
+            if len(pending) >= window:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    yield task.result()
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield task.result()
+
+    async def step_sequence(
+        self,
+        images: Sequence[np.ndarray],
+        task_descriptions: Sequence[Optional[str]],
+        state: Any,
+        window: Optional[int] = None,
+    ) -> AsyncIterator[tuple[int, Any]]:
+        """
+        Run consecutive frames of one episode on ``state``. Preprocessing and post-processing
+        stay in frame order while the forwards of up to ``window`` frames are batched; the
+        model input of a frame does not depend on the actions of the previous ones. Yields
+        (index, result) in order.
+        """
+        if (
+            getattr(self.inference, "exec_horizon", 1) > 1
+            or getattr(self.inference, "reasoning_interval", 1) > 1
+            or getattr(self.inference, "duplicate_frame_threshold", None) is not None
+        ):
+            # whether a frame needs a forward (or its reasoning) depends on the state left by the previous one
+            for index, (image, task_description) in enumerate(zip(images, task_descriptions)):
+                yield index, await self.step(image, task_description, state)
+            return
+
+        loop = asyncio.get_running_loop()
+        window = self._window() if window is None else window
+        in_flight = deque()
+        current_task = state.task_description
+        for index, (image, task_description) in enumerate(zip(images, task_descriptions)):
+            if task_description is not None and task_description != current_task:
+                # a new task resets the state, which must not happen under earlier frames' post-processing
+                while in_flight:
+                    yield await self._finish_in_order(in_flight, state)
+                current_task = task_description
+            inputs = await loop.run_in_executor(
+                self._preprocess, self.inference.preprocess, image, task_description, state
+            )
+            in_flight.append((index, asyncio.ensure_future(self._submit(inputs))))
+            if len(in_flight) >= window:
+                yield await self._finish_in_order(in_flight, state)
+        while in_flight:
+            yield await self._finish_in_order(in_flight, state)
+
+    async def _submit(self, inputs: Any) -> tuple[Any, float]:
+        """(outputs, forward seconds) of ``inputs``, from the result cache when it has them."""
+        key = inputs.get("cache_key") if isinstance(inputs, dict) else None
+        if key is None:
+            return await self.device.submit(inputs)
+        # the disk tier is read and written off the event loop
+        loop = asyncio.get_running_loop()
+        outputs = await loop.run_in_executor(self._preprocess, result_cache.get, key)
+        if outputs is not None:
+            return outputs, 0.0
+        outputs, forward_seconds = await self.device.submit(inputs)
+        # stored before post-processing can touch the outputs
+        await loop.run_in_executor(self._preprocess, result_cache.put, key, outputs)
+        return outputs, forward_seconds
+
+    async def _finish_in_order(self, in_flight: deque, state: Any) -> tuple[int, Any]:
+        index, forward = in_flight.popleft()
+        outputs, _ = await forward
+        return index, await self.finisher.submit((outputs, state, None, None))
+
+    def _window(self) -> int:
+        # enough requests in flight to fill a batch while the previous one runs
+        return max(2 * self.device.max_batch_size, 4)
+
+    def close(self) -> None:
+        """Stop the stage threads; requests still in flight are not awaited."""
+        self.device.close()
+        self.finisher.close()
+        self._preprocess.shutdown(wait=False)
+
+    def _forward(self, inputs: list) -> list:
+        start = time.perf_counter()
+        outputs = self.inference.forward_batch(inputs)
+        elapsed = time.perf_counter() - start
+        metrics.observe("batch_size", len(inputs))
+        return [(output, elapsed) for output in outputs]
+
+    def _finish_batch(self, items: list) -> list:
+        """Post-process and serialize (outputs, state, serialize, trace) items, in one call if the inference can."""
+        states = [state for _, state, _, _ in items]
+        for state in states:
+            state.num_steps += 1
+        start = time.perf_counter()
+        if hasattr(self.inference, "postprocess_batch"):
+            results = self.inference.postprocess_batch([outputs for outputs, _, _, _ in items], states)
+        else:
+            results = [self.inference.postprocess(outputs, state) for outputs, state, _, _ in items]
+        postprocess_seconds = time.perf_counter() - start
+        metrics.observe("postprocess_batch_size", len(items))
+
+        finished = []
+        for (_, _, serialize, trace), (raw_action, action) in zip(items, results):
+            metrics.record("postprocess", postprocess_seconds, trace)
+            if serialize is None:
+                serialize = self.serialize
+            if serialize is None:
+                finished.append((raw_action, action))
+                continue
+            start = time.perf_counter()
+            finished.append(serialize(raw_action, action))
+            metrics.record("serialize", time.perf_counter() - start, trace)
+        return finished
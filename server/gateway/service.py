@@ -0,0 +1,261 @@
+from fastapi import FastAPI, File, Form, HTTPException, Request, UploadFile, WebSocket
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import PlainTextResponse, Response
+from pydantic import BaseModel, ValidationError
+from typing import List, Optional
+from pathlib import Path
+import importlib
+import numpy as np
+import os
+import sys
+from starlette.concurrency import run_in_threadpool
+
+from common.metrics import metrics, start_trace, server_timing
+from common.protocol import (
+    carried_state, configure_sampling, configure_state, ndjson_response, read_carried_state, read_step_batch_request,
+    read_step_request,
+)
+from common.registry import ModelHost, ModelRegistry, ModelSpec
+from common.responses import response_encoder
+from common.sessions import PolicyState, SessionStore
+from common.states import STATE_HEADER
+from common.streaming import serve_control_loop
+from common.worker import InferenceWorker
+
+# model packages (models/<name>/ of the repo) are copied next to this file
+MODELS_DIR = Path(os.environ.get("MODELS_DIR", Path(__file__).resolve().parent / "models"))
+
+
+def model_factory(model_dir: str, module: str, class_name: str, **kwargs):
+    """Import ``class_name`` from models/<model_dir>/<module>.py on first use and instantiate it."""
+    def load():
+        path = str(MODELS_DIR / model_dir)
+        if path not in sys.path:
+            # the inference modules import their helpers (ensemblers) as top-level modules
+            sys.path.append(path)
+        return getattr(importlib.import_module(module), class_name)(**kwargs)
+    return load
+
+
+# same policy setups and batching defaults as the per-model services
+SPECS = [
+    ModelSpec("openvla", model_factory("openvla", "openvla_inference", "OpenVLAInference", policy_setup="google_robot"),
+              max_batch_size=int(os.environ.get("MAX_BATCH_SIZE", 8)),
+              max_wait_ms=float(os.environ.get("MAX_BATCH_WAIT_MS", 5))),
+    ModelSpec("ecot", model_factory("ecot", "ecot_inference", "EcoTInference", policy_setup="widowx_bridge"),
+              max_batch_size=int(os.environ.get("MAX_BATCH_SIZE", 8)),
+              max_wait_ms=float(os.environ.get("MAX_BATCH_WAIT_MS", 5))),
+    ModelSpec("cogact", model_factory("cogact", "cogact_inference", "CogACTInference", policy_setup="google_robot"),
+              max_batch_size=int(os.environ.get("MAX_BATCH_SIZE", 8)),
+              max_wait_ms=float(os.environ.get("MAX_BATCH_WAIT_MS", 5))),
+    ModelSpec("spatialvla", model_factory("spatialvla", "spatialvla_inference", "SpatialVLAInference",
+                                          policy_setup="google_robot")),
+]
+# spatialvla pins transformers 4.47 while the others need 4.40, so it is off in the default image
+ENABLED = os.environ.get("GATEWAY_MODELS", "openvla,ecot,cogact").split(",")
+
+
+def np_to_list(d):
+    # Convert numpy arrays to lists for JSON serialization
+    return {k: v.tolist() for k, v in d.items()}
+
+def step_payload(raw_action: dict, action: dict) -> dict:
+    return {"raw_action": np_to_list(raw_action), "action": np_to_list(action)}
+
+def make_host(spec: ModelSpec) -> ModelHost:
+    inference = spec.factory()
+    sessions = SessionStore(
+        inference.new_state,
+        ttl=float(os.environ.get("SESSION_TTL", 600)),
+        max_sessions=int(os.environ.get("MAX_SESSIONS", 64)),
+    )
+    worker = InferenceWorker(
+        inference,
+        serialize=step_payload,
+        preprocess_workers=int(os.environ.get("PREPROCESS_WORKERS", 2)),
+        max_batch_size=spec.max_batch_size,
+        max_wait_ms=spec.max_wait_ms,
+    )
+    return ModelHost(spec, inference, sessions, worker)
+
+
+app = FastAPI()
+registry = ModelRegistry(
+    [spec for spec in SPECS if spec.name in ENABLED],
+    make_host,
+    max_resident=int(os.environ.get("MAX_RESIDENT_MODELS", 2)),
+    min_free_bytes=int(float(os.environ.get("MIN_FREE_GPU_GB", 0)) * 2**30),
+    offload=os.environ.get("OFFLOAD", "cpu"),
+)
+metrics.gauge("model_resident", registry.resident)
+
+async def acquire(name: str) -> ModelHost:
+    """Get a model onto the GPU (loading it on first use); pair with registry.release."""
+    if name not in registry.specs:
+        raise HTTPException(status_code=404, detail=f"Unknown model: {name}")
+    return await run_in_threadpool(registry.acquire, name)
+
+def get_state(host: ModelHost, session_id: Optional[str]):
+    """Resolve a session id to its policy state; no id means the shared single-client state."""
+    if session_id is None:
+        return host.inference.state
+    try:
+        return host.sessions.get(session_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Unknown or expired session: {session_id}")
+
+@app.get("/ping")
+def ping():
+    """Health-check endpoint returning a simple status."""
+    return {"status": "ok"}
+
+@app.get("/models")
+def models():
+    """Registered models and where they currently live (None: not loaded)."""
+    return registry.status()
+
+class SamplingParams(BaseModel):
+    session_id: Optional[str] = None
+    cfg_scale: Optional[float] = None
+    use_ddim: Optional[bool] = None
+    num_ddim_steps: Optional[int] = None
+
+@app.post("/models/{name}/reset")
+async def reset(name: str, request: Request):
+    """
+    Same as /reset of the model services; takes task_description, session_id, policy_setup,
+    unnorm_key, stateless and (CogACT) cfg_scale / use_ddim / num_ddim_steps either as JSON
+    or as form fields. Loads the model if it is not resident.
+    """
+    if request.headers.get("content-type", "").startswith("application/json"):
+        fields = await request.json()
+    else:
+        fields = await request.form()
+    task_description, session_id = fields.get("task_description"), fields.get("session_id")
+    policy_setup, unnorm_key = fields.get("policy_setup"), fields.get("unnorm_key")
+    stateless = str(fields.get("stateless", False)).lower() in ("1", "true")
+    try:
+        sampling = SamplingParams(**{key: fields[key] for key in ("cfg_scale", "use_ddim", "num_ddim_steps")
+                                     if key in fields})
+    except ValidationError as exc:
+        raise RequestValidationError(exc.errors())
+    overrides = (sampling.cfg_scale, sampling.use_ddim, sampling.num_ddim_steps)
+
+    host = await acquire(name)
+    try:
+        if stateless:
+            session_id, state = None, host.inference.new_state()
+        elif session_id is None:
+            configure_state(host.inference, host.inference.state, policy_setup, unnorm_key)
+            configure_sampling(host.inference, PolicyState(), *overrides)
+            session_id, state = host.sessions.create()
+            host.inference.reset(task_description)
+        else:
+            state = get_state(host, session_id)
+        configure_state(host.inference, state, policy_setup, unnorm_key)
+        configure_sampling(host.inference, state, *overrides)
+        host.inference.reset(task_description, state)
+        result = {
+            "status": "reset",
+            "task_description": task_description,
+            "session_id": session_id,
+            "policy_setup": state.policy_setup,
+            "unnorm_key": state.unnorm_key,
+        }
+        # the host may be evicted (inference dropped) as soon as it is released
+        if hasattr(host.inference, "sampling"):
+            result["sampling"] = host.inference.sampling(state)
+        if stateless:
+            result["state"] = carried_state(host.inference, state)
+    finally:
+        registry.release(host)
+    return result
+
+@app.post("/models/{name}/update_session_parameters")
+async def update_session_parameters(name: str, params: SamplingParams):
+    """Same as /update_session_parameters of the CogACT service."""
+    host = await acquire(name)
+    try:
+        if not hasattr(host.inference, "configure_sampling"):
+            raise HTTPException(status_code=400, detail=f"{name} has no per-session sampling parameters.")
+        state = get_state(host, params.session_id)
+        configure_sampling(host.inference, state, params.cfg_scale, params.use_ddim, params.num_ddim_steps)
+        sampling = host.inference.sampling(state)
+    finally:
+        registry.release(host)
+    return {"session_id": params.session_id, "sampling": sampling}
+
+@app.post("/models/{name}/step")
+async def step(name: str, request: Request):
+    """
+    Same as /step of the model services (multipart form or binary frame, format / fields,
+    X-Policy-State of stateless clients).
+    """
+    trace = start_trace()
+    frame = await read_step_request(request)
+    encode = response_encoder(request)
+    host = await acquire(name)
+    try:
+        carried = read_carried_state(host.inference, request)
+        state = get_state(host, frame.session_id) if carried is None else carried
+        body = await host.worker.step(frame.image, frame.task_description, state, serialize=encode)
+        carried_header = None if carried is None else carried_state(host.inference, carried)
+    finally:
+        registry.release(host)
+    response = Response(body, media_type=encode.media_type)
+    if carried_header is not None:
+        response.headers[STATE_HEADER] = carried_header
+    response.headers["Server-Timing"] = server_timing(trace)
+    return response
+
+@app.post("/models/{name}/step_batch")
+async def step_batch(
+    name: str,
+    files: List[UploadFile] = File(...),
+    task_description: Optional[str] = Form(None),
+    task_descriptions: Optional[str] = Form(None),
+    session_id: Optional[str] = Form(None),
+    sequential: bool = Form(False),
+):
+    """Same as /step_batch of the model services; the model stays resident until the stream ends."""
+    images, prompts = await read_step_batch_request(files, task_description, task_descriptions)
+    if not (sequential and session_id is not None) and None in prompts:
+        raise HTTPException(status_code=400, detail="Every frame needs a task description without a session.")
+
+    host = await acquire(name)
+    try:
+        if sequential:
+            state = host.inference.new_state() if session_id is None else get_state(host, session_id)
+            results = host.worker.step_sequence(images, prompts, state)
+        else:
+            results = host.worker.step_independent(
+                [(image, prompt, host.inference.new_state()) for image, prompt in zip(images, prompts)]
+            )
+    except Exception:
+        registry.release(host)
+        raise
+
+    async def held():
+        try:
+            async for result in results:
+                yield result
+        finally:
+            registry.release(host)
+    return ndjson_response(held())
+
+@app.websocket("/models/{name}/ws")
+async def control_loop(websocket: WebSocket, name: str):
+    """Streaming control loop of one model; the model stays resident while connected."""
+    if name not in registry.specs:
+        await websocket.close(code=1008)
+        return
+    host = await run_in_threadpool(registry.acquire, name)
+    try:
+        await serve_control_loop(websocket, host.sessions, host.inference, host.worker.step)
+    finally:
+        registry.release(host)
+
+@app.get("/metrics")
+def get_metrics():
+    """Prometheus text exposition of stage latencies, batch sizes and model residency."""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
@@ -0,0 +1,146 @@
+"""
+action_head.py
+
+CogACT's ``predict_action`` split in two, so that the diffusion action head
+runs once for a batch of sessions instead of once per session: the VLM
+produces the cognition feature of each (image, instruction) pair, then one
+DDIM (or DDPM) denoising loop of the DiT, with classifier-free guidance,
+samples the action chunks of all sessions that share a sampler. Each session
+draws its own noise, so a chunk does not depend on the other sessions of the
+batch. The patch embeddings of the frames can be computed ahead (and taken
+from the vision cache, common/vision.py), in which case the VLM runs only the
+language model.
+"""
+from typing import Callable, Optional, Sequence
+import numpy as np
+import torch
+from PIL import Image
+from transformers import LlamaTokenizerFast
+
+from prismatic.models.vlms.prismatic import PrismaticVLM
+
+
+def _pixel_values(vlm, image: Image.Image):
+    pixel_values = vlm.vision_backbone.image_transform(image)
+    if isinstance(pixel_values, torch.Tensor):
+        return pixel_values[None, ...].to(vlm.device)
+    return {k: v[None, ...].to(vlm.device) for k, v in pixel_values.items()}
+
+
+@torch.inference_mode()
+def patch_embeddings(vla, images: Sequence[Image.Image]) -> torch.Tensor:
+    """(N, num_patches, D) projected patch embeddings of N frames, as PrismaticVLM.forward computes them."""
+    vlm = vla.vlm
+    pixel_values = [_pixel_values(vlm, image) for image in images]
+    if isinstance(pixel_values[0], torch.Tensor):
+        pixel_values = torch.cat(pixel_values)
+    else:
+        pixel_values = {k: torch.cat([x[k] for x in pixel_values]) for k in pixel_values[0]}
+    with torch.autocast("cuda", dtype=vlm.llm_backbone.half_precision_dtype,
+                        enabled=vlm.enable_mixed_precision_training):
+        return vlm.projector(vlm.vision_backbone(pixel_values))
+
+
+@torch.inference_mode()
+def cognition_features(
+    vla, image: Image.Image, instruction: str, patches: Optional[torch.Tensor] = None
+) -> torch.Tensor:
+    """
+    (1, D) cognition feature of one (image, instruction) pair, as in CogACTVLA.predict_action.
+    With the (num_patches, D) ``patches`` of the image (patch_embeddings), the vision backbone is skipped.
+    """
+    vlm = vla.vlm
+    tokenizer = vlm.llm_backbone.tokenizer
+    prompt_builder = vlm.get_prompt_builder()
+    prompt_builder.add_turn(role="human", message=f"What action should the robot take to {instruction.lower()}?")
+    input_ids = tokenizer(prompt_builder.get_prompt(), truncation=True, return_tensors="pt").input_ids.to(vlm.device)
+    if not isinstance(tokenizer, LlamaTokenizerFast):
+        raise ValueError(f"Unsupported `tokenizer` type = {type(tokenizer)}")
+    # the empty token after "ASSISTANT:" and the cognition token (</s>) seen at training time
+    input_ids = torch.cat((input_ids, torch.tensor([[29871, 2]], dtype=torch.long, device=vlm.device)), dim=1)
+
+    with torch.autocast("cuda", dtype=vlm.llm_backbone.half_precision_dtype,
+                        enabled=vlm.enable_mixed_precision_training):
+        if patches is not None:
+            # the multimodal prefill of PrismaticVLM.forward: patches right after <BOS>
+            input_embeddings = vlm.llm_backbone.embed_input_ids(input_ids)
+            embeddings = torch.cat(
+                [input_embeddings[:, :1], patches[None].to(input_embeddings.dtype), input_embeddings[:, 1:]], dim=1
+            )
+            output = vlm.llm_backbone(input_ids=None, inputs_embeds=embeddings, output_hidden_states=True,
+                                      return_dict=True)
+            return output.hidden_states[-1][:, -1, :]
+        output = super(PrismaticVLM, vlm).generate(
+            input_ids=input_ids,
+            pixel_values=_pixel_values(vlm, image),
+            max_new_tokens=1,
+            output_hidden_states=True,
+            return_dict_in_generate=True,
+        )
+    return output.hidden_states[0][-1][:, -1, :]
+
+
+@torch.inference_mode()
+def sample_chunks(
+    action_model,
+    features: torch.Tensor,
+    noise: torch.Tensor,
+    cfg_scales: Sequence[float],
+    use_ddim: bool,
+    select_ddim: Optional[Callable[[], None]] = None,
+) -> torch.Tensor:
+    """
+    Normalized (B, T, action_dim) chunks from one denoising loop over B sessions.
+
+    features: (B, D) cognition features
+    noise: (B, T, action_dim) initial noise of every session
+    cfg_scales: guidance scale of every session; all above 1 (classifier-free guidance on the
+        doubled batch) or all at most 1 (no guidance), as in predict_action
+    select_ddim: points action_model.ddim_diffusion at the sampler of the batch's step count
+    """
+    net = action_model.net
+    model_dtype = next(net.parameters()).dtype
+    features = features.unsqueeze(1).to(model_dtype)  # (B, 1, D)
+    noise = noise.to(device=features.device, dtype=model_dtype)
+    batch_size = features.shape[0]
+    using_cfg = cfg_scales[0] > 1.0
+    if using_cfg:
+        noise = torch.cat([noise, noise], 0)
+        uncondition = net.z_embedder.uncondition.unsqueeze(0).expand(batch_size, 1, -1)
+        # one scale per session, broadcast over the chunk and action dimensions
+        cfg_scale = torch.tensor(cfg_scales, device=features.device, dtype=model_dtype)[:, None, None]
+        model_kwargs = dict(z=torch.cat([features, uncondition], 0), cfg_scale=cfg_scale)
+        sample_fn = net.forward_with_cfg
+    else:
+        model_kwargs = dict(z=features)
+        sample_fn = net.forward
+
+    if use_ddim:
+        if select_ddim is not None:
+            select_ddim()
+        samples = action_model.ddim_diffusion.ddim_sample_loop(
+            sample_fn, noise.shape, noise, clip_denoised=False, model_kwargs=model_kwargs, progress=False,
+            device=features.device, eta=0.0,
+        )
+    else:
+        samples = action_model.diffusion.p_sample_loop(
+            sample_fn, noise.shape, noise, clip_denoised=False, model_kwargs=model_kwargs, progress=False,
+            device=features.device,
+        )
+    if using_cfg:
+        samples, _ = samples.chunk(2, dim=0)  # drop the unconditioned half
+    return samples
+
+
+def unnormalize_chunk(vla, normalized_actions: np.ndarray, unnorm_key: str) -> np.ndarray:
+    """(T, 7) normalized chunk to robot actions, with the gripper binarized, as in predict_action."""
+    action_norm_stats = vla.get_action_stats(unnorm_key)
+    mask = action_norm_stats.get("mask", np.ones_like(action_norm_stats["q01"], dtype=bool))
+    action_high, action_low = np.array(action_norm_stats["q99"]), np.array(action_norm_stats["q01"])
+    normalized_actions = np.clip(normalized_actions, -1, 1)
+    normalized_actions[:, 6] = np.where(normalized_actions[:, 6] < 0.5, 0, 1)
+    return np.where(
+        mask,
+        0.5 * (normalized_actions + 1) * (action_high - action_low) + action_low,
+        normalized_actions,
+    )
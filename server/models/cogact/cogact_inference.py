@@ -2,29 +2,46 @@
 cogact_policy.py
 
 """
-from collections import deque
-from typing import Optional, Sequence
+from typing import Optional, Sequence, Union
 import os
+import time
 from PIL import Image
 import torch
 import cv2 as cv
 import matplotlib.pyplot as plt
 import numpy as np
 
-from transforms3d.euler import euler2axangle
 from transformers import AutoModelForVision2Seq, AutoProcessor
 
 
 from vla import load_vla
-from sim_cogact.adaptive_ensemble import AdaptiveEnsembler
+from action_head import cognition_features, patch_embeddings, sample_chunks, unnormalize_chunk
+from adaptive_ensemble import AdaptiveEnsembler
+from common.duplicates import forward_or_reuse, remember_outputs, reuse_outputs
+from common.ensemble import AdaptiveEnsemblePool, ensemble_batch
+from common.metrics import metrics
+from common.postprocess import postprocess_actions
+from common.results import fingerprint, result_cache
+from common.sessions import PolicyState, Prefetch
+from common.vision import vision_cache
 
 class CogACTInference:
+    # default unnormalization key, sticky gripper repeats and ensemble horizon of each policy setup;
+    # the ensemble horizon fixes the window size of motion scale between each frame, see appendix in our paper for details
+    POLICY_SETUPS = {
+        "widowx_bridge": {"unnorm_key": "bridge_orig", "sticky_gripper_num_repeat": 1, "action_ensemble_horizon": 7},
+        "google_robot": {"unnorm_key": "fractal20220817_data", "sticky_gripper_num_repeat": 10,
+                         "action_ensemble_horizon": 2},
+    }
+
     def __init__(
         self,
         saved_model_path: str = 'CogACT/CogACT-Base',
         unnorm_key: Optional[str] = None,
         policy_setup: str = "widowx_bridge",
         horizon: int = 0,
+        exec_horizon: int = 1,
+        prefetch_at: Optional[int] = None,
         action_ensemble_horizon: Optional[int] = None,
         image_size: list[int] = [224, 224],
         future_action_window_size: int = 15,
@@ -37,24 +54,17 @@ class CogACTInference:
         use_bf16: bool = True,
         action_ensemble = True,
         adaptive_ensemble_alpha = 0.1,
+        duplicate_frame_threshold: Optional[float] = None,
     ) -> None:
         os.environ["TOKENIZERS_PARALLELISM"] = "false"
-        if policy_setup == "widowx_bridge":
-            unnorm_key = "bridge_orig" if unnorm_key is None else unnorm_key
-            action_ensemble = action_ensemble
-            adaptive_ensemble_alpha = adaptive_ensemble_alpha
-            if action_ensemble_horizon is None:
-                # Set 7 for widowx_bridge to fix the window size of motion scale between each frame. see appendix in our paper for details
-                action_ensemble_horizon = 7
-            self.sticky_gripper_num_repeat = 1
-        elif policy_setup == "google_robot":
-            unnorm_key = "fractal20220817_data" if unnorm_key is None else unnorm_key
-            action_ensemble = action_ensemble
-            adaptive_ensemble_alpha = adaptive_ensemble_alpha
+        if policy_setup in self.POLICY_SETUPS:
+            setup = self.POLICY_SETUPS[policy_setup]
+            unnorm_key = setup["unnorm_key"] if unnorm_key is None else unnorm_key
+            # an explicit ensemble horizon applies to every policy setup
+            self.fixed_action_ensemble_horizon = action_ensemble_horizon
             if action_ensemble_horizon is None:
-                # Set 2 for google_robot to fix the window size of motion scale between each frame. see appendix in our paper for details
-                action_ensemble_horizon = 2
-            self.sticky_gripper_num_repeat = 10
+                action_ensemble_horizon = setup["action_ensemble_horizon"]
+            self.sticky_gripper_num_repeat = setup["sticky_gripper_num_repeat"]
         else:
             raise NotImplementedError(
                 f"Policy setup {policy_setup} not supported for octo models. The other datasets can be found in the huggingface config.json file."
@@ -63,6 +73,8 @@ class CogACTInference:
         self.unnorm_key = unnorm_key
 
         print(f"*** policy_setup: {policy_setup}, unnorm_key: {unnorm_key} ***")
+        # defaults of the diffusion sampling, which sessions can override (configure_sampling);
+        # cfg_scale <= 1 turns classifier-free guidance off, halving the batch of the action head
         self.use_ddim = use_ddim
         self.num_ddim_steps = num_ddim_steps
         self.vla = load_vla(
@@ -74,6 +86,8 @@ class CogACTInference:
           action_dim=action_dim,
         )
         print("Successfully downloaded")
+        # identifies the checkpoint in the result cache
+        self.saved_model_path = saved_model_path
 
         if use_bf16:
             self.vla.vlm = self.vla.vlm.to(torch.bfloat16)
@@ -83,45 +97,116 @@ class CogACTInference:
         self.image_size = image_size
         self.action_scale = action_scale
         self.horizon = horizon
+        # number of actions executed from each predicted chunk before the next forward pass
+        self.exec_horizon = exec_horizon
+        # chunk index at which the next chunk starts being predicted in the background; None disables it
+        self.prefetch_at = prefetch_at
+        # mean absolute difference (0-1) of a frame's thumbnail from that of the last forward's frame up to
+        # which the last chunk is reused instead of a forward pass (common/duplicates.py); None disables it
+        self.duplicate_frame_threshold = duplicate_frame_threshold
         self.action_ensemble = action_ensemble
         self.adaptive_ensemble_alpha = adaptive_ensemble_alpha
         self.action_ensemble_horizon = action_ensemble_horizon
-        self.sticky_action_is_on = False
-        self.gripper_action_repeat = 0
-        self.sticky_gripper_action = 0.0
-        self.previous_gripper_action = None
+        # ring buffers of the ensemblers of all sessions, one pool per ensemble horizon
+        self.ensemble_pools: dict[int, AdaptiveEnsemblePool] = {}
+        # DDIM samplers of the action model by step count; the model keeps only the one it created first
+        self.ddim_samplers: dict[int, object] = {}
+
+        # state used by callers that do not pass their own (single-client mode)
+        self.state = self.new_state()
 
-        self.task_description = None
-        self.image_history = deque(maxlen=self.horizon)
+    def new_state(self, policy_setup: Optional[str] = None, unnorm_key: Optional[str] = None) -> PolicyState:
+        state = PolicyState(image_history_len=self.horizon)
+        self.configure(state, policy_setup, unnorm_key)
+        return state
+
+    def configure(
+        self, state: PolicyState, policy_setup: Optional[str] = None, unnorm_key: Optional[str] = None
+    ) -> None:
+        """
+        Set the policy_setup / unnorm_key of one session on top of the shared weights.
+        Without either, the server defaults are used; with only policy_setup, its default unnorm_key.
+        Raises ValueError for an unsupported setup or a dataset without normalization statistics.
+        """
+        if policy_setup is None and unnorm_key is None:
+            policy_setup, unnorm_key = self.policy_setup, self.unnorm_key
+        policy_setup = self.policy_setup if policy_setup is None else policy_setup
+        if policy_setup not in self.POLICY_SETUPS:
+            raise ValueError(f"Unsupported policy setup: {policy_setup}")
+        setup = self.POLICY_SETUPS[policy_setup]
+        unnorm_key = setup["unnorm_key"] if unnorm_key is None else unnorm_key
+        norm_stats = getattr(self.vla, "norm_stats", None)
+        if norm_stats is not None and unnorm_key not in norm_stats:
+            raise ValueError(f"Unknown unnorm_key: {unnorm_key}")
+        state.policy_setup = policy_setup
+        state.unnorm_key = unnorm_key
+        state.sticky_gripper_num_repeat = setup["sticky_gripper_num_repeat"]
         if self.action_ensemble:
-            self.action_ensembler = AdaptiveEnsembler(self.action_ensemble_horizon, self.adaptive_ensemble_alpha)
+            action_ensemble_horizon = self.fixed_action_ensemble_horizon or setup["action_ensemble_horizon"]
+            pool = self.ensemble_pools.get(action_ensemble_horizon)
+            if pool is None:
+                pool = AdaptiveEnsemblePool(action_ensemble_horizon, self.adaptive_ensemble_alpha)
+                self.ensemble_pools[action_ensemble_horizon] = pool
+            state.action_ensembler = AdaptiveEnsembler(action_ensemble_horizon, self.adaptive_ensemble_alpha, pool=pool)
         else:
-            self.action_ensembler = None
-        self.num_image_history = 0
+            state.action_ensembler = None
 
-    def _add_image_to_history(self, image: np.ndarray) -> None:
-        self.image_history.append(image)
-        self.num_image_history = min(self.num_image_history + 1, self.horizon)
+    def configure_sampling(
+        self,
+        state: PolicyState,
+        cfg_scale: Optional[float] = None,
+        use_ddim: Optional[bool] = None,
+        num_ddim_steps: Optional[int] = None,
+    ) -> None:
+        """
+        Override the diffusion sampling parameters of one session; None keeps the current value.
+        Raises ValueError for a step count below 1 or a negative cfg_scale.
+        """
+        self.check_sampling(cfg_scale, num_ddim_steps)
+        updates = {"cfg_scale": cfg_scale, "use_ddim": use_ddim, "num_ddim_steps": num_ddim_steps}
+        state.sampling.update({key: value for key, value in updates.items() if value is not None})
 
-    def reset(self, task_description: str) -> None:
-        self.task_description = task_description
-        self.image_history.clear()
-        if self.action_ensemble:
-            self.action_ensembler.reset()
-        self.num_image_history = 0
+    @staticmethod
+    def check_sampling(cfg_scale: Optional[float] = None, num_ddim_steps: Optional[int] = None) -> None:
+        """Raise ValueError for a DDIM step count below 1 or a negative cfg_scale (None is not checked)."""
+        if num_ddim_steps is not None and num_ddim_steps < 1:
+            raise ValueError(f"num_ddim_steps must be at least 1, got {num_ddim_steps}")
+        if cfg_scale is not None and cfg_scale < 0:
+            raise ValueError(f"cfg_scale must not be negative, got {cfg_scale}")
+
+    def sampling(self, state: PolicyState) -> dict:
+        """cfg_scale, use_ddim and num_ddim_steps of the session: its overrides over the server defaults."""
+        defaults = {"cfg_scale": self.cfg_scale, "use_ddim": self.use_ddim, "num_ddim_steps": self.num_ddim_steps}
+        return {**defaults, **state.sampling}
+
+    def _select_ddim_sampler(self, num_ddim_steps: int) -> None:
+        """
+        Point the action model at the DDIM sampler for ``num_ddim_steps``. predict_action creates the
+        sampler on its first call only and ignores the step count afterwards, so one is kept per count.
+        """
+        action_model = self.vla.action_model
+        sampler = self.ddim_samplers.get(num_ddim_steps)
+        if sampler is None:
+            action_model.create_ddim(ddim_step=num_ddim_steps)
+            sampler = self.ddim_samplers[num_ddim_steps] = action_model.ddim_diffusion
+        action_model.ddim_diffusion = sampler
+
+    def _add_image_to_history(self, image: np.ndarray, state: PolicyState) -> None:
+        state.image_history.append(image)
+        state.num_image_history = min(state.num_image_history + 1, self.horizon)
 
-        self.sticky_action_is_on = False
-        self.gripper_action_repeat = 0
-        self.sticky_gripper_action = 0.0
-        self.previous_gripper_action = None
+    def reset(self, task_description: str, state: Optional[PolicyState] = None) -> None:
+        state = self.state if state is None else state
+        state.reset(task_description)
 
     def step(
-        self, image: np.ndarray, task_description: Optional[str] = None, *args, **kwargs
+        self, image: np.ndarray, task_description: Optional[str] = None, *args, state: Optional[PolicyState] = None, **kwargs
     ) -> tuple[dict[str, np.ndarray], dict[str, np.ndarray]]:
         """
         Input:
             image: np.ndarray of shape (H, W, 3), uint8
             task_description: Optional[str], task description; if different from previous task description, policy state is reset
+            state: Optional[PolicyState], per-session policy state; defaults to self.state
         Output:
             raw_action: dict; raw policy action output
             action: dict; processed action to be sent to the maniskill2 environment, with the following keys:
@@ -130,72 +215,176 @@ class CogACTInference:
                 - 'gripper': np.ndarray of shape (1,), gripper action
                 - 'terminate_episode': np.ndarray of shape (1,), 1 if episode should be terminated, 0 otherwise
         """
+        state = self.state if state is None else state
+        inputs = self.preprocess(image, task_description, state)
+        if isinstance(inputs, Prefetch):
+            if inputs.result is None:
+                # nothing runs in the background here: predict now, use it at the chunk boundary
+                inputs.result = self.forward_batch([inputs.inputs])[0]
+                raw_actions = None
+            else:
+                raw_actions = inputs.result
+        else:
+            raw_actions = None if inputs is None else forward_or_reuse(self.forward_batch, [inputs])[0]
+        return self.postprocess(raw_actions, state)
+
+    def preprocess(
+        self, image: np.ndarray, task_description: Optional[str], state: PolicyState
+    ) -> Union[dict, Prefetch, None]:
+        """
+        CPU stage of step: reset on a new task, update the image history and build the model inputs.
+        Returns None while the next action comes from the cached chunk (see exec_horizon), and
+        a Prefetch when the next chunk is predicted ahead of time (see prefetch_at), and a Reuse of
+        the last chunk for a near-duplicate frame (see duplicate_frame_threshold).
+        """
         if task_description is not None:
-            if task_description != self.task_description:
-                self.reset(task_description)
+            if task_description != state.task_description:
+                self.reset(task_description, state)
 
         assert image.dtype == np.uint8
-        self._add_image_to_history(self._resize_image(image))
+        with metrics.span("resize"):
+            self._add_image_to_history(self._resize_image(image), state)
+        if self._chunk_is_cached(state):
+            if self._should_prefetch(state):
+                state.prefetch = Prefetch(self._model_inputs(image, state), state.chunk_step + 1)
+                return state.prefetch
+            return None
+        if state.prefetch is not None:
+            return state.prefetch
+        reuse = reuse_outputs(image, state, self.duplicate_frame_threshold)
+        if reuse is not None:
+            return reuse
+        return self._model_inputs(image, state)
+
+    def _model_inputs(self, image: np.ndarray, state: PolicyState) -> dict:
+        sampling = self.sampling(state)
+        cache_key = None
+        if result_cache.enabled:
+            cache_key = fingerprint(self.saved_model_path, state.unnorm_key, state.task_description, image,
+                                    sorted(sampling.items()))
+        image_key = fingerprint(self.saved_model_path, image) if vision_cache.enabled else None
         image: Image.Image = Image.fromarray(image)
-        raw_actions, normalized_actions = self.vla.predict_action(image=image,
-                                                                instruction=self.task_description,
-                                                                unnorm_key=self.unnorm_key,
-                                                                do_sample=False,
-                                                                cfg_scale=self.cfg_scale,
-                                                                use_ddim=self.use_ddim,
-                                                                num_ddim_steps=self.num_ddim_steps,
-                                                                )
+        return {"image": image, "instruction": state.task_description, "unnorm_key": state.unnorm_key,
+                **sampling, "cache_key": cache_key, "image_key": image_key}
 
-        if self.action_ensemble:
-            raw_actions = self.action_ensembler.ensemble_action(raw_actions)[None]
-        raw_action = {
-            "world_vector": np.array(raw_actions[0, :3]),
-            "rotation_delta": np.array(raw_actions[0, 3:6]),
-            "open_gripper": np.array(raw_actions[0, 6:7]),  # range [0, 1]; 1 = open; 0 = close
-        }
-
-        # process raw_action to obtain the action to be sent to the maniskill2 environment
-        action = {}
-        action["world_vector"] = raw_action["world_vector"] * self.action_scale
-        action_rotation_delta = np.asarray(raw_action["rotation_delta"], dtype=np.float64)
-
-        roll, pitch, yaw = action_rotation_delta
-        axes, angles = euler2axangle(roll, pitch, yaw)
-        action_rotation_axangle = axes * angles
-        action["rot_axangle"] = action_rotation_axangle * self.action_scale
-
-        if self.policy_setup == "google_robot":
-            action["gripper"] = 0
-            current_gripper_action = raw_action["open_gripper"]
-            if self.previous_gripper_action is None:
-                relative_gripper_action = np.array([0])
-                self.previous_gripper_action = current_gripper_action
-            else:
-                relative_gripper_action = self.previous_gripper_action - current_gripper_action
-            # fix a bug in the SIMPLER code here
-            # self.previous_gripper_action = current_gripper_action
+    def forward_batch(self, inputs: Sequence[dict]) -> list[np.ndarray]:
+        """
+        GPU stage of step: one (future_action_window_size + 1, 7) raw action chunk per input. For
+        several inputs (or with the vision cache) the VLM runs per input and the action head once per
+        sampler setting (action_head.py).
+        """
+        if len(inputs) == 1 and not vision_cache.enabled:
+            x = inputs[0]
+            with metrics.span("predict_action"):
+                if x["use_ddim"]:
+                    self._select_ddim_sampler(x["num_ddim_steps"])
+                raw_actions, normalized_actions = self.vla.predict_action(image=x["image"],
+                                                                        instruction=x["instruction"],
+                                                                        unnorm_key=x["unnorm_key"],
+                                                                        do_sample=False,
+                                                                        cfg_scale=x["cfg_scale"],
+                                                                        use_ddim=x["use_ddim"],
+                                                                        num_ddim_steps=x["num_ddim_steps"],
+                                                                        )
+            return [raw_actions]
+
+        with metrics.span("cognition"):
+            patches = [None] * len(inputs)
+            if vision_cache.enabled:
+                patches = vision_cache.embeddings(
+                    [x["image_key"] for x in inputs],
+                    lambda rows: patch_embeddings(self.vla, [inputs[i]["image"] for i in rows]),
+                )
+            features = torch.cat([
+                cognition_features(self.vla, x["image"], x["instruction"], x_patches)
+                for x, x_patches in zip(inputs, patches)
+            ])
+        action_model = self.vla.action_model
+        # the noise of every session is drawn on its own, as predict_action would
+        noise = torch.cat([
+            torch.randn(1, self.vla.future_action_window_size + 1, action_model.in_channels, device=features.device)
+            for _ in inputs
+        ])
+        # sessions sharing guidance on/off and the sampler are denoised together
+        groups: dict[tuple, list[int]] = {}
+        for i, x in enumerate(inputs):
+            key = (x["cfg_scale"] > 1.0, x["use_ddim"], x["num_ddim_steps"] if x["use_ddim"] else None)
+            groups.setdefault(key, []).append(i)
+        outputs = [None] * len(inputs)
+        for (_, use_ddim, num_ddim_steps), rows in groups.items():
+            with metrics.span("action_head"):
+                samples = sample_chunks(
+                    action_model,
+                    features[rows],
+                    noise[rows],
+                    [inputs[i]["cfg_scale"] for i in rows],
+                    use_ddim,
+                    select_ddim=lambda: self._select_ddim_sampler(num_ddim_steps),
+                ).float().cpu().numpy()
+            metrics.observe("action_head_batch_size", len(rows))
+            for i, normalized_actions in zip(rows, samples):
+                outputs[i] = unnormalize_chunk(self.vla, normalized_actions, inputs[i]["unnorm_key"])
+        return outputs
 
-            if np.abs(relative_gripper_action) > 0.5 and (not self.sticky_action_is_on):
-                self.sticky_action_is_on = True
-                self.sticky_gripper_action = relative_gripper_action
-                self.previous_gripper_action = current_gripper_action
+    def postprocess(
+        self, raw_actions: Optional[np.ndarray], state: PolicyState
+    ) -> tuple[dict[str, np.ndarray], dict[str, np.ndarray]]:
+        """
+        CPU stage of step: ensembling and gripper post-processing of a raw action chunk.
+        ``raw_actions`` None means the step is served from the cached chunk of the session.
+        """
+        return self.postprocess_batch([raw_actions], [state])[0]
 
-            if self.sticky_action_is_on:
-                self.gripper_action_repeat += 1
-                relative_gripper_action = self.sticky_gripper_action
+    def postprocess_batch(
+        self, outputs: Sequence[Optional[np.ndarray]], states: Sequence[PolicyState]
+    ) -> list[tuple[dict[str, np.ndarray], dict[str, np.ndarray]]]:
+        """postprocess for a batch of sessions; the gripper logic is vectorized (common/postprocess.py)."""
+        for raw_actions, state in zip(outputs, states):
+            if state.prefetch is None:
+                # predicted from the frame of this step (a prefetched chunk is not reused for near-duplicates)
+                remember_outputs(raw_actions, state, lambda chunk: chunk[0])
+        chunks = [self._current_chunk(raw_actions, state) for raw_actions, state in zip(outputs, states)]
+        if self.action_ensemble:
+            # sessions sharing an ensemble pool are ensembled in one vectorized call
+            actions = np.stack(ensemble_batch([state.action_ensembler for state in states], chunks))
+        else:
+            actions = np.stack([chunk[0] for chunk in chunks])
+        # sticky gripper with the reference action held until a sticky action triggers
+        return postprocess_actions(actions, states, self.action_scale, hold_previous_gripper=True)
 
-            if self.gripper_action_repeat == self.sticky_gripper_num_repeat:
-                self.sticky_action_is_on = False
-                self.gripper_action_repeat = 0
-                self.sticky_gripper_action = 0.0
+    def _current_chunk(self, raw_actions: Optional[np.ndarray], state: PolicyState) -> np.ndarray:
+        """The part of the new or cached chunk that starts at the current timestep."""
+        if raw_actions is None:
+            state.chunk_step += 1
+        elif state.prefetch is not None:
+            # the chunk was predicted from an earlier frame: skip the actions of the steps taken since
+            age = state.chunk_step + 1 - state.prefetch.chunk_step
+            self._observe_frame_age(age, time.monotonic() - state.prefetch.created)
+            state.action_chunk = raw_actions
+            state.chunk_step = state.chunk_start = min(age, len(raw_actions) - 1)
+            state.prefetch = None
+        else:
+            state.action_chunk = raw_actions
+            state.chunk_step = state.chunk_start = 0
+        return state.action_chunk[state.chunk_step:]
 
-            action["gripper"] = relative_gripper_action
+    def _chunk_is_cached(self, state: PolicyState) -> bool:
+        """Whether the next action can be taken open-loop from the last predicted chunk."""
+        if state.action_chunk is None:
+            return False
+        # exec_horizon steps from the first one served out of the chunk, so a forward runs every exec_horizon steps
+        return state.chunk_step + 1 < min(state.chunk_start + self.exec_horizon, len(state.action_chunk))
 
-        elif self.policy_setup == "widowx_bridge":
-            action["gripper"] = 2.0 * (raw_action["open_gripper"] > 0.5) - 1.0
+    def _should_prefetch(self, state: PolicyState) -> bool:
+        """Whether to start predicting the next chunk from the frame of this (cached) step."""
+        if self.prefetch_at is None or state.prefetch is not None:
+            return False
+        return state.chunk_step + 1 - state.chunk_start >= self.prefetch_at
 
-        action["terminate_episode"] = np.array([0.0])
-        return raw_action, action
+    def _observe_frame_age(self, steps: int, seconds: float) -> None:
+        """Report how stale the frame that conditioned a prefetched chunk is when the chunk is used."""
+        metrics.observe("prefetch_frame_age_steps", steps)
+        metrics.observe("prefetch_frame_age_seconds", seconds)
 
     def _resize_image(self, image: np.ndarray) -> np.ndarray:
         image = cv.resize(image, tuple(self.image_size), interpolation=cv.INTER_AREA)
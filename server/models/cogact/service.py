@@ -1,25 +1,55 @@
-from fastapi import FastAPI, File, UploadFile, Form, HTTPException
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi import FastAPI, File, UploadFile, Form, HTTPException, Request, WebSocket
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, Response
 from pydantic import BaseModel
 from typing import Optional, List
 import numpy as np
 import io
+import os
 import json
 from PIL import Image
 from transforms3d.euler import euler2axangle
 
 from cogact_inference import CogACTInference
+from common.metrics import metrics, start_trace, server_timing
+from common.sessions import PolicyState, SessionStore
+from common.protocol import (
+    carried_state, configure_sampling, configure_state, ndjson_response, read_carried_state, read_reset_request,
+    read_step_batch_request, read_step_request,
+)
+from common.responses import response_encoder
+from common.states import STATE_HEADER
+from common.streaming import serve_control_loop
+from common.worker import InferenceWorker
 
 app = FastAPI()
 # Instantiate a single global inference engine
-inference = CogACTInference(policy_setup='google_robot')
+inference = CogACTInference(
+    policy_setup='google_robot',
+    exec_horizon=int(os.environ.get("EXEC_HORIZON", 1)),
+    prefetch_at=int(os.environ["PREFETCH_AT"]) if os.environ.get("PREFETCH_AT") else None,
+    duplicate_frame_threshold=(
+        float(os.environ["DUPLICATE_FRAME_THRESHOLD"]) if os.environ.get("DUPLICATE_FRAME_THRESHOLD") else None
+    ),
+)
+# Per-episode policy state, keyed by the session id returned from /reset
+sessions = SessionStore(
+    inference.new_state,
+    ttl=float(os.environ.get("SESSION_TTL", 600)),
+    max_sessions=int(os.environ.get("MAX_SESSIONS", 64)),
+)
 
 class UpdateParams(BaseModel):
-    horizon: Optional[int]
-    pred_action_horizon: Optional[int]
-    exec_horizon: Optional[int]
-    image_size: Optional[List[int]]
-    action_scale: Optional[float]
+    horizon: Optional[int] = None
+    pred_action_horizon: Optional[int] = None
+    exec_horizon: Optional[int] = None
+    prefetch_at: Optional[int] = None
+    image_size: Optional[List[int]] = None
+    action_scale: Optional[float] = None
+    duplicate_frame_threshold: Optional[float] = None
+    # server defaults of the diffusion sampling, sessions can override them
+    cfg_scale: Optional[float] = None
+    use_ddim: Optional[bool] = None
+    num_ddim_steps: Optional[int] = None
 
 @app.get("/ping")
 def ping():
@@ -34,44 +64,183 @@ def update_inference_parameters(params: UpdateParams):
     updates = params.dict(exclude_none=True)
     if not updates:
         raise HTTPException(status_code=400, detail="No parameters provided to update.")
+    try:
+        # the same checks as the per-session overrides, before anything is applied
+        inference.check_sampling(params.cfg_scale, params.num_ddim_steps)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
     for key, value in updates.items():
         if not hasattr(inference, key):
             raise HTTPException(status_code=400, detail=f"Invalid parameter: {key}")
         setattr(inference, key, value)
     return JSONResponse(content={"status": "success", "updated": updates})
 
+def get_state(session_id: Optional[str]):
+    """Resolve a session id to its policy state; no id means the shared single-client state."""
+    if session_id is None:
+        return inference.state
+    try:
+        return sessions.get(session_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Unknown or expired session: {session_id}")
+
 class ResetRequest(BaseModel):
     task_description: str
+    session_id: Optional[str] = None
+    # robot setup of the session on top of the loaded weights; defaults to the server's
+    policy_setup: Optional[str] = None
+    unnorm_key: Optional[str] = None
+    # diffusion sampling of the session; defaults to the server's
+    cfg_scale: Optional[float] = None
+    use_ddim: Optional[bool] = None
+    num_ddim_steps: Optional[int] = None
+    # keep nothing on the server: the state is returned to the client, which sends it with every /step
+    stateless: bool = False
+
+class SamplingParams(BaseModel):
+    session_id: Optional[str] = None
+    cfg_scale: Optional[float] = None
+    use_ddim: Optional[bool] = None
+    num_ddim_steps: Optional[int] = None
 
 @app.post("/reset")
-def reset(task_description: Optional[str] = Form(None),):
+async def reset(request: Request):
+    """
+    Reset the inference state with a new task description, given as JSON or as form fields.
+    Without a session_id a new session is started (and the shared state is reset for
+    clients that ignore sessions); pass the returned session_id to /step.
+    policy_setup / unnorm_key switch the robot setup of the session without reloading weights,
+    cfg_scale / use_ddim / num_ddim_steps set its diffusion sampling (see /update_session_parameters).
+    With stateless=true no session is kept; the response carries the initial policy state
+    for the X-Policy-State header of the first /step.
+    """
+    req = await read_reset_request(request, ResetRequest)
+    overrides = (req.cfg_scale, req.use_ddim, req.num_ddim_steps)
+    if req.stateless:
+        session_id, state = None, inference.new_state()
+    elif req.session_id is None:
+        # validated on the shared state first, so a bad setup does not leave a session behind
+        configure_state(inference, inference.state, req.policy_setup, req.unnorm_key)
+        configure_sampling(inference, PolicyState(), *overrides)
+        session_id, state = sessions.create()
+        inference.reset(req.task_description)
+    else:
+        session_id, state = req.session_id, get_state(req.session_id)
+    configure_state(inference, state, req.policy_setup, req.unnorm_key)
+    configure_sampling(inference, state, *overrides)
+    inference.reset(req.task_description, state)
+    result = {
+        "status": "reset",
+        "task_description": req.task_description,
+        "session_id": session_id,
+        "policy_setup": state.policy_setup,
+        "unnorm_key": state.unnorm_key,
+        "sampling": inference.sampling(state),
+    }
+    if req.stateless:
+        result["state"] = carried_state(inference, state)
+    return result
+
+@app.post("/update_session_parameters")
+def update_session_parameters(params: SamplingParams):
     """
-    Reset the inference state with a new task description.
+    Change the diffusion sampling of one session from its next forward pass on, without
+    resetting the episode: the DDIM step count, cfg_scale (<= 1 turns classifier-free
+    guidance off) and use_ddim. Unset fields keep their value.
     """
-    inference.reset(task_description)
-    return {"status": "reset", "task_description": task_description}
+    state = get_state(params.session_id)
+    configure_sampling(inference, state, params.cfg_scale, params.use_ddim, params.num_ddim_steps)
+    return {"session_id": params.session_id, "sampling": inference.sampling(state)}
+
+def np_to_list(d):
+    # Convert numpy arrays to lists for JSON serialization
+    return {k: v.tolist() for k, v in d.items()}
+
+def step_payload(raw_action: dict, action: dict) -> dict:
+    return {"raw_action": np_to_list(raw_action), "action": np_to_list(action)}
+
+# Staged step pipeline: preprocessing on a thread pool, one forward for concurrent sessions
+# (the action head sampled as a batch) on the device thread, post-processing and serialization after it
+worker = InferenceWorker(
+    inference,
+    serialize=step_payload,
+    preprocess_workers=int(os.environ.get("PREPROCESS_WORKERS", 2)),
+    max_batch_size=int(os.environ.get("MAX_BATCH_SIZE", 8)),
+    max_wait_ms=float(os.environ.get("MAX_BATCH_WAIT_MS", 5)),
+)
+
+async def run_step(image: np.ndarray, task_description: Optional[str], state) -> dict:
+    return await worker.step(image, task_description, state)
+
+metrics.gauge("sessions_active", lambda: len(sessions))
+metrics.gauge("queue_depth", worker.device.qsize)
+metrics.gauge("session_steps", lambda: {(("session", sid),): state.num_steps for sid, state in sessions.items()})
 
 @app.post("/step")
-async def step(
+async def step(request: Request):
+    """
+    Run one inference step on an uploaded image. Returns raw_action and processed action.
+    Accepts the multipart form (file, task_description, session_id) or a binary frame
+    with Content-Type application/octet-stream (see common/frames.py). The query parameters
+    format (json / flat / msgpack / raw) and fields (raw_action,action) select a compact
+    response, see common/responses.py. A stateless client (reset with stateless=true) sends its
+    policy state in the X-Policy-State header instead of a session_id and gets the updated
+    state back in the same header, see common/states.py.
+    """
+    trace = start_trace()
+    frame = await read_step_request(request)
+    encode = response_encoder(request)
+    carried = read_carried_state(inference, request)
+    state = get_state(frame.session_id) if carried is None else carried
+
+    body = await worker.step(frame.image, frame.task_description, state, serialize=encode)
+    response = Response(body, media_type=encode.media_type)
+    if carried is not None:
+        response.headers[STATE_HEADER] = carried_state(inference, carried)
+    response.headers["Server-Timing"] = server_timing(trace)
+    return response
+
+@app.post("/step_batch")
+async def step_batch(
+    files: List[UploadFile] = File(...),
     task_description: Optional[str] = Form(None),
-    file: UploadFile = File(...)
+    task_descriptions: Optional[str] = Form(None),
+    session_id: Optional[str] = Form(None),
+    sequential: bool = Form(False),
 ):
     """
-    Run one inference step on an uploaded image. Returns raw_action and processed action.
+    Run N frames in one request, e.g. for offline evaluation or replay. Prompts are the shared
+    task_description or task_descriptions, a JSON list with one per frame; one frame with several
+    task_descriptions evaluates every prompt on that frame. By default every
+    frame is an independent step with a fresh state; with sequential=true the frames are
+    consecutive steps of one episode (of session_id if given). Results stream back as NDJSON
+    lines {"index", "raw_action", "action"}: in frame order when sequential, else as they complete.
     """
-    contents = await file.read()
-    try:
-        image = np.array(Image.open(io.BytesIO(contents)).convert("RGB"))
-    except Exception:
-        raise HTTPException(status_code=400, detail="Invalid image file.")
-    print(task_description)
+    images, prompts = await read_step_batch_request(files, task_description, task_descriptions)
+    if not (sequential and session_id is not None) and None in prompts:
+        raise HTTPException(status_code=400, detail="Every frame needs a task description without a session.")
 
-    raw_action, action = inference.step(image, task_description)
+    if sequential:
+        state = inference.new_state() if session_id is None else get_state(session_id)
+        results = worker.step_sequence(images, prompts, state)
+    else:
+        results = worker.step_independent(
+            [(image, prompt, inference.new_state()) for image, prompt in zip(images, prompts)]
+        )
+    return ndjson_response(results)
 
-    def np_to_list(d):
-        return {k: v.tolist() for k, v in d.items()}
+@app.get("/metrics")
+def get_metrics():
+    """Prometheus text exposition of stage latencies, batch sizes, queue depth and sessions."""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
 
-    return {"raw_action": np_to_list(raw_action), "action": np_to_list(action)}
+@app.websocket("/ws")
+async def control_loop(websocket: WebSocket):
+    """
+    Streaming control loop: one connection per episode, JSON reset commands and
+    binary frames in, /step payloads out in order (see common/streaming.py).
+    """
+    await serve_control_loop(websocket, sessions, inference, run_step)
 
 @app.post("/visualize_epoch")
 async def visualize_epoch(
@@ -2,14 +2,28 @@ from typing import Optional, Sequence
 import os
 import matplotlib.pyplot as plt
 import numpy as np
-from transforms3d.euler import euler2axangle
 from transformers import AutoModelForVision2Seq, AutoProcessor
 from PIL import Image
 import torch
 import cv2 as cv
 
+from common.duplicates import forward_or_reuse, frame_change, frame_signature, remember_outputs, reuse_outputs
+from common.metrics import metrics
+from common.postprocess import postprocess_actions
+from common.results import fingerprint, result_cache
+from common.sessions import PolicyState
+from common.vision import vision_cache
+from common.prismatic import EMPTY_TOKEN_ID, generate_batch, decode_action_tokens, process_inputs
+from ecot_reasoning import ReasoningBudget, check_sections
+
 
 class EcoTInference:
+    # default unnormalization key and sticky gripper repeats of each policy setup
+    POLICY_SETUPS = {
+        "widowx_bridge": {"unnorm_key": "bridge_orig", "sticky_gripper_num_repeat": 1},
+        "google_robot": {"unnorm_key": "fractal20220817_data", "sticky_gripper_num_repeat": 15},
+    }
+
     def __init__(
         self,
         saved_model_path: str = "Embodied-CoT/ecot-openvla-7b-bridge",
@@ -20,15 +34,18 @@ class EcoTInference:
         exec_horizon: int = 1,
         image_size: list[int] = [224, 224],
         action_scale: float = 1.0,
+        max_new_tokens: int = 1024,
+        reasoning_interval: int = 1,
+        reasoning_change_threshold: Optional[float] = None,
+        max_reasoning_tokens: Optional[int] = None,
+        reasoning_sections: Optional[list[str]] = None,
+        duplicate_frame_threshold: Optional[float] = None,
     ) -> None:
         os.environ["TOKENIZERS_PARALLELISM"] = "false"
         # set default unnormalization key and sticky gripper repeats
-        if policy_setup == "widowx_bridge":
-            unnorm_key = "bridge_orig" if unnorm_key is None else unnorm_key
-            self.sticky_gripper_num_repeat = 1
-        elif policy_setup == "google_robot":
-            unnorm_key = "fractal20220817_data" if unnorm_key is None else unnorm_key
-            self.sticky_gripper_num_repeat = 15
+        if policy_setup in self.POLICY_SETUPS:
+            unnorm_key = self.POLICY_SETUPS[policy_setup]["unnorm_key"] if unnorm_key is None else unnorm_key
+            self.sticky_gripper_num_repeat = self.POLICY_SETUPS[policy_setup]["sticky_gripper_num_repeat"]
         else:
             raise NotImplementedError(f"Unsupported policy setup: {policy_setup}")
         self.policy_setup = policy_setup
@@ -37,6 +54,8 @@ class EcoTInference:
         print(f"*** policy_setup: {policy_setup}, unnorm_key: {unnorm_key} ***")
         # load processor and model
         self.processor = AutoProcessor.from_pretrained(saved_model_path, trust_remote_code=True)
+        # identifies the tokenizer in the prompt cache
+        self.saved_model_path = saved_model_path
         self.model = AutoModelForVision2Seq.from_pretrained(
             saved_model_path,
             attn_implementation="sdpa",
@@ -51,93 +70,245 @@ class EcoTInference:
         self.horizon = horizon
         self.pred_action_horizon = pred_action_horizon
         self.exec_horizon = exec_horizon
+        # upper bound on reasoning + action tokens generated per step
+        self.max_new_tokens = max_new_tokens
+        # the chain-of-thought of a session is generated every reasoning_interval steps (1 = every step);
+        # in between only the action tokens are decoded, conditioned on the cached reasoning
+        self.reasoning_interval = reasoning_interval
+        # mean absolute difference (0-1) of a downscaled gray frame from the one the reasoning was
+        # generated on, above which it is regenerated early; None disables the check
+        self.reasoning_change_threshold = reasoning_change_threshold
+        # reasoning budget per step (ecot_reasoning.py): a cap on the reasoning tokens and the
+        # sections to generate, e.g. ["plan", "move"]; None leaves either unlimited
+        check_sections(reasoning_sections)
+        self.max_reasoning_tokens = max_reasoning_tokens
+        self.reasoning_sections = reasoning_sections
+        self._budget: Optional[ReasoningBudget] = None
+        # mean absolute difference (0-1) of a frame's thumbnail from that of the last forward's frame up to
+        # which the last outputs are reused instead of a forward pass (common/duplicates.py); None disables it
+        self.duplicate_frame_threshold = duplicate_frame_threshold
+
+        # default gripper and task state for callers without a session
+        self.state = self.new_state()
+
+    def new_state(self, policy_setup: Optional[str] = None, unnorm_key: Optional[str] = None) -> PolicyState:
+        state = PolicyState()
+        self.configure(state, policy_setup, unnorm_key)
+        return state
+
+    def configure(
+        self, state: PolicyState, policy_setup: Optional[str] = None, unnorm_key: Optional[str] = None
+    ) -> None:
+        """
+        Set the policy_setup / unnorm_key of one session on top of the shared weights.
+        Without either, the server defaults are used; with only policy_setup, its default unnorm_key.
+        Raises ValueError for an unsupported setup or a dataset without normalization statistics.
+        """
+        if policy_setup is None and unnorm_key is None:
+            policy_setup, unnorm_key = self.policy_setup, self.unnorm_key
+        policy_setup = self.policy_setup if policy_setup is None else policy_setup
+        if policy_setup not in self.POLICY_SETUPS:
+            raise ValueError(f"Unsupported policy setup: {policy_setup}")
+        setup = self.POLICY_SETUPS[policy_setup]
+        unnorm_key = setup["unnorm_key"] if unnorm_key is None else unnorm_key
+        norm_stats = getattr(self.model, "norm_stats", None)
+        if norm_stats is not None and unnorm_key not in norm_stats:
+            raise ValueError(f"Unknown unnorm_key: {unnorm_key}")
+        state.policy_setup = policy_setup
+        state.unnorm_key = unnorm_key
+        state.sticky_gripper_num_repeat = setup["sticky_gripper_num_repeat"]
 
-        # initial gripper and task state
-        self.sticky_action_is_on = False
-        self.gripper_action_repeat = 0
-        self.sticky_gripper_action = 0.0
-        self.previous_gripper_action = None
-        self.task_description = None
-        self.num_image_history = 0
-
-    def reset(self, task_description: str) -> None:
-        self.task_description = task_description
-        self.num_image_history = 0
-        self.sticky_action_is_on = False
-        self.gripper_action_repeat = 0
-        self.sticky_gripper_action = 0.0
-        self.previous_gripper_action = None
+    def reset(self, task_description: str, state: Optional[PolicyState] = None) -> None:
+        state = self.state if state is None else state
+        state.reset(task_description)
 
     def step(
         self,
         image: np.ndarray,
         task_description: Optional[str] = None,
         *args,
+        state: Optional[PolicyState] = None,
         **kwargs,
     ) -> tuple[dict[str, np.ndarray], dict[str, np.ndarray]]:
+        state = self.state if state is None else state
+        inputs = self.preprocess(image, task_description, state)
+        outputs = forward_or_reuse(self.forward_batch, [inputs])[0]
+        return self.postprocess(outputs, state)
+
+    def step_batch(
+        self,
+        images: Sequence[np.ndarray],
+        task_descriptions: Sequence[Optional[str]],
+        states: Sequence[Optional[PolicyState]],
+    ) -> list[tuple[dict[str, np.ndarray], dict[str, np.ndarray]]]:
+        # one padded forward + greedy decode of reasoning and action tokens for all frames
+        states = [self.state if state is None else state for state in states]
+        inputs = [self.preprocess(*item) for item in zip(images, task_descriptions, states)]
+        outputs = forward_or_reuse(self.forward_batch, inputs)
+        return self.postprocess_batch(outputs, states)
+
+    def preprocess(self, image: np.ndarray, task_description: Optional[str], state: PolicyState):
         # reset if new task
-        if task_description is not None and task_description != self.task_description:
-            self.reset(task_description)
+        if task_description is not None and task_description != state.task_description:
+            self.reset(task_description, state)
 
         assert image.dtype == np.uint8, "Expected uint8 image"
-        image = self._resize_image(image)
+        with metrics.span("resize"):
+            image = self._resize_image(image)
+        reuse = reuse_outputs(image, state, self.duplicate_frame_threshold)
+        if reuse is not None:
+            return reuse
         img_pil = Image.fromarray(image)
 
         # prepare inputs
-        inputs = self.processor(task_description, img_pil).to("cuda:0", dtype=torch.bfloat16)
-        # predict: EcoT returns (actions, reasoning_ids)
-        result = self.model.predict_action(
-            **inputs, unnorm_key=self.unnorm_key, do_sample=False
-        )
-        # unpack tuple if chain-of-thought is returned
-        if isinstance(result, tuple) or isinstance(result, list):
-            raw_actions_array, reasoning_ids = result
-        else:
-            raw_actions_array = result
-        # ensure numpy array
-        raw_actions_array = np.array(raw_actions_array)
-        # add batch dim
-        batched = raw_actions_array[None]
-
-        # build raw_action dict
-        raw_action = {
-            "world_vector": batched[0, :3],
-            "rotation_delta": batched[0, 3:6],
-            "open_gripper": batched[0, 6:7],
-        }
-
-        # process world motion
-        action = {}
-        action["world_vector"] = raw_action["world_vector"] * self.action_scale
-        r, p, y = raw_action["rotation_delta"].astype(np.float64)
-        ax, ang = euler2axangle(r, p, y)
-        action["rot_axangle"] = (ax * ang) * self.action_scale
-
-        # gripper logic
-        if self.policy_setup == "google_robot":
-            current = raw_action["open_gripper"]
-            if self.previous_gripper_action is None:
-                rel = np.array([0.0])
+        with metrics.span("processor"):
+            inputs = process_inputs(self.processor, self.saved_model_path, state.task_description, state.unnorm_key,
+                                    img_pil)
+            inputs = inputs.to("cuda:0", dtype=torch.bfloat16)
+        reasoning_ids = self._cached_reasoning(image, state)
+        cache_key = None
+        if result_cache.enabled:
+            # everything that shapes the generated reasoning and actions
+            cache_key = fingerprint(self.saved_model_path, state.unnorm_key, state.task_description, image,
+                                    reasoning_ids, self.reasoning_interval > 1, self.max_new_tokens,
+                                    self.max_reasoning_tokens, self.reasoning_sections)
+        image_key = fingerprint(self.saved_model_path, image) if vision_cache.enabled else None
+        return {"inputs": inputs, "unnorm_key": state.unnorm_key, "reasoning_ids": reasoning_ids,
+                "cache_key": cache_key, "image_key": image_key}
+
+    def _cached_reasoning(self, image: np.ndarray, state: PolicyState) -> Optional[torch.Tensor]:
+        """The reasoning ids to condition this step on, or None to generate the reasoning anew."""
+        if self.reasoning_interval <= 1:
+            return None
+        scene = frame_signature(image)
+        reuse = state.reasoning_ids is not None and state.reasoning_steps < self.reasoning_interval
+        if reuse and self.reasoning_change_threshold is not None:
+            reuse = frame_change(scene, state.reasoning_scene) <= self.reasoning_change_threshold
+        if not reuse:
+            state.reasoning_scene = scene
+            state.reasoning_steps = 1
+            metrics.inc("reasoning_generated")
+            return None
+        state.reasoning_steps += 1
+        metrics.inc("reasoning_reused")
+        return state.reasoning_ids
+
+    def reasoning(self, state: PolicyState) -> Optional[str]:
+        """The last chain-of-thought generated for the session (with reasoning_interval > 1)."""
+        if state.reasoning_ids is None:
+            return None
+        return self.processor.tokenizer.decode(state.reasoning_ids, skip_special_tokens=True)
+
+    def reasoning_budget(self, action_dim: int) -> Optional[ReasoningBudget]:
+        """The budget for the current max_reasoning_tokens / reasoning_sections, None without either."""
+        if self.max_reasoning_tokens is None and self.reasoning_sections is None:
+            return None
+        budget = self._budget
+        if budget is None or (budget.max_tokens, budget.section_names, budget.action_dim) != (
+            self.max_reasoning_tokens, self.reasoning_sections, action_dim
+        ):
+            budget = self._budget = ReasoningBudget(
+                self.processor.tokenizer, action_dim, self.model.vocab_size,
+                self.max_reasoning_tokens, self.reasoning_sections,
+            )
+        return budget
+
+    def forward_batch(self, inputs: Sequence) -> list[tuple[np.ndarray, Optional[torch.Tensor], int]]:
+        """
+        GPU stage of step: one ((7,) raw action, reasoning ids, decoded tokens) triple per processed
+        input. The reasoning ids are those generated in this step when reasoning_interval > 1, else None.
+        """
+        budgeted = self.max_reasoning_tokens is not None or self.reasoning_sections is not None
+        if len(inputs) == 1 and self.reasoning_interval <= 1 and not budgeted and not vision_cache.enabled:
+            # predict: EcoT returns (actions, reasoning_ids)
+            with metrics.span("predict_action"):
+                result = self.model.predict_action(
+                    **inputs[0]["inputs"], unnorm_key=inputs[0]["unnorm_key"], do_sample=False,
+                    max_new_tokens=self.max_new_tokens
+                )
+            # unpack tuple if chain-of-thought is returned
+            decoded_tokens = 0
+            if isinstance(result, tuple) or isinstance(result, list):
+                raw_actions_array, reasoning_ids = result
+                # generate returns the prompt, with the empty token predict_action appends to it, and the new tokens
+                input_ids = inputs[0]["inputs"]["input_ids"]
+                prompt_len = input_ids.shape[-1] + int(input_ids[0, -1] != EMPTY_TOKEN_ID)
+                decoded_tokens = reasoning_ids.shape[-1] - prompt_len
             else:
-                rel = self.previous_gripper_action - current
-            self.previous_gripper_action = current
-
-            if np.abs(rel) > 0.5 and not self.sticky_action_is_on:
-                self.sticky_action_is_on = True
-                self.sticky_gripper_action = rel
-            if self.sticky_action_is_on:
-                self.gripper_action_repeat += 1
-                rel = self.sticky_gripper_action
-            if self.gripper_action_repeat == self.sticky_gripper_num_repeat:
-                self.sticky_action_is_on = False
-                self.gripper_action_repeat = 0
-                self.sticky_gripper_action = 0.0
-            action["gripper"] = rel
-        else:
-            action["gripper"] = 2.0 * (raw_action["open_gripper"] > 0.5) - 1.0
+                raw_actions_array = result
+            metrics.observe("decoded_tokens", decoded_tokens)
+            # ensure numpy array
+            return [(np.array(raw_actions_array), None, decoded_tokens)]
+
+        eos_token_id = self.processor.tokenizer.eos_token_id
+        # action tokens are the last action_dim tokens before </s>
+        action_dim = self.model.get_action_dim(inputs[0]["unnorm_key"])
+        generate = [i for i, x in enumerate(inputs) if x["reasoning_ids"] is None]
+        reuse = [i for i, x in enumerate(inputs) if x["reasoning_ids"] is not None]
+        outputs = [None] * len(inputs)
+        budget = self.reasoning_budget(action_dim)
+        with metrics.span("predict_action"):
+            if generate:
+                controllers = None if budget is None else [budget.controller() for _ in generate]
+                generated = generate_batch(
+                    self.model,
+                    [inputs[i]["inputs"]["input_ids"][0] for i in generate],
+                    torch.cat([inputs[i]["inputs"]["pixel_values"] for i in generate]),
+                    max_new_tokens=self.max_new_tokens,
+                    eos_token_id=eos_token_id,
+                    controllers=controllers,
+                    image_keys=[inputs[i]["image_key"] for i in generate] if vision_cache.enabled else None,
+                )
+                for row, (i, ids) in enumerate(zip(generate, generated)):
+                    decoded_tokens = len(ids) if controllers is None else controllers[row].decoded
+                    ids = ids[:-1] if ids[-1] == eos_token_id else ids
+                    reasoning_ids = ids[:-action_dim] if self.reasoning_interval > 1 else None
+                    outputs[i] = (self._decode(ids[-action_dim:], inputs[i]), reasoning_ids, decoded_tokens)
+            if reuse:
+                # the cached reasoning is fed as part of the prompt; only the action tokens are decoded
+                generated = generate_batch(
+                    self.model,
+                    [inputs[i]["inputs"]["input_ids"][0] for i in reuse],
+                    torch.cat([inputs[i]["inputs"]["pixel_values"] for i in reuse]),
+                    max_new_tokens=action_dim,
+                    suffix_ids=[inputs[i]["reasoning_ids"] for i in reuse],
+                    image_keys=[inputs[i]["image_key"] for i in reuse] if vision_cache.enabled else None,
+                )
+                for i, ids in zip(reuse, generated):
+                    outputs[i] = (self._decode(ids[-action_dim:], inputs[i]), None, len(ids))
+        for _, _, decoded_tokens in outputs:
+            metrics.observe("decoded_tokens", decoded_tokens)
+        return outputs
+
+    def _decode(self, action_token_ids: torch.Tensor, inputs: dict) -> np.ndarray:
+        return decode_action_tokens(self.model, action_token_ids.numpy()[None], inputs["unnorm_key"])[0]
+
+    def postprocess(
+        self, outputs: tuple[np.ndarray, Optional[torch.Tensor], int], state: PolicyState
+    ) -> tuple[dict[str, np.ndarray], dict[str, np.ndarray]]:
+        """
+        CPU stage of step: raw (7,) action to the maniskill2 action, updating the gripper state
+        and keeping newly generated reasoning for the next steps.
+        """
+        return self.postprocess_batch([outputs], [state])[0]
 
-        action["terminate_episode"] = np.array([0.0])
-        return raw_action, action
+    def postprocess_batch(
+        self, outputs: Sequence[tuple[np.ndarray, Optional[torch.Tensor], int]], states: Sequence[PolicyState]
+    ) -> list[tuple[dict[str, np.ndarray], dict[str, np.ndarray]]]:
+        """postprocess for a batch of sessions, vectorized (common/postprocess.py)."""
+        for step_outputs, state in zip(outputs, states):
+            _, reasoning_ids, decoded_tokens = step_outputs
+            if step_outputs is state.duplicate_outputs:
+                # reused for a near-duplicate frame (common/duplicates.py): nothing was decoded
+                state.decoded_tokens = 0
+                continue
+            if reasoning_ids is not None:
+                state.reasoning_ids = reasoning_ids
+            state.decoded_tokens = decoded_tokens
+            remember_outputs(step_outputs, state, lambda step_outputs: step_outputs[0])
+        raw_actions = np.stack([raw_action for raw_action, _, _ in outputs])
+        # SIMPLER's sticky gripper, compared with the previous step every step
+        return postprocess_actions(raw_actions, states, self.action_scale, hold_previous_gripper=False)
 
     def _resize_image(self, image: np.ndarray) -> np.ndarray:
         return cv.resize(image, tuple(self.image_size), interpolation=cv.INTER_AREA)
@@ -0,0 +1,124 @@
+from typing import List, Optional, Sequence, Tuple
+
+# ECoT writes its chain-of-thought as tagged sections, always in this order, then the action tokens
+SECTIONS = {
+    "task": "TASK:",
+    "plan": "PLAN:",
+    "visible_objects": "VISIBLE OBJECTS:",
+    "subtask_reasoning": "SUBTASK REASONING:",
+    "subtask": "SUBTASK:",
+    "move_reasoning": "MOVE REASONING:",
+    "move": "MOVE:",
+    "gripper_position": "GRIPPER POSITION:",
+}
+ACTION_TAG = "ACTION:"
+# longest tag first, so that the end of "SUBTASK:" is not taken for "TASK:"
+TAGS = sorted(list(SECTIONS.values()) + [ACTION_TAG], key=len, reverse=True)
+
+
+def check_sections(sections: Optional[Sequence[str]]) -> None:
+    """Raises ValueError for names that are not in SECTIONS."""
+    unknown = set(sections or ()) - set(SECTIONS)
+    if unknown:
+        raise ValueError(f"Unknown reasoning sections: {sorted(unknown)}, expected some of {list(SECTIONS)}")
+
+
+class ReasoningBudget:
+    """
+    Limits the chain-of-thought ECoT generates per step: at most ``max_tokens`` reasoning tokens,
+    and only the ``sections`` given (names of SECTIONS); None leaves either unlimited. Makes one
+    ReasoningController per generated row.
+    """
+
+    def __init__(self, tokenizer, action_dim: int, vocab_size: int, max_tokens: Optional[int] = None,
+                 sections: Optional[Sequence[str]] = None) -> None:
+        check_sections(sections)
+        self.tokenizer = tokenizer
+        self.action_dim = action_dim
+        # action tokens are the 256 ids at the end of the vocabulary
+        self.first_action_token = vocab_size - 256
+        self.max_tokens = max_tokens
+        self.section_names = sections
+        self.sections = None if sections is None else [SECTIONS[name] for name in sections]
+        self._tag_ids = {tag: tokenizer.encode(tag, add_special_tokens=False) for tag in TAGS}
+
+    def controller(self) -> "ReasoningController":
+        return ReasoningController(self)
+
+    def tag_ids(self, tag: str) -> List[int]:
+        return self._tag_ids[tag]
+
+    def next_tag(self, tag: str) -> str:
+        """The first kept tag from ``tag`` on, in section order (ACTION: when none is left)."""
+        order = list(SECTIONS.values())
+        for candidate in order[order.index(tag):]:
+            if self.sections is None or candidate in self.sections:
+                return candidate
+        return ACTION_TAG
+
+
+class ReasoningController:
+    """
+    Steers the greedy decoding of one row in common/prismatic.generate_batch: a tag of a section that
+    is not kept is dropped in favor of the next kept one, reasoning past the token budget is cut with
+    ACTION:, and decoding ends with </s> once the action tokens are out.
+    """
+
+    def __init__(self, budget: ReasoningBudget) -> None:
+        self.budget = budget
+        self.tokens: List[int] = []  # generated ids, without the dropped ones
+        self.forced: List[int] = []  # ids fed next regardless of the model
+        self.decoded = 0  # decoding steps up to </s>, dropped tokens included
+        self.acting = False  # ACTION: is out, the action tokens follow
+        self.action_tokens = 0
+        self.done = False
+
+    def step(self, token: int) -> Tuple[int, int]:
+        if self.done:
+            # the other rows of the batch are still decoding
+            return token, 0
+        self.decoded += 1
+        drop = 0
+        if self.forced:
+            token = self.forced.pop(0)
+        elif self.acting:
+            if self.action_tokens == self.budget.action_dim:
+                token = self.budget.tokenizer.eos_token_id
+            elif token >= self.budget.first_action_token:
+                self.action_tokens += 1
+        else:
+            tag = self._completed_tag(token)
+            if tag is not None and tag != ACTION_TAG and self.budget.next_tag(tag) != tag:
+                # the tag is already partly fed: drop it and write the next kept one instead
+                drop = len(self._tag_span(token, tag)) - 1
+                del self.tokens[len(self.tokens) - drop:]
+                token = self._force(self.budget.next_tag(tag))
+            elif tag == ACTION_TAG:
+                self.acting = True
+            elif self.budget.max_tokens is not None and len(self.tokens) >= self.budget.max_tokens:
+                token = self._force(ACTION_TAG)
+        self.done = token == self.budget.tokenizer.eos_token_id
+        self.tokens.append(token)
+        return token, drop
+
+    def _force(self, tag: str) -> int:
+        self.forced = list(self.budget.tag_ids(tag))
+        self.acting = tag == ACTION_TAG
+        return self.forced.pop(0)
+
+    def _completed_tag(self, token: int) -> Optional[str]:
+        """The tag that ``token`` completes, if any."""
+        # a tag takes at most a token per character
+        text = self.budget.tokenizer.decode(self.tokens[-len(TAGS[0]):] + [token])
+        for tag in TAGS:
+            if text.endswith(tag):
+                return tag
+        return None
+
+    def _tag_span(self, token: int, tag: str) -> List[int]:
+        """The shortest tail of the generated ids (ending with ``token``) whose text holds ``tag``."""
+        ids = self.tokens + [token]
+        for length in range(1, len(ids) + 1):
+            if tag in self.budget.tokenizer.decode(ids[-length:]):
+                return ids[-length:]
+        return ids
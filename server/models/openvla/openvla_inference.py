@@ -2,13 +2,26 @@ from typing import Optional, Sequence
 import os
 import matplotlib.pyplot as plt
 import numpy as np
-from transforms3d.euler import euler2axangle
 from transformers import AutoModelForVision2Seq, AutoProcessor
 from PIL import Image
 import torch
 import cv2 as cv
 
+from common.duplicates import forward_or_reuse, remember_outputs, reuse_outputs
+from common.metrics import metrics
+from common.postprocess import postprocess_actions
+from common.results import fingerprint, result_cache
+from common.sessions import PolicyState
+from common.vision import vision_cache
+from common.prismatic import generate_batch, decode_action_tokens, process_inputs
+
 class OpenVLAInference:
+    # default unnormalization key and sticky gripper repeats of each policy setup
+    POLICY_SETUPS = {
+        "widowx_bridge": {"unnorm_key": "bridge_orig", "sticky_gripper_num_repeat": 1},
+        "google_robot": {"unnorm_key": "fractal20220817_data", "sticky_gripper_num_repeat": 15},
+    }
+
     def __init__(
         self,
         saved_model_path: str = "openvla/openvla-7b",
@@ -19,14 +32,12 @@ class OpenVLAInference:
         exec_horizon: int = 1,
         image_size: list[int] = [224, 224],
         action_scale: float = 1.0,
+        duplicate_frame_threshold: Optional[float] = None,
     ) -> None:
         os.environ["TOKENIZERS_PARALLELISM"] = "false"
-        if policy_setup == "widowx_bridge":
-            unnorm_key = "bridge_orig" if unnorm_key is None else unnorm_key
-            self.sticky_gripper_num_repeat = 1
-        elif policy_setup == "google_robot":
-            unnorm_key = "fractal20220817_data" if unnorm_key is None else unnorm_key
-            self.sticky_gripper_num_repeat = 15
+        if policy_setup in self.POLICY_SETUPS:
+            unnorm_key = self.POLICY_SETUPS[policy_setup]["unnorm_key"] if unnorm_key is None else unnorm_key
+            self.sticky_gripper_num_repeat = self.POLICY_SETUPS[policy_setup]["sticky_gripper_num_repeat"]
         else:
             raise NotImplementedError(
                 f"Policy setup {policy_setup} not supported for octo models. The other datasets can be found in the huggingface config.json file."
@@ -36,6 +47,8 @@ class OpenVLAInference:
 
         print(f"*** policy_setup: {policy_setup}, unnorm_key: {unnorm_key} ***")
         self.processor = AutoProcessor.from_pretrained(saved_model_path, trust_remote_code=True)
+        # identifies the tokenizer in the prompt cache
+        self.saved_model_path = saved_model_path
         self.vla = AutoModelForVision2Seq.from_pretrained(
             "openvla/openvla-7b",
             attn_implementation="sdpa",  # [Optional] Requires `flash_attn`
@@ -49,32 +62,53 @@ class OpenVLAInference:
         self.horizon = horizon
         self.pred_action_horizon = pred_action_horizon
         self.exec_horizon = exec_horizon
-
-        self.sticky_action_is_on = False
-        self.gripper_action_repeat = 0
-        self.sticky_gripper_action = 0.0
-        self.previous_gripper_action = None
+        # mean absolute difference (0-1) of a frame's thumbnail from that of the last forward's frame up to
+        # which the last outputs are reused instead of a forward pass (common/duplicates.py); None disables it
+        self.duplicate_frame_threshold = duplicate_frame_threshold
 
         self.task = None
-        self.task_description = None
-        self.num_image_history = 0
+        # state used by callers that do not pass their own (single-client mode)
+        self.state = self.new_state()
 
-    def reset(self, task_description: str) -> None:
-        self.task_description = task_description
-        self.num_image_history = 0
+    def new_state(self, policy_setup: Optional[str] = None, unnorm_key: Optional[str] = None) -> PolicyState:
+        state = PolicyState()
+        self.configure(state, policy_setup, unnorm_key)
+        return state
 
-        self.sticky_action_is_on = False
-        self.gripper_action_repeat = 0
-        self.sticky_gripper_action = 0.0
-        self.previous_gripper_action = None
+    def configure(
+        self, state: PolicyState, policy_setup: Optional[str] = None, unnorm_key: Optional[str] = None
+    ) -> None:
+        """
+        Set the policy_setup / unnorm_key of one session on top of the shared weights.
+        Without either, the server defaults are used; with only policy_setup, its default unnorm_key.
+        Raises ValueError for an unsupported setup or a dataset without normalization statistics.
+        """
+        if policy_setup is None and unnorm_key is None:
+            policy_setup, unnorm_key = self.policy_setup, self.unnorm_key
+        policy_setup = self.policy_setup if policy_setup is None else policy_setup
+        if policy_setup not in self.POLICY_SETUPS:
+            raise ValueError(f"Unsupported policy setup: {policy_setup}")
+        setup = self.POLICY_SETUPS[policy_setup]
+        unnorm_key = setup["unnorm_key"] if unnorm_key is None else unnorm_key
+        norm_stats = getattr(self.vla, "norm_stats", None)
+        if norm_stats is not None and unnorm_key not in norm_stats:
+            raise ValueError(f"Unknown unnorm_key: {unnorm_key}")
+        state.policy_setup = policy_setup
+        state.unnorm_key = unnorm_key
+        state.sticky_gripper_num_repeat = setup["sticky_gripper_num_repeat"]
+
+    def reset(self, task_description: str, state: Optional[PolicyState] = None) -> None:
+        state = self.state if state is None else state
+        state.reset(task_description)
 
     def step(
-        self, image: np.ndarray, task_description: Optional[str] = None, *args, **kwargs
+        self, image: np.ndarray, task_description: Optional[str] = None, *args, state: Optional[PolicyState] = None, **kwargs
     ) -> tuple[dict[str, np.ndarray], dict[str, np.ndarray]]:
         """
         Input:
             image: np.ndarray of shape (H, W, 3), uint8
             task_description: Optional[str], task description; if different from previous task description, policy state is reset
+            state: Optional[PolicyState], per-session policy state; defaults to self.state
         Output:
             raw_action: dict; raw policy action output
             action: dict; processed action to be sent to the maniskill2 environment, with the following keys:
@@ -83,65 +117,90 @@ class OpenVLAInference:
                 - 'gripper': np.ndarray of shape (1,), gripper action
                 - 'terminate_episode': np.ndarray of shape (1,), 1 if episode should be terminated, 0 otherwise
         """
+        state = self.state if state is None else state
+        inputs = self.preprocess(image, task_description, state)
+        raw_actions = forward_or_reuse(self.forward_batch, [inputs])[0]
+        return self.postprocess(raw_actions, state)
+
+    def step_batch(
+        self,
+        images: Sequence[np.ndarray],
+        task_descriptions: Sequence[Optional[str]],
+        states: Sequence[Optional[PolicyState]],
+    ) -> list[tuple[dict[str, np.ndarray], dict[str, np.ndarray]]]:
+        """
+        Batched version of step for concurrent sessions: one padded forward pass and
+        greedy action-token decode for all frames. Inputs and outputs are per-item as in step.
+        """
+        states = [self.state if state is None else state for state in states]
+        inputs = [self.preprocess(*item) for item in zip(images, task_descriptions, states)]
+        outputs = forward_or_reuse(self.forward_batch, inputs)
+        return self.postprocess_batch(outputs, states)
+
+    def preprocess(self, image: np.ndarray, task_description: Optional[str], state: PolicyState):
+        """
+        CPU stage of step: reset on a new task, resize and run the processor. Returns a Reuse of the
+        last outputs for a near-duplicate frame (see duplicate_frame_threshold).
+        """
         if task_description is not None:
-            if task_description != self.task_description:
-                self.reset(task_description)
+            if task_description != state.task_description:
+                self.reset(task_description, state)
 
         assert image.dtype == np.uint8
-        image = self._resize_image(image)
-
+        with metrics.span("resize"):
+            image = self._resize_image(image)
+        reuse = reuse_outputs(image, state, self.duplicate_frame_threshold)
+        if reuse is not None:
+            return reuse
+
+        cache_key = None
+        if result_cache.enabled:
+            cache_key = fingerprint(self.saved_model_path, state.unnorm_key, state.task_description, image)
+        image_key = fingerprint(self.saved_model_path, image) if vision_cache.enabled else None
         image: Image.Image = Image.fromarray(image)
-        prompt = task_description
-
-        # predict action (7-dof; un-normalize for bridgev2)
-        inputs = self.processor(prompt, image).to("cuda:0", dtype=torch.bfloat16)
-        raw_actions = self.vla.predict_action(**inputs, unnorm_key=self.unnorm_key, do_sample=False)[None]
-        # print(f"*** raw actions {raw_actions} ***")
-
-        raw_action = {
-            "world_vector": np.array(raw_actions[0, :3]),
-            "rotation_delta": np.array(raw_actions[0, 3:6]),
-            "open_gripper": np.array(raw_actions[0, 6:7]),  # range [0, 1]; 1 = open; 0 = close
-        }
-
-        # process raw_action to obtain the action to be sent to the maniskill2 environment
-        action = {}
-        action["world_vector"] = raw_action["world_vector"] * self.action_scale
-        action_rotation_delta = np.asarray(raw_action["rotation_delta"], dtype=np.float64)
-        roll, pitch, yaw = action_rotation_delta
-        action_rotation_ax, action_rotation_angle = euler2axangle(roll, pitch, yaw)
-        action_rotation_axangle = action_rotation_ax * action_rotation_angle
-        action["rot_axangle"] = action_rotation_axangle * self.action_scale
-
-        if self.policy_setup == "google_robot":
-            current_gripper_action = raw_action["open_gripper"]
-            if self.previous_gripper_action is None:
-                relative_gripper_action = np.array([0])
-            else:
-                relative_gripper_action = self.previous_gripper_action - current_gripper_action
-            self.previous_gripper_action = current_gripper_action
-
-            if np.abs(relative_gripper_action) > 0.5 and (not self.sticky_action_is_on):
-                self.sticky_action_is_on = True
-                self.sticky_gripper_action = relative_gripper_action
-
-            if self.sticky_action_is_on:
-                self.gripper_action_repeat += 1
-                relative_gripper_action = self.sticky_gripper_action
-
-            if self.gripper_action_repeat == self.sticky_gripper_num_repeat:
-                self.sticky_action_is_on = False
-                self.gripper_action_repeat = 0
-                self.sticky_gripper_action = 0.0
-
-            action["gripper"] = relative_gripper_action
-
-        elif self.policy_setup == "widowx_bridge":
-            action["gripper"] = 2.0 * (raw_action["open_gripper"] > 0.5) - 1.0
-
-        action["terminate_episode"] = np.array([0.0])
-
-        return raw_action, action
+        prompt = state.task_description
+        with metrics.span("processor"):
+            inputs = process_inputs(self.processor, self.saved_model_path, prompt, state.unnorm_key, image)
+            inputs = inputs.to("cuda:0", dtype=torch.bfloat16)
+        return {"inputs": inputs, "unnorm_key": state.unnorm_key, "cache_key": cache_key, "image_key": image_key}
+
+    def forward_batch(self, inputs: Sequence) -> list[np.ndarray]:
+        """GPU stage of step: one (7,) raw action per processed input, un-normalized with its session's key."""
+        if len(inputs) == 1 and not vision_cache.enabled:
+            # predict action (7-dof; un-normalize for bridgev2)
+            with metrics.span("predict_action"):
+                return [self.vla.predict_action(**inputs[0]["inputs"], unnorm_key=inputs[0]["unnorm_key"],
+                                                do_sample=False)]
+
+        # every dataset of the checkpoint has 7-dof actions
+        action_dim = self.vla.get_action_dim(inputs[0]["unnorm_key"])
+        with metrics.span("predict_action"):
+            generated = generate_batch(
+                self.vla,
+                [x["inputs"]["input_ids"][0] for x in inputs],
+                torch.cat([x["inputs"]["pixel_values"] for x in inputs]),
+                max_new_tokens=action_dim,
+                image_keys=[x["image_key"] for x in inputs] if vision_cache.enabled else None,
+            )
+        return [
+            decode_action_tokens(self.vla, ids[None, -action_dim:].numpy(), x["unnorm_key"])[0]
+            for ids, x in zip(generated, inputs)
+        ]
+
+    def postprocess(
+        self, raw_actions: np.ndarray, state: PolicyState
+    ) -> tuple[dict[str, np.ndarray], dict[str, np.ndarray]]:
+        """CPU stage of step: raw (7,) action to the maniskill2 action, updating the gripper state."""
+        return self.postprocess_batch([raw_actions], [state])[0]
+
+    def postprocess_batch(
+        self, outputs: Sequence[np.ndarray], states: Sequence[PolicyState]
+    ) -> list[tuple[dict[str, np.ndarray], dict[str, np.ndarray]]]:
+        """postprocess for a batch of sessions, vectorized (common/postprocess.py)."""
+        for raw_action, state in zip(outputs, states):
+            remember_outputs(raw_action, state, lambda raw_action: raw_action)
+        # SIMPLER's sticky gripper, compared with the previous step every step
+        return postprocess_actions(np.stack(outputs), states, self.action_scale, hold_previous_gripper=False)
 
     def _resize_image(self, image: np.ndarray) -> np.ndarray:
         image = cv.resize(image, tuple(self.image_size), interpolation=cv.INTER_AREA)
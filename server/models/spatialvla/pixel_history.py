@@ -0,0 +1,61 @@
+from typing import Callable, Optional
+
+import numpy as np
+import torch
+
+
+class PixelHistory:
+    """
+    Observation history of one session as processed pixel tensors, in a fixed ring of
+    ``length`` frames. A frame goes through the image processor once, the first time it is
+    sampled, instead of on every step it stays in the history; frames between the
+    ``interval``-th ones are never processed.
+    """
+
+    def __init__(self, length: int, interval: int, process: Callable[[np.ndarray], torch.Tensor]) -> None:
+        self.length = length
+        self.process = process
+        # _sampled[head]: ring slots of every interval-th frame, oldest first, ending at the newest
+        self._sampled = [
+            [(head + 1 + offset) % length for offset in range(0, length, interval)] for head in range(length)
+        ]
+        self._pixels: Optional[torch.Tensor] = None  # (length, 3, H, W), allocated on the first frame
+        self._frames: list = [None] * length  # raw frames not processed yet
+        self._head = length - 1
+        self._size = 0
+        self.latest: Optional[np.ndarray] = None  # newest raw frame
+
+    def __len__(self) -> int:
+        return self._size
+
+    def clear(self) -> None:
+        self._frames = [None] * self.length
+        self._size = 0
+
+    def append(self, image: np.ndarray) -> None:
+        """Add a frame; the first one of an episode fills the whole history."""
+        self.latest = image
+        if self._size == 0:
+            self._frames = [image] * self.length
+            self._size = self.length
+            return
+        self._head = (self._head + 1) % self.length
+        self._frames[self._head] = image
+
+    def pixel_values(self) -> torch.Tensor:
+        """(num_frames, 3, H, W) pixels of the sampled frames, oldest first, processing the new ones."""
+        slots = self._sampled[self._head]
+        processed = {}
+        for slot in slots:
+            image = self._frames[slot]
+            if image is None:
+                continue
+            if id(image) not in processed:
+                processed[id(image)] = self.process(image)
+            pixels = processed[id(image)]
+            if self._pixels is None:
+                self._pixels = torch.empty((self.length,) + pixels.shape, dtype=pixels.dtype)
+            self._pixels[slot] = pixels
+            self._frames[slot] = None
+        # a copy: the forward may run after later frames have been written over these slots
+        return self._pixels[slots]
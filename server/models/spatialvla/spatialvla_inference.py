@@ -1,39 +1,48 @@
-from typing import Optional, Sequence, List
+from typing import Optional, Sequence
 import os
+import time
 import matplotlib.pyplot as plt
 import numpy as np
-from transforms3d.euler import euler2axangle
-from transformers import AutoModel, AutoProcessor
-from collections import deque
+from transformers import AutoModel, AutoProcessor, BatchFeature
 from PIL import Image
 import torch
 import cv2 as cv
 
 from action_ensemble import ActionEnsembler
+from pixel_history import PixelHistory
+from common.duplicates import forward_or_reuse, remember_outputs, reuse_outputs
+from common.ensemble import TemporalEnsemblePool, ensemble_batch
+from common.metrics import metrics
+from common.postprocess import postprocess_actions
+from common.prompts import prompt_cache
+from common.results import fingerprint, result_cache
+from common.sessions import PolicyState, Prefetch
 
 
 class SpatialVLAInference:
+    # default unnormalization key and sticky gripper repeats of each policy setup
+    POLICY_SETUPS = {
+        "widowx_bridge": {"unnorm_key": "bridge_orig/1.0.0", "sticky_gripper_num_repeat": 1},
+        "google_robot": {"unnorm_key": "fractal20220817_data/0.1.0", "sticky_gripper_num_repeat": 10},
+    }
+
     def __init__(
             self,
             saved_model_path: str = "IPEC-COMMUNITY/spatialvla-4b-224-pt",
             unnorm_key: Optional[str] = None,
             policy_setup: str = "widowx_bridge",
             exec_horizon: int = 1,
+            prefetch_at: Optional[int] = None,
             image_size: list[int] = [224, 224],
             action_scale: float = 1.0,
             action_ensemble_temp: float = -0.8,
+            duplicate_frame_threshold: Optional[float] = None,
     ) -> None:
         os.environ["TOKENIZERS_PARALLELISM"] = "false"
-        if policy_setup == "widowx_bridge":
-            unnorm_key = "bridge_orig/1.0.0" if unnorm_key is None else unnorm_key
-            action_ensemble = True
-            self.sticky_gripper_num_repeat = 1
-        elif policy_setup == "google_robot":
-            unnorm_key = (
-                "fractal20220817_data/0.1.0" if unnorm_key is None else unnorm_key
-            )
+        if policy_setup in self.POLICY_SETUPS:
+            unnorm_key = self.POLICY_SETUPS[policy_setup]["unnorm_key"] if unnorm_key is None else unnorm_key
             action_ensemble = True
-            self.sticky_gripper_num_repeat = 10
+            self.sticky_gripper_num_repeat = self.POLICY_SETUPS[policy_setup]["sticky_gripper_num_repeat"]
         else:
             raise NotImplementedError(
                 f"Policy setup {policy_setup} not supported for octo models. The other datasets can be found in the huggingface config.json file."
@@ -45,6 +54,8 @@ class SpatialVLAInference:
         self.processor = AutoProcessor.from_pretrained(
             saved_model_path, trust_remote_code=True
         )
+        # identifies the tokenizer in the prompt cache
+        self.saved_model_path = saved_model_path
         self.vla = (
             AutoModel.from_pretrained(
                 saved_model_path,
@@ -60,44 +71,69 @@ class SpatialVLAInference:
         self.obs_horizon = (self.processor.num_obs_steps - 1) * self.processor.obs_delta + 1
         self.obs_interval = self.processor.obs_delta
         self.pred_action_horizon = self.processor.action_chunk_size
-        self.image_history = deque(maxlen=self.obs_horizon)
         self.exec_horizon = exec_horizon
-
-        self.sticky_action_is_on = False
-        self.gripper_action_repeat = 0
-        self.sticky_gripper_action = 0.0
-        self.previous_gripper_action = None
+        # chunk index at which the next chunk starts being predicted in the background; None disables it
+        self.prefetch_at = prefetch_at
+        # mean absolute difference (0-1) of a frame's thumbnail from that of the last forward's frame up to
+        # which the last chunk is reused instead of a forward pass (common/duplicates.py); None disables it
+        self.duplicate_frame_threshold = duplicate_frame_threshold
 
         self.action_ensemble = action_ensemble
         self.action_ensemble_temp = action_ensemble_temp
+        # ring buffers of the ensemblers of all sessions
+        self.ensemble_pool = TemporalEnsemblePool(self.pred_action_horizon, action_ensemble_temp)
 
+        self.task = None
+        # state used by callers that do not pass their own (single-client mode)
+        self.state = self.new_state()
+
+    def new_state(self, policy_setup: Optional[str] = None, unnorm_key: Optional[str] = None) -> PolicyState:
         if self.action_ensemble:
-            self.action_ensembler = ActionEnsembler(
-                self.pred_action_horizon, self.action_ensemble_temp
+            action_ensembler = ActionEnsembler(
+                self.pred_action_horizon, self.action_ensemble_temp, pool=self.ensemble_pool
             )
         else:
-            self.action_ensembler = None
+            action_ensembler = None
+        state = PolicyState(action_ensembler=action_ensembler)
+        state.image_history = PixelHistory(self.obs_horizon, self.obs_interval, self._process_frame)
+        self.configure(state, policy_setup, unnorm_key)
+        return state
 
-        self.task = None
-        self.task_description = None
+    def configure(
+            self, state: PolicyState, policy_setup: Optional[str] = None, unnorm_key: Optional[str] = None
+    ) -> None:
+        """
+        Set the policy_setup / unnorm_key of one session on top of the shared weights.
+        Without either, the server defaults are used; with only policy_setup, its default unnorm_key.
+        Raises ValueError for an unsupported setup or a dataset without normalization statistics.
+        """
+        if policy_setup is None and unnorm_key is None:
+            policy_setup, unnorm_key = self.policy_setup, self.unnorm_key
+        policy_setup = self.policy_setup if policy_setup is None else policy_setup
+        if policy_setup not in self.POLICY_SETUPS:
+            raise ValueError(f"Unsupported policy setup: {policy_setup}")
+        setup = self.POLICY_SETUPS[policy_setup]
+        unnorm_key = setup["unnorm_key"] if unnorm_key is None else unnorm_key
+        statistics = getattr(self.processor, "statistics", None)
+        if statistics is not None and unnorm_key not in statistics:
+            raise ValueError(f"Unknown unnorm_key: {unnorm_key}")
+        state.policy_setup = policy_setup
+        state.unnorm_key = unnorm_key
+        state.sticky_gripper_num_repeat = setup["sticky_gripper_num_repeat"]
 
-    def reset(self, task_description: str) -> None:
-        self.image_history.clear()
-        if self.action_ensemble:
-            self.action_ensembler.reset()
-        self.task_description = task_description
-        self.sticky_action_is_on = False
-        self.gripper_action_repeat = 0
-        self.sticky_gripper_action = 0.0
-        self.previous_gripper_action = None
+    def reset(self, task_description: str, state: Optional[PolicyState] = None) -> None:
+        state = self.state if state is None else state
+        state.reset(task_description)
 
     def step(
-            self, image: np.ndarray, task_description: Optional[str] = None, *args, **kwargs
+            self, image: np.ndarray, task_description: Optional[str] = None, *args,
+            state: Optional[PolicyState] = None, **kwargs
     ) -> tuple[dict[str, np.ndarray], dict[str, np.ndarray]]:
         """
         Input:
             image: np.ndarray of shape (H, W, 3), uint8
             task_description: Optional[str], task description; if different from previous task description, policy state is reset
+            state: Optional[PolicyState], per-session policy state; defaults to self.state
         Output:
             raw_action: dict; raw policy action output
             action: dict; processed action to be sent to the maniskill2 environment, with the following keys:
@@ -106,100 +142,157 @@ class SpatialVLAInference:
                 - 'gripper': np.ndarray of shape (1,), gripper action
                 - 'terminate_episode': np.ndarray of shape (1,), 1 if episode should be terminated, 0 otherwise
         """
+        state = self.state if state is None else state
+        inputs = self.preprocess(image, task_description, state)
+        if isinstance(inputs, Prefetch):
+            if inputs.result is None:
+                # nothing runs in the background here: predict now, use it at the chunk boundary
+                inputs.result = self.forward_batch([inputs.inputs])[0]
+                raw_actions = None
+            else:
+                raw_actions = inputs.result
+        else:
+            raw_actions = None if inputs is None else forward_or_reuse(self.forward_batch, [inputs])[0]
+        return self.postprocess(raw_actions, state)
+
+    def preprocess(self, image: np.ndarray, task_description: Optional[str], state: PolicyState):
+        """
+        CPU stage of step: reset on a new task, update the image history and run the processor.
+        Returns None while the next action comes from the cached chunk (see exec_horizon), and
+        a Prefetch when the next chunk is predicted ahead of time (see prefetch_at), and a Reuse of
+        the last chunk for a near-duplicate frame (see duplicate_frame_threshold).
+        """
         if task_description is not None:
-            if task_description != self.task_description:
-                self.reset(task_description)
+            if task_description != state.task_description:
+                self.reset(task_description, state)
 
         assert image.dtype == np.uint8
-        image = self._resize_image(image)
-        self._add_image_to_history(image)
-        images: List[Image.Image] = self._obtain_image_history()
-        prompt = task_description
+        with metrics.span("resize"):
+            image = self._resize_image(image)
+        self._add_image_to_history(image, state)
+        if self._chunk_is_cached(state):
+            if self._should_prefetch(state):
+                state.prefetch = Prefetch(self._model_inputs(state), state.chunk_step + 1)
+                return state.prefetch
+            return None
+        if state.prefetch is not None:
+            return state.prefetch
+        reuse = reuse_outputs(image, state, self.duplicate_frame_threshold)
+        if reuse is not None:
+            return reuse
+        return self._model_inputs(state)
 
+    def _model_inputs(self, state: PolicyState):
+        with metrics.span("processor"):
+            pixel_values = state.image_history.pixel_values()
+
+            def prompt_inputs():
+                # prompt tokens and intrinsics do not depend on the frames; the processor needs some all the same
+                images = [Image.fromarray(state.image_history.latest).convert("RGB")] * len(pixel_values)
+                inputs = self.processor(images=images, text=state.task_description, unnorm_key=state.unnorm_key,
+                                        return_tensors="pt", do_normalize=False)
+                return {k: v for k, v in inputs.items() if k != "pixel_values"}
+
+            text_inputs = prompt_cache.get(self.saved_model_path, state.task_description, state.unnorm_key,
+                                           prompt_inputs)
+            inputs = BatchFeature({**text_inputs, "pixel_values": pixel_values})
+        cache_key = None
+        if result_cache.enabled:
+            # the pixels of the whole sampled history, not only the newest frame
+            cache_key = fingerprint(self.saved_model_path, state.unnorm_key, state.task_description, pixel_values)
+        return {"inputs": inputs, "unnorm_key": state.unnorm_key, "cache_key": cache_key}
+
+    def forward_batch(self, inputs: Sequence) -> list[np.ndarray]:
+        """GPU stage of step: one (action_chunk_size, 7) raw action chunk per processed input."""
+        outputs = []
         # predict action (7-dof; un-normalize for bridgev2)
-        inputs = self.processor(images=images, text=prompt, unnorm_key=self.unnorm_key, return_tensors="pt",
-                                do_normalize=False)
         with torch.no_grad():
-            if hasattr(self.processor, "action_tokenizer"):
-                generation_outputs = self.vla.predict_action(inputs)
-                raw_actions = self.processor.decode_actions(
-                    generation_outputs=generation_outputs,
-                    unnorm_key=self.unnorm_key,
-                )["actions"]
-            else:
-                raw_actions = self.vla.predict_action(**inputs)["actions"]
-                raw_actions = raw_actions.cpu().numpy()
-
-        if self.action_ensemble:
-            raw_actions = self.action_ensembler.ensemble_action(raw_actions)[None]
-
-        raw_action = {
-            "world_vector": np.array(raw_actions[0, :3]),
-            "rotation_delta": np.array(raw_actions[0, 3:6]),
-            "open_gripper": np.array(
-                raw_actions[0, 6:7]
-            ),  # range [0, 1]; 1 = open; 0 = close
-        }
-
-        # process raw_action to obtain the action to be sent to the maniskill2 environment
-        action = {}
-        action["world_vector"] = raw_action["world_vector"] * self.action_scale
-        action_rotation_delta = np.asarray(
-            raw_action["rotation_delta"], dtype=np.float64
-        )
-        roll, pitch, yaw = action_rotation_delta
-        action_rotation_ax, action_rotation_angle = euler2axangle(roll, pitch, yaw)
-        action_rotation_axangle = action_rotation_ax * action_rotation_angle
-        action["rot_axangle"] = action_rotation_axangle * self.action_scale
-
-        if self.policy_setup == "google_robot":
-            action["gripper"] = 0
-            current_gripper_action = raw_action["open_gripper"]
-            if self.previous_gripper_action is None:
-                relative_gripper_action = np.array([0])
-                self.previous_gripper_action = current_gripper_action
-            else:
-                relative_gripper_action = self.previous_gripper_action - current_gripper_action
-            # fix a bug in the SIMPLER code here
-            # self.previous_gripper_action = current_gripper_action
+            for x in inputs:
+                with metrics.span("predict_action"):
+                    if hasattr(self.processor, "action_tokenizer"):
+                        generation_outputs = self.vla.predict_action(x["inputs"])
+                        raw_actions = self.processor.decode_actions(
+                            generation_outputs=generation_outputs,
+                            unnorm_key=x["unnorm_key"],
+                        )["actions"]
+                    else:
+                        raw_actions = self.vla.predict_action(**x["inputs"])["actions"]
+                        raw_actions = raw_actions.cpu().numpy()
+                outputs.append(raw_actions)
+        return outputs
 
-            if np.abs(relative_gripper_action) > 0.5 and (not self.sticky_action_is_on):
-                self.sticky_action_is_on = True
-                self.sticky_gripper_action = relative_gripper_action
-                self.previous_gripper_action = current_gripper_action
+    def postprocess(
+        self, raw_actions: Optional[np.ndarray], state: PolicyState
+    ) -> tuple[dict[str, np.ndarray], dict[str, np.ndarray]]:
+        """
+        CPU stage of step: ensembling and gripper post-processing of a raw action chunk.
+        ``raw_actions`` None means the step is served from the cached chunk of the session.
+        """
+        return self.postprocess_batch([raw_actions], [state])[0]
 
-            if self.sticky_action_is_on:
-                self.gripper_action_repeat += 1
-                relative_gripper_action = self.sticky_gripper_action
+    def postprocess_batch(
+        self, outputs: Sequence[Optional[np.ndarray]], states: Sequence[PolicyState]
+    ) -> list[tuple[dict[str, np.ndarray], dict[str, np.ndarray]]]:
+        """postprocess for a batch of sessions; the gripper logic is vectorized (common/postprocess.py)."""
+        for raw_actions, state in zip(outputs, states):
+            if state.prefetch is None:
+                # predicted from the frame of this step (a prefetched chunk is not reused for near-duplicates)
+                remember_outputs(raw_actions, state, lambda chunk: chunk[0])
+        chunks = [self._current_chunk(raw_actions, state) for raw_actions, state in zip(outputs, states)]
+        if self.action_ensemble:
+            # sessions sharing an ensemble pool are ensembled in one vectorized call
+            actions = np.stack(ensemble_batch([state.action_ensembler for state in states], chunks))
+        else:
+            actions = np.stack([chunk[0] for chunk in chunks])
+        # sticky gripper with the reference action held until a sticky action triggers
+        return postprocess_actions(actions, states, self.action_scale, hold_previous_gripper=True)
 
-            if self.gripper_action_repeat == self.sticky_gripper_num_repeat:
-                self.sticky_action_is_on = False
-                self.gripper_action_repeat = 0
-                self.sticky_gripper_action = 0.0
+    def _current_chunk(self, raw_actions: Optional[np.ndarray], state: PolicyState) -> np.ndarray:
+        """The part of the new or cached chunk that starts at the current timestep."""
+        if raw_actions is None:
+            state.chunk_step += 1
+        elif state.prefetch is not None:
+            # the chunk was predicted from an earlier frame: skip the actions of the steps taken since
+            age = state.chunk_step + 1 - state.prefetch.chunk_step
+            self._observe_frame_age(age, time.monotonic() - state.prefetch.created)
+            state.action_chunk = raw_actions
+            state.chunk_step = state.chunk_start = min(age, len(raw_actions) - 1)
+            state.prefetch = None
+        else:
+            state.action_chunk = raw_actions
+            state.chunk_step = state.chunk_start = 0
+        return state.action_chunk[state.chunk_step:]
 
-            action["gripper"] = relative_gripper_action
+    def _chunk_is_cached(self, state: PolicyState) -> bool:
+        """Whether the next action can be taken open-loop from the last predicted chunk."""
+        if state.action_chunk is None:
+            return False
+        # exec_horizon steps from the first one served out of the chunk, so a forward runs every exec_horizon steps
+        return state.chunk_step + 1 < min(state.chunk_start + self.exec_horizon, len(state.action_chunk))
 
-        elif self.policy_setup == "widowx_bridge":
-            action["gripper"] = 2.0 * (raw_action["open_gripper"] > 0.5) - 1.0
+    def _should_prefetch(self, state: PolicyState) -> bool:
+        """Whether to start predicting the next chunk from the frame of this (cached) step."""
+        if self.prefetch_at is None or state.prefetch is not None:
+            return False
+        return state.chunk_step + 1 - state.chunk_start >= self.prefetch_at
 
-        action["terminate_episode"] = np.array([0.0])
-        return raw_action, action
+    def _observe_frame_age(self, steps: int, seconds: float) -> None:
+        """Report how stale the frame that conditioned a prefetched chunk is when the chunk is used."""
+        metrics.observe("prefetch_frame_age_steps", steps)
+        metrics.observe("prefetch_frame_age_seconds", seconds)
 
     def _resize_image(self, image: np.ndarray) -> np.ndarray:
         image = cv.resize(image, tuple(self.image_size), interpolation=cv.INTER_AREA)
         return image
 
-    def _add_image_to_history(self, image: np.ndarray) -> None:
-        if len(self.image_history) == 0:
-            self.image_history.extend([image] * self.obs_horizon)
-        else:
-            self.image_history.append(image)
+    def _add_image_to_history(self, image: np.ndarray, state: PolicyState) -> None:
+        state.image_history.append(image)
 
-    def _obtain_image_history(self) -> List[Image.Image]:
-        image_history = list(self.image_history)
-        images = image_history[:: self.obs_interval]
-        images = [Image.fromarray(image).convert("RGB") for image in images]
-        return images
+    def _process_frame(self, image: np.ndarray) -> torch.Tensor:
+        """(3, H, W) pixel values of one frame, as the processor computes them for the history."""
+        image = Image.fromarray(image).convert("RGB")
+        pixel_values = self.processor.image_processor(images=[image], return_tensors="pt", do_normalize=False)
+        return pixel_values["pixel_values"][0]
 
     def visualize_epoch(
             self,
@@ -0,0 +1,12 @@
+import sys
+from pathlib import Path
+
+SERVER = Path(__file__).resolve().parents[1]
+# the services run from server/ with their model directory on the path as well (see the Dockerfiles)
+sys.path.insert(0, str(SERVER))
+
+
+def add_model_dir(name: str) -> None:
+    path = str(SERVER / "models" / name)
+    if path not in sys.path:
+        sys.path.insert(0, path)
@@ -0,0 +1,80 @@
+"""
+Batched sampling of CogACT's diffusion action head (models/cogact/action_head.py) against sampling
+every session on its own, as predict_action does, on the tiny CPU DiT of the head benchmark. Needs
+the CogACT package (action_model, prismatic) of the cogact image.
+"""
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+import torch
+
+from conftest import add_model_dir
+
+pytest.importorskip("action_model")
+add_model_dir("cogact")
+action_head = pytest.importorskip("action_head")
+
+from benchmarks.cogact_head_benchmark import relative_error, sample_one, tiny_action_model  # noqa: E402
+
+TOKEN_SIZE = 32
+CHUNK_LEN = 16
+DDIM_STEPS = 10
+# batched matmuls round differently, so the difference is relative to the size of the samples
+TOLERANCE = 1e-5
+
+
+@pytest.fixture(scope="module")
+def action_model():
+    return tiny_action_model(TOKEN_SIZE, CHUNK_LEN, DDIM_STEPS)
+
+
+def sessions(count, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    features = torch.randn(count, TOKEN_SIZE, generator=generator)
+    noise = torch.randn(count, CHUNK_LEN, 7, generator=generator)
+    return features, noise
+
+
+def per_session(action_model, features, noise, cfg_scales):
+    return torch.cat([sample_one(action_model, f, n, s) for f, n, s in zip(features, noise, cfg_scales)])
+
+
+@pytest.mark.parametrize("cfg_scales", [[1.5, 2.0, 3.0, 1.5, 5.0], [1.0, 1.0, 1.0], [0.5, 1.0]])
+def test_batch_matches_sessions(action_model, cfg_scales):
+    # a (B, 1, 1) scale per session with guidance, the conditional branch alone without
+    features, noise = sessions(len(cfg_scales))
+    actual = action_head.sample_chunks(action_model, features, noise, cfg_scales, use_ddim=True)
+    assert actual.shape == (len(cfg_scales), CHUNK_LEN, 7)
+    assert relative_error(actual, per_session(action_model, features, noise, cfg_scales)) <= TOLERANCE
+
+
+def test_session_does_not_depend_on_the_batch(action_model):
+    features, noise = sessions(4)
+    alone = action_head.sample_chunks(action_model, features[:1], noise[:1], [2.0], use_ddim=True)
+    batched = action_head.sample_chunks(action_model, features, noise, [2.0, 4.0, 1.5, 3.0], use_ddim=True)
+    assert relative_error(batched[:1], alone) <= TOLERANCE
+
+
+def test_forward_batch_mixes_guidance(action_model, monkeypatch):
+    # CogACTInference.forward_batch splits the sessions with and without guidance into two loops
+    cogact_inference = pytest.importorskip("cogact_inference")
+    cfg_scales = [1.0, 1.5, 3.0, 1.0, 2.0]
+    features, _ = sessions(len(cfg_scales))
+    monkeypatch.setattr(cogact_inference, "cognition_features",
+                        lambda vla, image, instruction, patches=None: features[int(instruction)][None])
+    monkeypatch.setattr(cogact_inference, "unnormalize_chunk", lambda vla, actions, unnorm_key: actions)
+    inference = object.__new__(cogact_inference.CogACTInference)
+    inference.vla = SimpleNamespace(action_model=action_model, future_action_window_size=CHUNK_LEN - 1)
+    inference.ddim_samplers = {DDIM_STEPS: action_model.ddim_diffusion}
+    inputs = [{"image": None, "instruction": str(i), "unnorm_key": None, "cfg_scale": cfg_scale,
+               "use_ddim": True, "num_ddim_steps": DDIM_STEPS, "image_key": None}
+              for i, cfg_scale in enumerate(cfg_scales)]
+
+    torch.manual_seed(0)
+    outputs = inference.forward_batch(inputs)
+    # forward_batch draws the noise of every session in order
+    torch.manual_seed(0)
+    noise = torch.cat([torch.randn(1, CHUNK_LEN, 7) for _ in cfg_scales])
+    expected = per_session(action_model, features, noise, cfg_scales)
+    assert relative_error(torch.from_numpy(np.stack(outputs)), expected) <= TOLERANCE
@@ -0,0 +1,59 @@
+"""
+Decoded-token accounting of ECoT (vla_decoded_tokens, /reasoning), with the model replaced by a stub.
+"""
+import numpy as np
+import pytest
+import torch
+
+from conftest import add_model_dir
+
+add_model_dir("ecot")
+ecot_inference = pytest.importorskip("ecot_inference")
+
+from common.duplicates import forward_or_reuse, reuse_outputs  # noqa: E402
+from common.prismatic import EMPTY_TOKEN_ID  # noqa: E402
+from common.sessions import PolicyState  # noqa: E402
+
+NEW_TOKENS = 12
+
+
+class StubECoT:
+    """predict_action like PrismaticForConditionalGeneration: the prompt gets the empty token, then generate."""
+
+    def predict_action(self, input_ids, unnorm_key=None, **kwargs):
+        if input_ids[0, -1] != EMPTY_TOKEN_ID:
+            input_ids = torch.cat([input_ids, input_ids.new_tensor([[EMPTY_TOKEN_ID]])], dim=1)
+        generated = torch.cat([input_ids, torch.arange(NEW_TOKENS)[None]], dim=1)
+        return np.zeros(7), generated
+
+
+def make_inference():
+    inference = object.__new__(ecot_inference.EcoTInference)
+    inference.model = StubECoT()
+    inference.reasoning_interval = 1
+    inference.max_reasoning_tokens = None
+    inference.reasoning_sections = None
+    inference.max_new_tokens = 1024
+    return inference
+
+
+@pytest.mark.parametrize("prompt", [[1, 512, 13], [1, 512, 13, EMPTY_TOKEN_ID]])
+def test_predict_action_counts_only_new_tokens(prompt):
+    inputs = {"inputs": {"input_ids": torch.tensor([prompt])}, "unnorm_key": "bridge_orig"}
+    [(_, _, decoded_tokens)] = make_inference().forward_batch([inputs])
+    assert decoded_tokens == NEW_TOKENS
+
+
+def test_reused_step_decodes_nothing():
+    inference = make_inference()
+    inference.action_scale = 1.0
+    state = PolicyState()
+    state.policy_setup = "widowx_bridge"
+    image = np.zeros((64, 64, 3), dtype=np.uint8)
+    inputs = {"inputs": {"input_ids": torch.tensor([[1, 512, 13]])}, "unnorm_key": "bridge_orig"}
+    for expected in [NEW_TOKENS, 0, 0]:
+        # the same frame again is served the outputs of the first forward (common/duplicates.py)
+        reuse = reuse_outputs(image, state, threshold=0.01)
+        [step_outputs] = forward_or_reuse(inference.forward_batch, [reuse or inputs])
+        inference.postprocess_batch([step_outputs], [state])
+        assert state.decoded_tokens == expected
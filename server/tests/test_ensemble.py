@@ -0,0 +1,135 @@
+"""
+Parity of the ring-buffer ensemble pools (common/ensemble.py) with the per-session deque ensemblers
+they replaced: SpatialVLA's ActionEnsembler and CogACT's AdaptiveEnsembler. The pools match them bit
+for bit up to a horizon of 7; from 8 on the summation order can change the last bit, so float32
+actions of unit scale are compared to within 1e-6 there.
+"""
+from collections import deque
+
+import numpy as np
+import pytest
+
+from common.ensemble import AdaptiveEnsemblePool, Ensembler, TemporalEnsemblePool, ensemble_batch
+
+HORIZONS = [1, 2, 3, 4, 7, 8, 12, 16]
+CHUNK_LEN = 16
+
+
+class ActionEnsembler:
+    """SpatialVLA's temporal ensembler before the pools."""
+
+    def __init__(self, pred_action_horizon, action_ensemble_temp=0.0):
+        self.pred_action_horizon = pred_action_horizon
+        self.action_ensemble_temp = action_ensemble_temp
+        self.action_history = deque(maxlen=self.pred_action_horizon)
+
+    def reset(self):
+        self.action_history.clear()
+
+    def ensemble_action(self, cur_action):
+        self.action_history.append(cur_action)
+        num_actions = len(self.action_history)
+        if cur_action.ndim == 1:
+            curr_act_preds = np.stack(self.action_history)
+        else:
+            curr_act_preds = np.stack(
+                [pred_actions[i] for (i, pred_actions) in zip(range(num_actions - 1, -1, -1), self.action_history)
+                 if i < len(pred_actions)]
+            )
+            num_actions = len(curr_act_preds)
+        weights = np.exp(-self.action_ensemble_temp * np.arange(num_actions))
+        weights = weights / weights.sum()
+        return np.sum(weights[:, None] * curr_act_preds, axis=0)
+
+
+class AdaptiveEnsembler:
+    """CogACT's adaptive ensembler before the pools."""
+
+    def __init__(self, pred_action_horizon, adaptive_ensemble_alpha=0.0):
+        self.pred_action_horizon = pred_action_horizon
+        self.action_history = deque(maxlen=self.pred_action_horizon)
+        self.adaptive_ensemble_alpha = adaptive_ensemble_alpha
+
+    def reset(self):
+        self.action_history.clear()
+
+    def ensemble_action(self, cur_action):
+        self.action_history.append(cur_action)
+        num_actions = len(self.action_history)
+        if cur_action.ndim == 1:
+            curr_act_preds = np.stack(self.action_history)
+        else:
+            curr_act_preds = np.stack(
+                [pred_actions[i] for (i, pred_actions) in zip(range(num_actions - 1, -1, -1), self.action_history)
+                 if i < len(pred_actions)]
+            )
+            num_actions = len(curr_act_preds)
+        ref = curr_act_preds[num_actions - 1, :]
+        dot_product = np.sum(curr_act_preds * ref, axis=1)
+        norm_previous_pred = np.linalg.norm(curr_act_preds, axis=1)
+        norm_ref = np.linalg.norm(ref)
+        cos_similarity = dot_product / (norm_previous_pred * norm_ref + 1e-7)
+        weights = np.exp(self.adaptive_ensemble_alpha * cos_similarity)
+        weights = weights / weights.sum()
+        return np.sum(weights[:, None] * curr_act_preds, axis=0)
+
+
+KINDS = {
+    "temporal": (TemporalEnsemblePool, ActionEnsembler, -0.8),
+    "adaptive": (AdaptiveEnsemblePool, AdaptiveEnsembler, 0.1),
+}
+
+
+def assert_matches(actual, expected, horizon):
+    if horizon <= 7:
+        np.testing.assert_array_equal(actual, expected)
+    else:
+        np.testing.assert_allclose(actual, expected, rtol=0, atol=1e-6)
+
+
+@pytest.mark.parametrize("kind", KINDS)
+@pytest.mark.parametrize("horizon", HORIZONS)
+def test_pool_matches_deque_ensembler(kind, horizon):
+    pool_type, reference_type, param = KINDS[kind]
+    rng = np.random.default_rng(horizon)
+    sessions = 5
+    pool = pool_type(horizon, param, capacity=2)
+    ensemblers = [Ensembler(pool) for _ in range(sessions)]
+    references = [reference_type(horizon, param) for _ in range(sessions)]
+    for step in range(4 * horizon + 20):
+        for ensembler, reference in zip(ensemblers, references):
+            # a new episode, so the history restarts shorter than the horizon
+            if rng.uniform() < 0.05:
+                ensembler.reset()
+                reference.reset()
+        # a random subset of the sessions steps, with chunks cut short as with exec_horizon > 1
+        active = [i for i in range(sessions) if rng.uniform() < 0.8]
+        chunks = [rng.standard_normal((int(rng.integers(1, CHUNK_LEN + 1)), 7)).astype(np.float32) for _ in active]
+        actual = ensemble_batch([ensemblers[i] for i in active], chunks)
+        for i, chunk, action in zip(active, chunks, actual):
+            assert_matches(action, references[i].ensemble_action(chunk), horizon)
+
+
+@pytest.mark.parametrize("kind", KINDS)
+@pytest.mark.parametrize("horizon", [2, 7, 16])
+def test_repeated_session_in_one_batch(kind, horizon):
+    # consecutive steps of one session (sequential /step_batch) are added in order
+    pool_type, reference_type, param = KINDS[kind]
+    rng = np.random.default_rng(0)
+    ensemblers = [Ensembler(pool_type(horizon, param))] * 3
+    reference = reference_type(horizon, param)
+    for _ in range(horizon + 2):
+        chunks = list(rng.standard_normal((3, CHUNK_LEN, 7)).astype(np.float32))
+        for chunk, action in zip(chunks, ensemble_batch(ensemblers, chunks)):
+            assert_matches(action, reference.ensemble_action(chunk), horizon)
+
+
+@pytest.mark.parametrize("kind", KINDS)
+def test_single_actions(kind):
+    # 1-D inputs are averaged without the time alignment
+    pool_type, reference_type, param = KINDS[kind]
+    rng = np.random.default_rng(1)
+    ensembler, reference = Ensembler(pool_type(4, param)), reference_type(4, param)
+    for _ in range(10):
+        action = rng.standard_normal(7).astype(np.float32)
+        assert_matches(ensembler.ensemble_action(action), reference.ensemble_action(action), 4)
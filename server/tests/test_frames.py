@@ -0,0 +1,50 @@
+"""
+Binary frame protocol of /step (common/frames.py): round trips, and the frames the models cannot
+take, which must fail to decode (a 400) instead of reaching preprocess.
+"""
+import struct
+
+import numpy as np
+import pytest
+
+from common.frames import CODECS, FRAME_MAGIC, FRAME_VERSION, decode_frame, encode_frame
+
+
+def header(dtype_idx, shape):
+    return (struct.pack("<4sBBBB", FRAME_MAGIC, FRAME_VERSION, CODECS.index("raw"), dtype_idx, len(shape))
+            + struct.pack(f"<{len(shape)}I", *shape) + struct.pack("<HH", 0, 0))
+
+
+@pytest.mark.parametrize("codec", ["raw", "jpeg"])
+def test_round_trip(codec):
+    image = np.random.default_rng(0).integers(0, 256, (24, 32, 3), dtype=np.uint8)
+    frame = decode_frame(encode_frame(image, codec, session_id="s", task_description="pick"))
+    assert frame.image.shape == image.shape and frame.image.dtype == np.uint8
+    assert (frame.session_id, frame.task_description) == ("s", "pick")
+    if codec == "raw":
+        np.testing.assert_array_equal(frame.image, image)
+
+
+@pytest.mark.parametrize("image", [
+    np.zeros((24, 32), dtype=np.uint8),
+    np.zeros((24, 32, 4), dtype=np.uint8),
+    np.zeros((24, 32, 3), dtype=np.uint16),
+    np.zeros((24, 32, 3), dtype=np.float32),
+])
+def test_encode_rejects_non_rgb_uint8(image):
+    with pytest.raises(ValueError):
+        encode_frame(image)
+
+
+@pytest.mark.parametrize("dtype_idx, shape, itemsize", [
+    (0, (24, 32), 1),
+    (0, (24, 32, 1), 1),
+    (0, (2, 24, 32, 3), 1),
+    # dtype codes other than uint8
+    (1, (24, 32, 3), 2),
+    (2, (24, 32, 3), 4),
+])
+def test_decode_rejects_non_rgb_uint8(dtype_idx, shape, itemsize):
+    message = header(dtype_idx, shape) + bytes(int(np.prod(shape)) * itemsize)
+    with pytest.raises(ValueError):
+        decode_frame(message)
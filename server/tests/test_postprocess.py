@@ -0,0 +1,133 @@
+"""
+Parity of the vectorized post-processing (common/postprocess.py) with the per-session code it
+replaced: transforms3d's euler2axangle and the scalar sticky-gripper state machines of SIMPLER
+(OpenVLA, ECoT) and of CogACT / SpatialVLA.
+"""
+import numpy as np
+import pytest
+from transforms3d.euler import euler2axangle as reference_euler2axangle
+
+from common.postprocess import euler2axangle, postprocess_actions
+from common.sessions import PolicyState
+
+
+def reference_axangle(rpy):
+    axis, angle = reference_euler2axangle(*rpy)
+    return axis * angle
+
+
+class ScalarGripper:
+    """The per-session sticky gripper of the model classes before vectorization."""
+
+    def __init__(self, num_repeat, hold_previous):
+        self.num_repeat = num_repeat
+        self.hold_previous = hold_previous
+        self.sticky_action_is_on = False
+        self.gripper_action_repeat = 0
+        self.sticky_gripper_action = 0.0
+        self.previous_gripper_action = None
+
+    def step(self, current):
+        if self.previous_gripper_action is None:
+            relative = 0.0
+            if self.hold_previous:
+                self.previous_gripper_action = current
+        else:
+            relative = self.previous_gripper_action - current
+        if not self.hold_previous:
+            self.previous_gripper_action = current
+
+        if np.abs(relative) > 0.5 and not self.sticky_action_is_on:
+            self.sticky_action_is_on = True
+            self.sticky_gripper_action = relative
+            if self.hold_previous:
+                self.previous_gripper_action = current
+
+        if self.sticky_action_is_on:
+            self.gripper_action_repeat += 1
+            relative = self.sticky_gripper_action
+
+        if self.gripper_action_repeat == self.num_repeat:
+            self.sticky_action_is_on = False
+            self.gripper_action_repeat = 0
+            self.sticky_gripper_action = 0.0
+        return relative
+
+
+def test_euler2axangle_random():
+    rpy = np.random.default_rng(0).uniform(-np.pi, np.pi, (1000, 3))
+    expected = np.stack([reference_axangle(row) for row in rpy])
+    np.testing.assert_allclose(euler2axangle(rpy), expected, rtol=0, atol=1e-12)
+
+
+@pytest.mark.parametrize("rpy", [
+    (0.0, 0.0, 0.0),
+    (1e-17, 0.0, -1e-17),
+    (np.pi, 0.0, 0.0),
+    (-np.pi, 0.0, 0.0),
+    (0.0, np.pi, 0.0),
+    (0.0, 0.0, -np.pi),
+    (np.pi, np.pi, np.pi),
+    (-np.pi, np.pi / 2, np.pi),
+    (0.0, -np.pi / 2, 0.0),
+])
+def test_euler2axangle_edges(rpy):
+    np.testing.assert_allclose(euler2axangle(np.array([rpy])), [reference_axangle(rpy)], rtol=0, atol=1e-12)
+
+
+def gripper_sequence(rng, steps):
+    """Open/close commands with long holds, so that sticky actions trigger and expire."""
+    values, value = [], rng.uniform(0, 1)
+    for _ in range(steps):
+        if rng.uniform() < 0.15:
+            value = 1.0 - value if rng.uniform() < 0.7 else rng.uniform(0, 1)
+        values.append(value)
+    return np.array(values)
+
+
+@pytest.mark.parametrize("hold_previous", [False, True])
+def test_sticky_gripper_matches_scalar_code(hold_previous):
+    rng = np.random.default_rng(1)
+    setups = ["google_robot", "google_robot", "widowx_bridge", "google_robot"]
+    num_repeats = [15, 10, 1, 3]
+    states, references = [], []
+    for setup, num_repeat in zip(setups, num_repeats):
+        state = PolicyState()
+        state.policy_setup = setup
+        state.sticky_gripper_num_repeat = num_repeat
+        states.append(state)
+        references.append(ScalarGripper(num_repeat, hold_previous))
+    steps = 80
+    grippers = np.stack([gripper_sequence(rng, steps) for _ in states])
+
+    for t in range(steps):
+        raw_actions = rng.uniform(-0.5, 0.5, (len(states), 7))
+        raw_actions[:, 6] = grippers[:, t]
+        results = postprocess_actions(raw_actions, states, 1.0, hold_previous)
+        for i, (_, action) in enumerate(results):
+            if setups[i] == "google_robot":
+                expected = references[i].step(grippers[i, t])
+            else:
+                expected = 2.0 * (grippers[i, t] > 0.5) - 1.0
+            assert action["gripper"][0] == pytest.approx(expected, abs=1e-12), (t, i)
+            np.testing.assert_allclose(action["rot_axangle"], reference_axangle(raw_actions[i, 3:6]), atol=1e-12)
+
+
+@pytest.mark.parametrize("hold_previous", [False, True])
+def test_repeated_session_in_one_batch(hold_previous):
+    # consecutive steps of one session (sequential /step_batch) next to another session
+    rng = np.random.default_rng(2)
+    states = [PolicyState(), PolicyState()]
+    for state in states:
+        state.policy_setup = "google_robot"
+        state.sticky_gripper_num_repeat = 4
+    references = [ScalarGripper(4, hold_previous), ScalarGripper(4, hold_previous)]
+    grippers = [gripper_sequence(rng, 60), gripper_sequence(rng, 60)]
+    for t in range(0, 60, 3):
+        order = [0, 0, 1, 0, 1, 1]
+        positions = [t, t + 1, t, t + 2, t + 1, t + 2]
+        raw_actions = np.zeros((len(order), 7))
+        raw_actions[:, 6] = [grippers[i][p] for i, p in zip(order, positions)]
+        results = postprocess_actions(raw_actions, [states[i] for i in order], 1.0, hold_previous)
+        for (_, action), i, p in zip(results, order, positions):
+            assert action["gripper"][0] == pytest.approx(references[i].step(grippers[i][p]), abs=1e-12)
@@ -0,0 +1,70 @@
+"""
+Forward schedule of the open-loop chunk execution (exec_horizon) with prefetching (prefetch_at),
+on SpatialVLA's synchronous step with the model replaced by a recorder.
+"""
+import numpy as np
+import pytest
+
+from conftest import add_model_dir
+
+add_model_dir("spatialvla")
+spatialvla_inference = pytest.importorskip("spatialvla_inference")
+
+from common.sessions import PolicyState  # noqa: E402
+
+CHUNK_LEN = 16
+
+
+def make_inference(exec_horizon, prefetch_at):
+    inference = object.__new__(spatialvla_inference.SpatialVLAInference)
+    inference.exec_horizon = exec_horizon
+    inference.prefetch_at = prefetch_at
+    inference.duplicate_frame_threshold = None
+    inference.action_ensemble = False
+    inference.action_scale = 1.0
+    inference._resize_image = lambda image: image
+    inference._add_image_to_history = lambda image, state: None
+    # the inputs of a forward are the index of the step whose frame conditions it
+    inference.frames = []
+    inference._model_inputs = lambda state: len(inference.frames)
+    inference.forwards = []
+
+    def forward_batch(inputs):
+        inference.forwards.extend(inputs)
+        return [np.zeros((CHUNK_LEN, 7), dtype=np.float32) for _ in inputs]
+
+    inference.forward_batch = forward_batch
+    return inference
+
+
+def run(inference, steps):
+    state = PolicyState()
+    state.policy_setup = "widowx_bridge"
+    inference.reset("pick", state)
+    starts = []
+    for _ in range(steps):
+        image = np.zeros((8, 8, 3), dtype=np.uint8)
+        inference.step(image, None, state=state)
+        inference.frames.append(image)
+        starts.append(state.chunk_step == state.chunk_start)
+    # steps that took their action from a new chunk
+    return [step for step, start in enumerate(starts) if start]
+
+
+def test_forward_every_exec_horizon_steps():
+    inference = make_inference(exec_horizon=4, prefetch_at=None)
+    assert run(inference, 12) == [0, 4, 8]
+    assert inference.forwards == [0, 4, 8]
+
+
+def test_prefetch_keeps_the_cadence_of_exec_horizon():
+    inference = make_inference(exec_horizon=4, prefetch_at=2)
+    # every chunk serves 4 steps; the next one is predicted from the frame 2 steps into the current one
+    assert run(inference, 13) == [0, 4, 8, 12]
+    assert inference.forwards == [0, 2, 6, 10]
+
+
+def test_prefetch_at_the_first_cached_step():
+    inference = make_inference(exec_horizon=3, prefetch_at=1)
+    assert run(inference, 10) == [0, 3, 6, 9]
+    assert inference.forwards == [0, 1, 4, 7]
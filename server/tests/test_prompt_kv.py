@@ -0,0 +1,40 @@
+"""
+Why the key/value states of the prompt are not reused across the steps of an episode (see
+common/prismatic.py): in the Prismatic layout <BOS>, image patches, prompt text, the keys and values
+of the text change with the frame from the second layer on. Checked on a tiny random Llama.
+"""
+import torch
+from transformers import LlamaConfig, LlamaForCausalLM
+
+NUM_PATCHES = 4
+NUM_TEXT = 5
+
+
+def prompt_kv(model, bos, patches, text):
+    embeds = torch.cat([bos, patches, text], dim=1)
+    with torch.no_grad():
+        past = model(inputs_embeds=embeds, use_cache=True).past_key_values
+    return [(past[layer][0], past[layer][1]) for layer in range(model.config.num_hidden_layers)]
+
+
+def test_text_kv_depends_on_the_image_from_the_second_layer():
+    torch.manual_seed(0)
+    config = LlamaConfig(vocab_size=64, hidden_size=32, intermediate_size=64, num_hidden_layers=3,
+                         num_attention_heads=4, num_key_value_heads=4, max_position_embeddings=32)
+    model = LlamaForCausalLM(config).eval()
+    embed = model.get_input_embeddings()
+    bos = embed(torch.tensor([[1]]))
+    text = embed(torch.randint(2, 64, (1, NUM_TEXT)))
+    # projected patches of two different frames
+    first = prompt_kv(model, bos, torch.randn(1, NUM_PATCHES, 32), text)
+    second = prompt_kv(model, bos, torch.randn(1, NUM_PATCHES, 32), text)
+
+    text_positions = slice(1 + NUM_PATCHES, None)
+    for layer, ((keys, values), (other_keys, other_values)) in enumerate(zip(first, second)):
+        # <BOS> comes before the image and never sees it
+        assert torch.allclose(keys[:, :, :1], other_keys[:, :, :1])
+        assert torch.allclose(values[:, :, :1], other_values[:, :, :1])
+        same_text = (torch.allclose(keys[:, :, text_positions], other_keys[:, :, text_positions])
+                     and torch.allclose(values[:, :, text_positions], other_values[:, :, text_positions]))
+        # layer 0 projects the text embeddings alone; deeper layers take in the attended patches
+        assert same_text == (layer == 0), layer
@@ -0,0 +1,208 @@
+"""
+Client-carried policy state (common/states.py): the state of every model kind survives a round trip
+through the blob and the X-Policy-State header, and malformed blobs are rejected with a 400.
+CogACTInference needs the CogACT package, so its state is built by a stand-in with the same
+adaptive ensembler.
+"""
+import base64
+
+import numpy as np
+import pytest
+import torch
+from fastapi import HTTPException
+
+from conftest import add_model_dir
+
+for name in ("openvla", "ecot", "spatialvla", "cogact"):
+    add_model_dir(name)
+openvla_inference = pytest.importorskip("openvla_inference")
+ecot_inference = pytest.importorskip("ecot_inference")
+spatialvla_inference = pytest.importorskip("spatialvla_inference")
+
+from adaptive_ensemble import AdaptiveEnsembler  # noqa: E402
+from common.duplicates import frame_signature  # noqa: E402
+from common.ensemble import AdaptiveEnsemblePool, TemporalEnsemblePool  # noqa: E402
+from common.protocol import carried_state, read_carried_state  # noqa: E402
+from common.sessions import PolicyState  # noqa: E402
+from common.states import FIELDS, STATE_HEADER, _read, decode_state, encode_state  # noqa: E402
+
+CHUNK_LEN = 8
+HORIZON = 4
+
+
+def base(cls, **attributes):
+    inference = object.__new__(cls)
+    inference.policy_setup = "google_robot"
+    inference.unnorm_key = cls.POLICY_SETUPS["google_robot"]["unnorm_key"]
+    # the last chunk is carried only when its actions are executed open loop
+    inference.exec_horizon = 4
+    inference.__dict__.update(attributes)
+    return inference
+
+
+def openvla():
+    return base(openvla_inference.OpenVLAInference, vla=None)
+
+
+def ecot():
+    return base(ecot_inference.EcoTInference, model=None, reasoning_interval=4)
+
+
+def spatialvla():
+    return base(spatialvla_inference.SpatialVLAInference, processor=None, action_ensemble=True,
+                pred_action_horizon=HORIZON, action_ensemble_temp=-0.8, obs_horizon=1, obs_interval=1,
+                _process_frame=lambda image: image,
+                ensemble_pool=TemporalEnsemblePool(HORIZON, -0.8))
+
+
+class CogACTStates:
+    """new_state of CogACTInference with adaptive ensembling, without the model."""
+    exec_horizon = 4
+
+    def __init__(self):
+        self.pool = AdaptiveEnsemblePool(HORIZON, 0.1)
+
+    def new_state(self, policy_setup=None, unnorm_key=None):
+        state = PolicyState(image_history_len=1)
+        state.policy_setup = policy_setup or "google_robot"
+        state.unnorm_key = unnorm_key or "fractal20220817_data"
+        state.sticky_gripper_num_repeat = 10
+        state.action_ensembler = AdaptiveEnsembler(HORIZON, 0.1, pool=self.pool)
+        return state
+
+
+def episode(inference, rng, steps=6):
+    """A state some steps into an episode, with every carried field away from its default."""
+    state = inference.new_state("widowx_bridge")
+    state.reset("put the spoon on the towel")
+    state.num_steps = 17
+    state.sticky_action_is_on = True
+    state.gripper_action_repeat = 3
+    state.sticky_gripper_action = -1.0
+    state.previous_gripper_action = 0.123456789
+    state.action_chunk = rng.standard_normal((CHUNK_LEN, 7)).astype(np.float32)
+    state.chunk_step = state.chunk_start = 2
+    state.chunk_step += 1
+    if state.action_ensembler is not None:
+        for _ in range(steps):
+            state.action_ensembler.ensemble_action(rng.standard_normal((CHUNK_LEN, 7)).astype(np.float32))
+    return state
+
+
+def carried(state):
+    values = {}
+    for kind, name in FIELDS:
+        value = _read(state, name)
+        values[name] = [a.tolist() for a in value] if kind == "arrays" and value else value
+        if kind == "array" and value is not None:
+            values[name] = (value.dtype.str, value.tolist())
+    return values
+
+
+def round_trip(inference, state):
+    # through the header, as a stateless client carries it
+    request = type("Request", (), {"headers": {STATE_HEADER: carried_state(inference, state)}})()
+    return read_carried_state(inference, request)
+
+
+@pytest.mark.parametrize("make", [openvla, ecot, spatialvla, CogACTStates])
+def test_round_trip(make):
+    rng = np.random.default_rng(0)
+    inference = make()
+    state = episode(inference, rng)
+    if isinstance(inference, CogACTStates):
+        state.sampling = {"cfg_scale": 2.5, "use_ddim": False, "num_ddim_steps": 7}
+    restored = round_trip(inference, state)
+    assert carried(restored) == carried(state)
+    assert restored.sampling == state.sampling
+    assert restored.sticky_gripper_num_repeat == state.sticky_gripper_num_repeat
+    if state.action_ensembler is not None:
+        # the next ensembled actions are the same
+        for _ in range(HORIZON + 1):
+            chunk = rng.standard_normal((CHUNK_LEN, 7)).astype(np.float32)
+            np.testing.assert_array_equal(restored.action_ensembler.ensemble_action(chunk),
+                                          state.action_ensembler.ensemble_action(chunk))
+
+
+@pytest.mark.parametrize("steps", [0, 1, HORIZON - 1, 3 * HORIZON])
+def test_ensemble_history_is_trimmed(steps):
+    inference = spatialvla()
+    state = episode(inference, np.random.default_rng(1), steps)
+    history = state.action_ensembler.history()
+    # oldest first, the chunk added age steps ago keeps its rows age + 1 to HORIZON - 1
+    ages = range(min(steps, HORIZON - 1) - 1, -1, -1)
+    assert [len(chunk) for chunk in history] == [HORIZON - 1 - age for age in ages]
+    restored = round_trip(inference, state)
+    assert [c.tolist() for c in restored.action_ensembler.history()] == [c.tolist() for c in history]
+
+
+def test_chunk_is_carried_only_with_exec_horizon():
+    inference = openvla()
+    state = episode(inference, np.random.default_rng(2))
+    inference.exec_horizon = 1
+    restored = round_trip(inference, state)
+    assert restored.action_chunk is None and restored.chunk_step == 0
+    inference.exec_horizon = 4
+    restored = round_trip(inference, state)
+    np.testing.assert_array_equal(restored.action_chunk, state.action_chunk)
+    assert (restored.chunk_step, restored.chunk_start) == (3, 2)
+
+
+def test_ecot_reasoning():
+    inference = ecot()
+    state = episode(inference, np.random.default_rng(3))
+    state.reasoning_ids = torch.tensor([[1, 512, 32000, 29871, 65535]])
+    state.reasoning_steps = 2
+    state.reasoning_scene = frame_signature(np.random.default_rng(3).integers(0, 256, (64, 64, 3), dtype=np.uint8))
+    restored = round_trip(inference, state)
+    assert torch.equal(restored.reasoning_ids, state.reasoning_ids)
+    assert restored.reasoning_ids.dtype == torch.long
+    np.testing.assert_array_equal(restored.reasoning_scene, state.reasoning_scene)
+    assert restored.reasoning_steps == 2
+    # token ids past uint16 are carried as int32
+    state.reasoning_ids = torch.tensor([[1, 70000]])
+    assert torch.equal(round_trip(inference, state).reasoning_ids, state.reasoning_ids)
+
+
+def test_fresh_state_is_the_header():
+    inference = openvla()
+    assert encode_state(inference, PolicyState()) == b"VLAS\x01"
+
+
+def malformed():
+    inference = CogACTStates()
+    blob = encode_state(inference, episode(inference, np.random.default_rng(4)))
+    yield "short", b"VL"
+    yield "magic", b"VLAX" + blob[4:]
+    yield "version", blob[:4] + b"\x09" + blob[5:]
+    yield "tag", blob + bytes([len(FIELDS)])
+    yield "truncated", blob[:-1]
+    # the task string: tag, then a length past the end
+    yield "string", blob[:5] + b"\x00\xff\xff"
+    yield "array dtype", blob[:5] + bytes([FIELDS.index(("array", "action_chunk")), 9, 1, 1, 0])
+
+
+@pytest.mark.parametrize("name, blob", list(malformed()))
+def test_malformed_blob_is_rejected(name, blob):
+    inference = CogACTStates()
+    with pytest.raises(ValueError):
+        decode_state(inference, blob)
+    request = type("Request", (), {"headers": {STATE_HEADER: base64.b64encode(blob).decode()}})()
+    with pytest.raises(HTTPException) as exc_info:
+        read_carried_state(inference, request)
+    assert exc_info.value.status_code == 400
+
+
+def test_every_truncation_is_rejected_or_a_prefix():
+    inference = spatialvla()
+    state = episode(inference, np.random.default_rng(5))
+    blob = encode_state(inference, state)
+    prefixes = 0
+    for end in range(len(blob)):
+        try:
+            decode_state(inference, blob[:end])
+        except ValueError:
+            continue
+        # cut between two fields: the fields before the cut are a valid state
+        prefixes += 1
+    assert prefixes < len(FIELDS)